@@ -0,0 +1,151 @@
+"""
+Negotiated gzip / brotli compression for selected routes.
+
+`CompressionMiddleware` compresses the responses of the routes it is given
+(by route template) when the client accepts it and the body is at least
+COMPRESSION_MIN_SIZE bytes. Brotli is preferred when the optional `brotli`
+package is installed and the client accepts `br`.
+
+Streamed bodies are compressed chunk by chunk and flushed after each one, so a
+client still receives each page of a streamed order list as soon as it is
+produced. Large chunks are compressed on a worker thread (zlib and brotli
+release the GIL) to keep the event loop responsive. Only text formats are
+compressed; XLSX files are zip archives already.
+
+A compressed response is a different representation of the resource, so a
+strong ETag on it is weakened (W/"..."). If-None-Match uses the weak
+comparison, so conditional GETs keep working.
+"""
+
+import asyncio
+import os
+import zlib
+from typing import Iterable, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # optional; gzip only without it
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))  # bytes; smaller bodies are sent as is
+COMPRESSION_THREAD_SIZE = int(os.environ.get('COMPRESSION_THREAD_SIZE', '65536'))  # chunks this big are compressed off the loop
+GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+# Brotli's default (11) is meant for static assets and far too slow per request
+BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4'))
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+
+def available_encodings() -> list:
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """The encoding to use for an Accept-Encoding header (brotli first), or None for identity."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in available_encodings():
+        if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+class _Encoder:
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+        self.encoding = encoding
+
+    def _compress(self, data: bytes, finish: bool) -> bytes:
+        if self.encoding == "br":
+            output = self._compressor.process(data)
+            return output + (self._compressor.finish() if finish else self._compressor.flush())
+        output = self._compressor.compress(data)
+        return output + self._compressor.flush(zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+    async def compress(self, data: bytes, finish: bool) -> bytes:
+        if len(data) >= COMPRESSION_THREAD_SIZE:
+            return await asyncio.to_thread(self._compress, data, finish)
+        return self._compress(data, finish)
+
+
+def _compressible(headers: MutableHeaders) -> bool:
+    content_type = headers.get("content-type", "")
+    return "content-encoding" not in headers and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing the responses of `routes` (route templates)."""
+
+    def __init__(self, app, routes: Iterable[str], minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.routes = set(routes)
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            return await self.app(scope, receive, send)
+
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"))
+        start_message = None
+        passthrough = False
+        encoder: Optional[_Encoder] = None
+        buffered = b""
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough, encoder, buffered
+            if message["type"] == "http.response.start":
+                # The router has stored the matched route in the scope by the time the response starts
+                if getattr(scope.get("route"), "path", None) not in self.routes:
+                    passthrough = True
+                    return await send(message)
+                headers = MutableHeaders(raw=message["headers"])
+                headers.add_vary_header("Accept-Encoding")
+                if encoding is None or message["status"] in (204, 304) or not _compressible(headers):
+                    passthrough = True
+                    return await send(message)
+                start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                buffered += body
+                if more_body and len(buffered) < self.minimum_size:
+                    return
+                if len(buffered) < self.minimum_size:
+                    passthrough = True
+                    await send(start_message)
+                    return await send({"type": "http.response.body", "body": buffered})
+                encoder = _Encoder(encoding)
+                headers = MutableHeaders(raw=start_message["headers"])
+                del headers["content-length"]
+                headers["content-encoding"] = encoding
+                etag = headers.get("etag")
+                if etag and not etag.startswith("W/"):
+                    headers["etag"] = "W/" + etag
+                await send(start_message)
+                body, buffered = buffered, b""
+
+            data = await encoder.compress(body, finish=not more_body)
+            if data or not more_body:
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,160 @@
+"""
+In-process fan-out of order changes to connected dashboards (Server-Sent Events).
+
+Each open /api/events/orders stream is one `Subscription`: a bounded queue of
+encoded SSE frames and nothing else. An idle connection costs one suspended
+task and its queue, with no per-connection timer. A single hub task sends
+every subscription a comment frame every EVENTS_HEARTBEAT_INTERVAL seconds,
+which keeps proxies from closing the stream and reveals dead peers. The same
+task ends streams older than EVENTS_MAX_STREAM_AGE, so clients re-authenticate
+periodically: each stream is opened with a single-use ticket (see server.py).
+
+`publish` encodes an event once and offers the same bytes to every
+subscription of that user without waiting. When a subscription's queue is
+full, the client is not keeping up. The subscription is marked dropped, and
+its stream ends once the frames already queued are sent. The dashboard
+reconnects with a new ticket, and reloads the order list when it does.
+
+The hub lives in one process. With several uvicorn workers, a change reaches
+only the dashboards connected to the worker that wrote it.
+"""
+
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Dict, Optional, Set
+
+from responses import dumps
+
+logger = logging.getLogger(__name__)
+
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', '64'))  # frames a connection may fall behind before it is dropped
+EVENTS_HEARTBEAT_INTERVAL = float(os.environ.get('EVENTS_HEARTBEAT_INTERVAL', '15'))
+# Streams are closed after this long so the client re-authenticates (the dashboard reconnects with a new ticket)
+EVENTS_MAX_STREAM_AGE = float(os.environ.get('EVENTS_MAX_STREAM_AGE', '900'))
+EVENTS_RETRY_MS = 3000  # reconnection delay suggested to EventSource
+
+HEARTBEAT_FRAME = b": keepalive\n\n"
+_CLOSE = object()
+
+
+def encode_event(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + dumps(data) + b"\n\n"
+
+
+class Subscription:
+    def __init__(self, hub: "EventHub", user_id: str, queue_size: int, max_age: float):
+        self.hub = hub
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = False
+        self.closes_at = asyncio.get_running_loop().time() + max_age
+
+    def offer(self, frame) -> bool:
+        """Queue a frame without waiting; a full queue drops the subscription."""
+        if self.dropped:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            self.dropped = True
+            self.hub.dropped += 1
+            logger.info("Dropping slow event stream of user %s", self.user_id)
+            return False
+
+    def close(self):
+        try:
+            self.queue.put_nowait(_CLOSE)
+        except asyncio.QueueFull:
+            self.dropped = True  # ends once the queued frames are sent
+
+
+class EventHub:
+    def __init__(
+        self,
+        queue_size: int = EVENTS_QUEUE_SIZE,
+        heartbeat_interval: float = EVENTS_HEARTBEAT_INTERVAL,
+        max_stream_age: float = EVENTS_MAX_STREAM_AGE,
+    ):
+        self.queue_size = queue_size
+        self.heartbeat_interval = heartbeat_interval
+        self.max_stream_age = max_stream_age
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    def subscribe(self, user_id: str) -> Subscription:
+        subscription = Subscription(self, user_id, self.queue_size, self.max_stream_age)
+        self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.user_id]
+
+    async def stream(self, user_id: str) -> AsyncIterator[bytes]:
+        """
+        An SSE response body: a retry hint, then the user's events until the
+        subscription is dropped or closed. Subscribing only once the body is
+        iterated means a client gone before that leaves nothing behind.
+        """
+        subscription = self.subscribe(user_id)
+        try:
+            yield f"retry: {EVENTS_RETRY_MS}\n\n".encode()
+            while True:
+                frame = await subscription.queue.get()
+                if frame is _CLOSE:
+                    return
+                yield frame
+                if subscription.dropped and subscription.queue.empty():
+                    return
+        finally:
+            self.unsubscribe(subscription)
+
+    def has_subscribers(self, user_id: str) -> bool:
+        return user_id in self._subscriptions
+
+    @property
+    def connections(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def publish(self, user_id: str, event: str, data) -> int:
+        """Offer an event to every stream of `user_id`; returns how many took it."""
+        subscriptions = self._subscriptions.get(user_id)
+        if not subscriptions:
+            return 0
+        frame = encode_event(event, data)
+        return sum(subscription.offer(frame) for subscription in list(subscriptions))
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = loop.time()
+            for subscriptions in list(self._subscriptions.values()):
+                for subscription in list(subscriptions):
+                    if now >= subscription.closes_at:
+                        subscription.close()
+                    else:
+                        subscription.offer(HEARTBEAT_FRAME)
+
+    def start(self):
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        """Stop the heartbeat and end every open stream."""
+        task, self._heartbeat_task = self._heartbeat_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        for subscriptions in list(self._subscriptions.values()):
+            for subscription in list(subscriptions):
+                subscription.close()
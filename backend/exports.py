@@ -0,0 +1,111 @@
+"""
+Streaming exports of orders and dispatches.
+
+Rows come from an async iterator of pages (a Mongo cursor or the Shopify
+paginator) and are written out page by page, so an export never holds more
+than one page in memory.
+
+- CSV is streamed straight to the client as each page is written.
+- XLSX uses `openpyxl` (in requirements.txt; without it format=xlsx is a
+  501). The workbook is built in write-only mode on a worker thread into a
+  spooled temporary file, and is streamed once it is complete (a zip file
+  cannot be sent before it is finished).
+"""
+
+import asyncio
+import csv
+import io
+import os
+import tempfile
+from datetime import datetime
+from typing import AsyncIterator, BinaryIO, List, Sequence
+
+EXPORT_SPOOL_SIZE = int(os.environ.get('EXPORT_SPOOL_SIZE', str(8 * 1024 * 1024)))  # bytes kept in memory before spilling to disk
+EXPORT_READ_SIZE = 64 * 1024
+
+# Spreadsheet apps evaluate cells starting with these characters as formulas
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def xlsx_available() -> bool:
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _is_number(value: str) -> bool:
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def cell_value(value, keep_datetimes: bool = False):
+    """Flatten a document field into a spreadsheet cell."""
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value if keep_datetimes else value.isoformat()
+    if isinstance(value, list):
+        # Line items: "Produit A x2; Produit B x1"
+        value = "; ".join(
+            f"{item.get('name', '')} x{item.get('quantity', 0)}" if isinstance(item, dict) else str(item)
+            for item in value
+        )
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES) and not _is_number(value):
+        return "'" + value
+    return value
+
+
+async def csv_chunks(pages: AsyncIterator[List[dict]], columns: Sequence[str]) -> AsyncIterator[str]:
+    """Yield a CSV document one page at a time, header first."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")  # BOM so Excel opens the UTF-8 (Arabic) text correctly
+    writer.writerow(columns)
+    yield buffer.getvalue()
+
+    async for page in pages:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([cell_value(row.get(column)) for column in columns] for row in page)
+        yield buffer.getvalue()
+
+
+def _append_rows(sheet, page: List[dict], columns: Sequence[str]):
+    for row in page:
+        sheet.append([cell_value(row.get(column), keep_datetimes=True) for column in columns])
+
+
+async def xlsx_file(pages: AsyncIterator[List[dict]], columns: Sequence[str], title: str) -> BinaryIO:
+    """Write the pages into a write-only workbook and return the file, rewound."""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    sheet.append(list(columns))
+    async for page in pages:
+        await asyncio.to_thread(_append_rows, sheet, page, columns)
+
+    output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    try:
+        await asyncio.to_thread(workbook.save, output)
+    except BaseException:
+        output.close()
+        raise
+    output.seek(0)
+    return output
+
+
+async def file_chunks(output: BinaryIO) -> AsyncIterator[bytes]:
+    try:
+        while True:
+            chunk = await asyncio.to_thread(output.read, EXPORT_READ_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        output.close()
@@ -0,0 +1,120 @@
+"""
+MongoDB index declarations.
+
+Every index the app relies on is declared here. `ensure_indexes` creates them
+from the startup hook, and `index_report` (exposed through `manage.py indexes`)
+compares the declaration against the live database.
+"""
+
+import logging
+import os
+from typing import Dict, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True, name="username_unique"),
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        # Also serves plain role lookups
+        IndexModel([("role", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="role_created_at_id"),
+    ],
+    "user_settings": [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+    ],
+    "shopify_orders": [
+        IndexModel([("user_id", ASCENDING), ("id", ASCENDING)], unique=True, name="user_id_id_unique"),
+        IndexModel([("user_id", ASCENDING), ("created_at_ts", DESCENDING)], name="user_id_created_at"),
+    ],
+    "shopify_sync": [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+    ],
+    "shopify_webhooks": [
+        IndexModel([("user_id", ASCENDING), ("webhook_id", ASCENDING)], unique=True, name="user_id_webhook_id_unique"),
+        # Shopify retries a delivery for up to 48 hours
+        IndexModel(
+            [("received_at", ASCENDING)],
+            expireAfterSeconds=int(os.environ.get('SHOPIFY_WEBHOOK_ID_TTL', '259200')),
+            name="received_at_ttl",
+        ),
+    ],
+    "zrexpress_jobs": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("status", ASCENDING), ("available_at", ASCENDING)], name="status_available_at"),
+        IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)], name="status_lease_expires_at"),
+    ],
+    "dispatches": [
+        IndexModel([("user_id", ASCENDING), ("id_externe", ASCENDING)], unique=True, name="user_id_id_externe_unique"),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_id_created_at"),
+    ],
+    "shipments": [
+        IndexModel([("user_id", ASCENDING), ("tracking", ASCENDING)], unique=True, name="user_id_tracking_unique"),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("tracking", DESCENDING)], name="user_id_created_at"),
+        # Status sync: a user's open parcels, least recently checked first
+        IndexModel([("user_id", ASCENDING), ("final", ASCENDING), ("checked_at", ASCENDING)], name="user_id_final_checked_at"),
+    ],
+    "connection_health": [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+    ],
+    "request_profiles": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("route", ASCENDING), ("created_at", DESCENDING)], name="route_created_at"),
+        IndexModel(
+            [("created_at", ASCENDING)],
+            expireAfterSeconds=int(os.environ.get('REQUEST_PROFILE_TTL', '604800')),
+            name="created_at_ttl",
+        ),
+    ],
+    "idempotency_keys": [
+        IndexModel([("user_id", ASCENDING), ("key", ASCENDING)], unique=True, name="user_id_key_unique"),
+        IndexModel(
+            [("created_at", ASCENDING)],
+            expireAfterSeconds=int(os.environ.get('IDEMPOTENCY_KEY_TTL', '86400')),
+            name="created_at_ttl",
+        ),
+    ],
+    "stream_tickets": [
+        # Redeemed tickets are deleted on use; this removes the ones never used
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+}
+
+
+async def ensure_indexes(db):
+    """Create all declared indexes; failures (e.g. duplicates blocking a unique index) are logged, not raised."""
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            logger.error("Could not create indexes on %s: %s", collection, e)
+
+
+async def index_report(db) -> Dict[str, dict]:
+    """
+    Report, per declared collection, which declared indexes are missing, which
+    existing indexes are not declared, and which have not been used since the
+    server last restarted (according to `$indexStats`).
+    """
+    report = {}
+    for collection, indexes in INDEXES.items():
+        declared = {index.document["name"] for index in indexes}
+        existing = set(await db[collection].index_information())
+        existing.discard("_id_")
+
+        usage = {}
+        try:
+            async for stats in db[collection].aggregate([{"$indexStats": {}}]):
+                usage[stats["name"]] = stats["accesses"]["ops"]
+        except OperationFailure:
+            pass
+
+        report[collection] = {
+            "missing": sorted(declared - existing),
+            "undeclared": sorted(existing - declared),
+            "unused": sorted(name for name in existing if usage.get(name) == 0),
+            "usage": {name: usage.get(name) for name in sorted(existing)},
+        }
+    return report
@@ -0,0 +1,176 @@
+"""
+MongoDB-backed background job queue.
+
+Jobs are documents in a collection. In-process async workers claim them
+atomically with a visibility timeout (lease): a job whose worker dies is picked
+up again once its lease expires. Failed jobs are retried with exponential
+backoff until `max_attempts` is reached.
+"""
+
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+class RetryJob(Exception):
+    """Raised by a handler to have the job retried later (counts as an attempt)."""
+
+
+class FailJob(Exception):
+    """Raised by a handler to fail the job immediately, without further retries."""
+
+
+class JobQueue:
+    def __init__(
+        self,
+        collection,
+        handler: Callable[[dict, "JobQueue"], Awaitable[Optional[dict]]],
+        workers: int = 2,
+        visibility_timeout: float = 120,
+        max_attempts: int = 5,
+        poll_interval: float = 1.0,
+        retry_backoff: float = 5.0,
+    ):
+        self.collection = collection
+        self.handler = handler
+        self.workers = workers
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retry_backoff = retry_backoff
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+
+    async def enqueue(self, job_type: str, user_id: str, payload: dict, **fields) -> dict:
+        now = datetime.utcnow()
+        job = {
+            "id": str(uuid.uuid4()),
+            "type": job_type,
+            "user_id": user_id,
+            "status": "queued",
+            "payload": payload,
+            "attempts": 0,
+            "max_attempts": self.max_attempts,
+            "available_at": now,
+            "lease_expires_at": None,
+            "lease_owner": None,
+            "last_error": None,
+            "created_at": now,
+            "updated_at": now,
+            "completed_at": None,
+            **fields,
+        }
+        await self.collection.insert_one(job)
+        self._wakeup.set()
+        return job
+
+    async def claim(self, worker_id: str) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "queued", "available_at": {"$lte": now}},
+                    {"status": "running", "lease_expires_at": {"$lte": now}},
+                ]
+            },
+            {
+                "$set": {
+                    "status": "running",
+                    "lease_owner": worker_id,
+                    "lease_expires_at": now + timedelta(seconds=self.visibility_timeout),
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("available_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def update(self, job: dict, changes: dict):
+        """Apply a Mongo update to a job this worker still holds the lease for."""
+        changes = dict(changes)
+        changes.setdefault("$set", {})["updated_at"] = datetime.utcnow()
+        await self.collection.update_one({"id": job["id"], "lease_owner": job["lease_owner"]}, changes)
+
+    async def _extend_lease(self, job: dict):
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            await self.update(job, {"$set": {
+                "lease_expires_at": datetime.utcnow() + timedelta(seconds=self.visibility_timeout)
+            }})
+
+    async def _finish(self, job: dict, status: str, fields: Optional[dict] = None):
+        now = datetime.utcnow()
+        await self.update(job, {"$set": {
+            "status": status,
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "completed_at": now,
+            **(fields or {}),
+        }})
+
+    async def _retry_or_fail(self, job: dict, error: str):
+        if job["attempts"] >= job.get("max_attempts", self.max_attempts):
+            logger.warning("Job %s failed after %s attempts: %s", job["id"], job["attempts"], error)
+            await self._finish(job, "failed", {"last_error": error})
+            return
+
+        delay = self.retry_backoff * 2 ** (job["attempts"] - 1)
+        await self.update(job, {"$set": {
+            "status": "queued",
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "available_at": datetime.utcnow() + timedelta(seconds=delay),
+            "last_error": error,
+        }})
+
+    async def _process(self, job: dict):
+        lease_task = asyncio.create_task(self._extend_lease(job))
+        try:
+            result = await self.handler(job, self)
+        except RetryJob as e:
+            await self._retry_or_fail(job, str(e))
+        except FailJob as e:
+            await self._finish(job, "failed", {"last_error": str(e)})
+        except Exception as e:
+            logger.exception("Job %s raised", job["id"])
+            await self._retry_or_fail(job, f"{type(e).__name__}: {e}")
+        else:
+            await self._finish(job, "completed", result)
+        finally:
+            lease_task.cancel()
+
+    async def _worker(self, worker_id: str):
+        while True:
+            try:
+                job = await self.claim(worker_id)
+            except Exception:
+                logger.exception("Job queue worker %s could not claim a job", worker_id)
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._process(job)
+
+    def start(self):
+        for _ in range(self.workers):
+            worker_id = str(uuid.uuid4())
+            self._tasks.append(asyncio.create_task(self._worker(worker_id)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the A7delivery backend.
+
+Usage: python manage.py indexes [--create]
+"""
+
+import asyncio
+import json
+import os
+from pathlib import Path
+
+import typer
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from indexes import ensure_indexes, index_report
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+cli = typer.Typer(help="A7delivery backend maintenance commands")
+
+
+@cli.callback()
+def main():
+    """A7delivery backend maintenance commands."""
+
+
+def get_database():
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    return client, client[os.environ['DB_NAME']]
+
+
+@cli.command()
+def indexes(create: bool = typer.Option(False, "--create", help="Create missing indexes before reporting")):
+    """Report missing, undeclared and unused MongoDB indexes."""
+    async def run():
+        client, db = get_database()
+        try:
+            if create:
+                await ensure_indexes(db)
+            return await index_report(db)
+        finally:
+            client.close()
+
+    report = asyncio.run(run())
+    typer.echo(json.dumps(report, indent=2))
+
+    if any(entry["missing"] for entry in report.values()):
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    cli()
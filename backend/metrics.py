@@ -0,0 +1,262 @@
+"""
+Prometheus metrics.
+
+- HTTP requests are counted and timed per route template and status by
+  `MetricsMiddleware`. The time runs until the last body chunk is sent, so
+  streamed responses are measured in full.
+- MongoDB commands are timed per collection and command by
+  `MongoCommandMetrics`, a pymongo command listener passed to the client.
+- Upstream (Shopify / ZRExpress) calls are timed per outcome by
+  `observe_upstream`, which upstream.py calls for every HTTP attempt. Time
+  spent waiting for a rate limiter or connection slot is recorded separately,
+  and so are retries, calls refused by a circuit breaker or deadline, and the
+  number of open breakers.
+- Scheduled per-tenant jobs (scheduler.py) record how late they started
+  and how long they ran.
+- Event-loop lag is sampled by a background task.
+
+`/metrics` renders the registry. When PROMETHEUS_MULTIPROC_DIR is set (uvicorn
+with several workers), values are aggregated across worker processes.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from pymongo import monitoring
+from starlette.responses import Response
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL = float(os.environ.get('METRICS_LOOP_LAG_INTERVAL', '0.5'))  # seconds between event-loop lag samples
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SCHEDULER_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0)
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests handled, by route template and status.",
+    ["method", "route", "status"],
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the last byte of its response.",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "HTTP requests currently being handled.",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds",
+    "MongoDB command round-trip time, by collection, command and outcome.",
+    ["collection", "command", "outcome"],
+    buckets=MONGO_BUCKETS,
+)
+UPSTREAM_REQUEST_DURATION = Histogram(
+    "upstream_request_duration_seconds",
+    "Upstream HTTP call time, by upstream, method and outcome (2xx, 4xx, 429, 5xx or error).",
+    ["upstream", "method", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_QUEUE_DURATION = Histogram(
+    "upstream_queue_seconds",
+    "Time an upstream call waited for a rate limiter or connection slot before being sent.",
+    ["upstream"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries_total",
+    "Upstream calls sent again after a transport error or 502/503/504.",
+    ["upstream"],
+)
+UPSTREAM_REJECTED = Counter(
+    "upstream_rejected_total",
+    "Upstream calls failed without a response, by reason (circuit_open or deadline).",
+    ["upstream", "reason"],
+)
+UPSTREAM_CIRCUITS_OPEN = Gauge(
+    "upstream_circuits_open",
+    "Upstream hosts whose circuit breaker is open or half open.",
+    ["upstream"],
+    multiprocess_mode="livesum",
+)
+SCHEDULER_JOB_LAG = Histogram(
+    "scheduler_job_lag_seconds",
+    "How long after it was due a scheduled per-tenant job started, by job.",
+    ["job"],
+    buckets=SCHEDULER_BUCKETS,
+)
+SCHEDULER_JOB_DURATION = Histogram(
+    "scheduler_job_duration_seconds",
+    "Scheduled per-tenant job runtime, by job and outcome (success, failure or timeout).",
+    ["job", "outcome"],
+    buckets=SCHEDULER_BUCKETS,
+)
+SCHEDULER_JOBS_RUNNING = Gauge(
+    "scheduler_jobs_running",
+    "Scheduled jobs currently running.",
+    multiprocess_mode="livesum",
+)
+SCHEDULER_JOBS_OVERDUE = Gauge(
+    "scheduler_jobs_overdue",
+    "Scheduled jobs past their due time and waiting for a slot or their tenant's turn.",
+    multiprocess_mode="livesum",
+)
+EVENT_LOOP_LAG = Gauge(
+    "event_loop_lag_seconds",
+    "How late the last event-loop lag probe woke up.",
+    multiprocess_mode="livemax",
+)
+
+# Route label for requests that did not match any route, to keep label cardinality bounded
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request count, latency and in-flight requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        status_code = 500
+        started = time.perf_counter()
+        in_progress = HTTP_REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_progress.dec()
+            # The router stores the matched route in the scope; label with its template, not the raw path
+            route = scope.get("route")
+            route_label = getattr(route, "path", None) or UNMATCHED_ROUTE
+            HTTP_REQUESTS.labels(method, route_label, str(status_code)).inc()
+            HTTP_REQUEST_DURATION.labels(method, route_label, str(status_code)).observe(time.perf_counter() - started)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo command listener timing each command by collection."""
+
+    # Commands whose first field is not the collection name
+    _COLLECTION_FIELDS = {"getMore": "collection"}
+
+    def __init__(self):
+        self._collections = {}
+
+    def _key(self, event):
+        return event.connection_id, event.request_id
+
+    def started(self, event):
+        field = self._COLLECTION_FIELDS.get(event.command_name, event.command_name)
+        collection = event.command.get(field)
+        self._collections[self._key(event)] = collection if isinstance(collection, str) else ""
+
+    def _observe(self, event, outcome):
+        collection = self._collections.pop(self._key(event), "")
+        MONGO_COMMAND_DURATION.labels(collection, event.command_name, outcome).observe(event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._observe(event, "success")
+
+    def failed(self, event):
+        self._observe(event, "failure")
+
+
+def upstream_outcome(status_code: Optional[int]) -> str:
+    if status_code is None:
+        return "error"
+    if status_code == 429:
+        return "429"
+    return f"{status_code // 100}xx"
+
+
+def observe_upstream(upstream: str, method: str, status_code: Optional[int], duration: float):
+    UPSTREAM_REQUEST_DURATION.labels(upstream, method, upstream_outcome(status_code)).observe(duration)
+
+
+def observe_upstream_queue(upstream: str, duration: float):
+    UPSTREAM_QUEUE_DURATION.labels(upstream).observe(duration)
+
+
+def observe_upstream_retry(upstream: str):
+    UPSTREAM_RETRIES.labels(upstream).inc()
+
+
+def observe_upstream_rejected(upstream: str, reason: str):
+    UPSTREAM_REJECTED.labels(upstream, reason).inc()
+
+
+def set_upstream_circuits_open(upstream: str, count: int):
+    UPSTREAM_CIRCUITS_OPEN.labels(upstream).set(count)
+
+
+def observe_scheduler_job(job: str, outcome: str, lag: float, duration: float):
+    SCHEDULER_JOB_LAG.labels(job).observe(lag)
+    SCHEDULER_JOB_DURATION.labels(job, outcome).observe(duration)
+
+
+def set_scheduler_backlog(running: int, overdue: int):
+    SCHEDULER_JOBS_RUNNING.set(running)
+    SCHEDULER_JOBS_OVERDUE.set(overdue)
+
+
+async def _probe_loop_lag(interval: float):
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(0.0, time.perf_counter() - expected))
+
+
+_loop_lag_task: Optional[asyncio.Task] = None
+
+
+def start_loop_lag_monitor(interval: float = LOOP_LAG_INTERVAL):
+    global _loop_lag_task
+    if _loop_lag_task is None:
+        _loop_lag_task = asyncio.create_task(_probe_loop_lag(interval))
+
+
+async def stop_loop_lag_monitor():
+    global _loop_lag_task
+    task, _loop_lag_task = _loop_lag_task, None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def metrics_response() -> Response:
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
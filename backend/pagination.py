@@ -0,0 +1,46 @@
+"""
+Keyset (cursor) pagination helpers.
+
+A page ends with an opaque cursor holding the sort key of its last document.
+The next page is queried with `after(fields, values)`, so every page is an
+index range scan, however deep into the list it starts. Offset pagination
+would have to skip over all the earlier documents instead. The sort key must
+be unique, so it normally ends with the document id.
+"""
+
+import base64
+import json
+from datetime import datetime
+from typing import List, Sequence
+
+
+def encode_cursor(values: Sequence) -> str:
+    payload = [{"$dt": value.isoformat()} if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> List:
+    """The sort key stored in `cursor`; raises ValueError for anything `encode_cursor` did not produce."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(payload, list):
+            raise ValueError("cursor is not a list")
+        return [
+            datetime.fromisoformat(value["$dt"]) if isinstance(value, dict) and "$dt" in value else value
+            for value in payload
+        ]
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def after(fields: Sequence[str], values: Sequence, descending: bool = False) -> dict:
+    """Filter for the documents strictly after `values` in `fields` order (ascending, or descending on every field)."""
+    if len(fields) != len(values):
+        raise ValueError("Invalid cursor")
+    operator = "$lt" if descending else "$gt"
+    clauses = []
+    for position, field in enumerate(fields):
+        clause = dict(zip(fields[:position], values[:position]))
+        clause[field] = {operator: values[position]}
+        clauses.append(clause)
+    return {"$or": clauses}
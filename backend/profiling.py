@@ -0,0 +1,258 @@
+"""
+On-demand per-request profiling.
+
+Admins switch profiling on through /api/admin/profiling. A request is then
+profiled when either:
+
+- it carries `X-Profile-Token` matching the configured token (so a tenant can
+  reproduce a slow call on request), or
+- it hits a route whose template has a sample rate, and wins the draw.
+
+A profiled request records:
+
+- wall-clock time;
+- on-loop CPU time, i.e. thread CPU time spent in the request's own task
+  steps (work done in sub-tasks, e.g. a streamed body, is not included);
+- awaited time broken down into MongoDB commands, upstream calls, upstream
+  queueing and password hashing.
+
+These are attributed through a context variable, which Motor's executor and
+child tasks inherit. Concurrent awaits (gather) are summed, so a breakdown
+can exceed the wall time. Optionally cProfile function stats are captured,
+one request at a time. They cover everything the event loop ran while that
+request was in flight.
+
+Profiles are stored in `request_profiles` and expire through a TTL index
+(see indexes.py). The config is cached per process for
+PROFILING_CONFIG_REFRESH seconds, so a change reaches every worker within
+that time.
+"""
+
+import contextvars
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, Optional
+
+from pymongo import monitoring
+from starlette.routing import Match
+
+logger = logging.getLogger(__name__)
+
+PROFILING_CONFIG_REFRESH = float(os.environ.get('PROFILING_CONFIG_REFRESH', '5'))  # seconds a worker caches the config
+PROFILE_TOP_FUNCTIONS = 30
+PROFILE_TOKEN_HEADER = "x-profile-token"
+
+_current: contextvars.ContextVar[Optional["RequestProfile"]] = contextvars.ContextVar("request_profile", default=None)
+_cprofile_lock = threading.Lock()
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, route: str, trigger: str):
+        self.id = str(uuid.uuid4())
+        self.method = method
+        self.path = path
+        self.route = route
+        self.trigger = trigger
+        self.started_at = datetime.utcnow()
+        self.cpu = 0.0
+        self.waits: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()  # Mongo listeners report from Motor's executor threads
+
+    def add(self, kind: str, duration: float):
+        with self._lock:
+            self.waits[kind] = self.waits.get(kind, 0.0) + duration
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+
+def record_wait(kind: str, duration: float):
+    """Attribute awaited time to the request being profiled, if any."""
+    profile = _current.get()
+    if profile is not None:
+        profile.add(kind, duration)
+
+
+class MongoCommandProfiler(monitoring.CommandListener):
+    """pymongo command listener attributing command time to the profiled request."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record_wait("mongodb", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record_wait("mongodb", event.duration_micros / 1e6)
+
+
+class _CPUTimed:
+    """Drive a coroutine step by step, adding the thread CPU time of each step to the profile."""
+
+    def __init__(self, coroutine, profile: RequestProfile):
+        self.coroutine = coroutine
+        self.profile = profile
+
+    def __await__(self):
+        coroutine = self.coroutine
+        value, error = None, None
+        while True:
+            started = time.thread_time()
+            try:
+                if error is not None:
+                    signal = coroutine.throw(error)
+                else:
+                    signal = coroutine.send(value)
+            except StopIteration as stop:
+                self.profile.cpu += time.thread_time() - started
+                return stop.value
+            except BaseException:
+                self.profile.cpu += time.thread_time() - started
+                raise
+            self.profile.cpu += time.thread_time() - started
+            try:
+                value, error = (yield signal), None
+            except BaseException as e:
+                value, error = None, e
+
+
+class RequestProfiler:
+    """Holds the profiling switch (`config_collection`) and stores profiles (`profiles_collection`)."""
+
+    def __init__(self, config_collection, profiles_collection):
+        self.config_collection = config_collection
+        self.profiles_collection = profiles_collection
+        self._config: dict = {}
+        self._loaded_at = float("-inf")
+
+    async def config(self) -> dict:
+        now = time.monotonic()
+        if now - self._loaded_at > PROFILING_CONFIG_REFRESH:
+            self._loaded_at = now
+            try:
+                self._config = await self.config_collection.find_one({"_id": "profiling"}, {"_id": 0}) or {}
+            except Exception:
+                logger.exception("Could not load the profiling config")
+        return self._config
+
+    async def set_config(self, config: dict) -> dict:
+        await self.config_collection.replace_one({"_id": "profiling"}, config, upsert=True)
+        self._config, self._loaded_at = config, time.monotonic()
+        return config
+
+    def select(self, scope, app, config: dict) -> Optional[RequestProfile]:
+        """Decide whether to profile this request; returns its profile if so."""
+        if not config.get("enabled"):
+            return None
+        expires_at = config.get("expires_at")
+        if expires_at and datetime.utcnow() >= expires_at:
+            return None
+
+        route = _route_template(scope, app)
+        trigger = None
+        token = config.get("header_token")
+        if token:
+            for name, value in scope["headers"]:
+                if name == PROFILE_TOKEN_HEADER.encode() and hmac.compare_digest(value, token.encode()):
+                    trigger = "header"
+                    break
+        if trigger is None:
+            rate = config.get("routes", {}).get(route, 0.0)
+            if rate > 0 and random.random() < rate:
+                trigger = "sample"
+        if trigger is None:
+            return None
+        return RequestProfile(scope["method"], scope["path"], route, trigger)
+
+    async def save(self, profile: RequestProfile, status_code: int, wall: float, stats: Optional[str]):
+        waits = {kind: round(duration * 1000, 2) for kind, duration in profile.waits.items()}
+        document = {
+            "id": profile.id,
+            "method": profile.method,
+            "path": profile.path,
+            "route": profile.route,
+            "status": status_code,
+            "trigger": profile.trigger,
+            "created_at": profile.started_at,
+            "wall_ms": round(wall * 1000, 2),
+            "cpu_ms": round(profile.cpu * 1000, 2),
+            "wait_ms": waits,
+            "wait_counts": profile.counts,
+            # Wall time not accounted for by on-loop CPU or the recorded awaits: other requests, thread pools, the network to the client
+            "unaccounted_ms": round(max(0.0, wall - profile.cpu - sum(profile.waits.values())) * 1000, 2),
+            "cprofile": stats,
+        }
+        try:
+            await self.profiles_collection.insert_one(document)
+        except Exception:
+            logger.exception("Could not store request profile %s", profile.id)
+
+
+def _route_template(scope, app) -> str:
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", scope["path"])
+    return scope["path"]
+
+
+def _cprofile_stats(profiler: cProfile.Profile) -> str:
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    return output.getvalue()
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling the requests `RequestProfiler.select` picks."""
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        config = await self.profiler.config()
+        profile = self.profiler.select(scope, scope["app"], config) if config else None
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        function_profiler = None
+        if config.get("cprofile") and _cprofile_lock.acquire(blocking=False):
+            function_profiler = cProfile.Profile()
+            try:
+                function_profiler.enable()
+            except ValueError:  # another profiler is active in this thread
+                function_profiler = None
+                _cprofile_lock.release()
+
+        token = _current.set(profile)
+        started = time.perf_counter()
+        try:
+            await _CPUTimed(self.app(scope, receive, send_wrapper), profile)
+        finally:
+            wall = time.perf_counter() - started
+            _current.reset(token)
+            stats = None
+            if function_profiler is not None:
+                function_profiler.disable()
+                _cprofile_lock.release()
+                stats = _cprofile_stats(function_profiler)
+            await self.profiler.save(profile, status_code, wall, stats)
@@ -0,0 +1,46 @@
+"""
+Fast JSON serialisation for large responses.
+
+FastAPI's default path validates a route's return value against its
+response_model, converts it to plain Python with `jsonable_encoder` and then
+encodes that with the stdlib `json` module. For a list of thousands of orders
+most of the request's CPU goes there.
+
+`dumps` encodes in one native pass instead: with orjson when it is installed,
+otherwise with pydantic-core's serializer (always available with Pydantic v2).
+Both handle dicts, lists, datetimes and Pydantic models. Routes opt in by
+returning a `FastJSONResponse`, which FastAPI sends as is.
+"""
+
+from typing import Any
+
+import pydantic_core
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:  # optional; pydantic-core is nearly as fast
+    orjson = None
+
+
+def _default(value: Any):
+    # Types orjson does not know natively (Pydantic models, sets, ...)
+    return pydantic_core.to_jsonable_python(value)
+
+
+def dumps(content: Any) -> bytes:
+    """Compact UTF-8 JSON for `content`."""
+    if orjson is not None:
+        return orjson.dumps(content, default=_default)
+    return pydantic_core.to_json(content)
+
+
+def json_backend() -> str:
+    return "orjson" if orjson is not None else "pydantic-core"
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,243 @@
+"""
+In-process scheduler for periodic per-tenant background jobs.
+
+Every active, unexpired user with stored settings is a tenant. Each registered
+`Job` runs once per `interval` for every tenant it `applies` to: order sync,
+shipment status sync and connection health checks (see server.py).
+
+- Concurrency is bounded globally: at most SCHEDULER_CONCURRENCY jobs run at
+  once, across all tenants.
+- Tenants are served in turn. A tenant runs one job at a time, and when a slot
+  frees up the next tenant in the rotation with a due job gets it. A store
+  with a long sync therefore holds one slot, never all of them, and waits for
+  its next turn behind everyone else. A job that runs past
+  SCHEDULER_JOB_TIMEOUT is cancelled; the syncs resume where they stopped.
+- Start times are jittered. A new tenant's first run is spread over one
+  interval, and each later run is due `interval` ± SCHEDULER_JITTER after the
+  previous one started, so jobs do not line up after a restart.
+
+The tenant list is reloaded every SCHEDULER_TENANT_REFRESH seconds, which is
+how deactivated and expired users (and changed credentials) are picked up.
+Lag (how late a job started) and runtime are kept per job for
+/api/admin/scheduler and recorded in the Prometheus metrics.
+
+The scheduler runs in every process that starts it. With several uvicorn
+workers, set SCHEDULER_ENABLED=false on all but one.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from metrics import observe_scheduler_job, set_scheduler_backlog
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SCHEDULER_CONCURRENCY = int(os.environ.get('SCHEDULER_CONCURRENCY', '8'))  # jobs running at once, all tenants together
+SCHEDULER_JITTER = float(os.environ.get('SCHEDULER_JITTER', '0.1'))  # fraction of the interval added or taken off each run
+SCHEDULER_JOB_TIMEOUT = float(os.environ.get('SCHEDULER_JOB_TIMEOUT', '300'))
+SCHEDULER_TENANT_REFRESH = float(os.environ.get('SCHEDULER_TENANT_REFRESH', '60'))  # seconds between tenant list reloads
+SCHEDULER_IDLE_WAIT = 5.0  # longest sleep when nothing is due
+
+TenantLoader = Callable[[], Awaitable[Dict[str, dict]]]
+
+
+class Job:
+    def __init__(
+        self,
+        name: str,
+        interval: float,
+        run: Callable[[str, dict], Awaitable[object]],
+        applies: Optional[Callable[[dict], bool]] = None,
+    ):
+        self.name = name
+        self.interval = interval
+        self.run = run
+        self.applies = applies or (lambda settings: True)
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_runtime = 0.0
+        self.total_runtime = 0.0
+
+    def record(self, outcome: str, lag: float, runtime: float):
+        self.runs += 1
+        if outcome == "failure":
+            self.failures += 1
+        elif outcome == "timeout":
+            self.timeouts += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.last_runtime = runtime
+        self.total_runtime += runtime
+        observe_scheduler_job(self.name, outcome, lag, runtime)
+
+    def snapshot(self) -> dict:
+        return {
+            "interval": self.interval,
+            "runs": self.runs,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "last_lag": round(self.last_lag, 3),
+            "max_lag": round(self.max_lag, 3),
+            "last_runtime": round(self.last_runtime, 3),
+            "average_runtime": round(self.total_runtime / self.runs, 3) if self.runs else None,
+        }
+
+
+class Scheduler:
+    def __init__(
+        self,
+        load_tenants: TenantLoader,
+        concurrency: int = SCHEDULER_CONCURRENCY,
+        jitter: float = SCHEDULER_JITTER,
+        job_timeout: float = SCHEDULER_JOB_TIMEOUT,
+        tenant_refresh: float = SCHEDULER_TENANT_REFRESH,
+    ):
+        """`load_tenants` returns the settings of every tenant to schedule, by tenant id."""
+        self.load_tenants = load_tenants
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.job_timeout = job_timeout
+        self.tenant_refresh = tenant_refresh
+        self.jobs: Dict[str, Job] = {}
+        self._settings: Dict[str, dict] = {}
+        self._due: Dict[Tuple[str, str], float] = {}  # (tenant, job) -> monotonic time the next run is due
+        self._turns: Deque[str] = deque()  # round-robin order of tenants
+        self._running: Dict[str, Tuple[str, float]] = {}  # tenant -> (job, started)
+        self._tasks: set = set()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def add_job(self, job: Job):
+        self.jobs[job.name] = job
+
+    def _next_due(self, interval: float, started: float) -> float:
+        return started + interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def refresh_tenants(self):
+        tenants = await self.load_tenants()
+        now = time.monotonic()
+        for tenant in list(self._settings):
+            if tenant not in tenants:
+                del self._settings[tenant]
+        self._settings.update(tenants)
+        self._turns = deque(tenant for tenant in self._turns if tenant in tenants)
+        known = set(self._turns)
+        self._turns.extend(tenant for tenant in tenants if tenant not in known)
+
+        due = {}
+        for tenant, settings in tenants.items():
+            for job in self.jobs.values():
+                if not job.applies(settings):
+                    continue
+                key = (tenant, job.name)
+                # A tenant seen for the first time gets its first run somewhere within one interval
+                due[key] = self._due.get(key, now + random.uniform(0, job.interval))
+        self._due = due
+
+    def _pick(self, now: float) -> Optional[Tuple[str, Job, float]]:
+        """The most overdue job of the next tenant in turn that has one and is not already running a job."""
+        for _ in range(len(self._turns)):
+            tenant = self._turns[0]
+            self._turns.rotate(-1)
+            if tenant in self._running:
+                continue
+            overdue = [
+                (self._due[(tenant, name)], job)
+                for name, job in self.jobs.items()
+                if self._due.get((tenant, name), now + 1) <= now
+            ]
+            if overdue:
+                due, job = min(overdue, key=lambda item: item[0])
+                return tenant, job, due
+        return None
+
+    def _next_wakeup(self, now: float) -> float:
+        waiting = [due for (tenant, _), due in self._due.items() if tenant not in self._running]
+        return min(min(waiting, default=now + SCHEDULER_IDLE_WAIT), now + SCHEDULER_IDLE_WAIT)
+
+    async def _execute(self, tenant: str, job: Job, due: float, started: float, settings: dict):
+        outcome = "success"
+        try:
+            await asyncio.wait_for(job.run(tenant, settings), timeout=self.job_timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            logger.warning("Scheduled %s for user %s timed out after %.0fs", job.name, tenant, self.job_timeout)
+        except Exception:
+            outcome = "failure"
+            logger.exception("Scheduled %s failed for user %s", job.name, tenant)
+        finally:
+            del self._running[tenant]
+            self._slots.release()
+            self._wakeup.set()
+        job.record(outcome, max(0.0, started - due), time.monotonic() - started)
+
+    async def _run(self):
+        next_refresh = 0.0
+        while True:
+            now = time.monotonic()
+            if now >= next_refresh:
+                try:
+                    await self.refresh_tenants()
+                except Exception:
+                    logger.exception("Could not load scheduler tenants")
+                next_refresh = now + self.tenant_refresh
+
+            await self._slots.acquire()
+            now = time.monotonic()
+            picked = self._pick(now)
+            set_scheduler_backlog(len(self._running), sum(due <= now for due in self._due.values()))
+            if picked is None:
+                self._slots.release()
+                self._wakeup.clear()
+                timeout = min(self._next_wakeup(now), next_refresh) - now
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0.01))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            tenant, job, due = picked
+            # Claimed before the task starts, so the next pick skips this tenant
+            started = time.monotonic()
+            self._running[tenant] = (job.name, started)
+            # Due again one interval after this run started, however long it takes
+            self._due[(tenant, job.name)] = self._next_due(job.interval, started)
+            task = asyncio.create_task(self._execute(tenant, job, due, started, self._settings[tenant]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop scheduling and cancel the jobs still running."""
+        tasks = [task for task in (self._task, *self._tasks) if task is not None]
+        self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            "running": self._task is not None,
+            "concurrency": self.concurrency,
+            "tenants": len(self._settings),
+            "overdue": sum(due <= now for due in self._due.values()),
+            "jobs": {name: job.snapshot() for name, job in self.jobs.items()},
+            "active": [
+                {"user_id": tenant, "job": name, "running_for": round(now - started, 3)}
+                for tenant, (name, started) in self._running.items()
+            ],
+        }
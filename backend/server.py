@@ -1,26 +1,55 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import hashlib
+import json
 import logging
+import re
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 import uuid
-from datetime import datetime, timedelta
+import secrets
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import jwt
 from passlib.context import CryptContext
 import httpx
 import asyncio
 
+from compression import CompressionMiddleware
+from etags import VersionCounter, etag_for, etag_matches, not_modified, set_etag
+from events import EventHub
+from exports import csv_chunks, file_chunks, xlsx_available, xlsx_file
+from indexes import ensure_indexes
+from job_queue import FailJob, JobQueue, RetryJob
+from metrics import MetricsMiddleware, MongoCommandMetrics, metrics_response, start_loop_lag_monitor, stop_loop_lag_monitor
+from pagination import after, decode_cursor, encode_cursor
+from profiling import MongoCommandProfiler, ProfilingMiddleware, RequestProfiler, record_wait
+from responses import FastJSONResponse, dumps
+from scheduler import SCHEDULER_ENABLED, Job, Scheduler
+from tracking import TrackingNumberAllocator
+from transforms import shopify_order_records, zrexpress_colis_records
+from upstream import NOT_SENT_ERRORS, ZREXPRESS_BASE_URL, UpstreamUnavailable, circuit_breaker_states, close_clients, open_clients, shopify_limiter_states, upstream_request
+from webhooks import SHOPIFY_ORDER_TOPICS, BufferedWriter, RecentIds, SecretCache, verify_shopify_hmac
+from wilayas import get_wilaya_resolver
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics(), MongoCommandProfiler()])
 db = client[os.environ['DB_NAME']]
 
 # Security
@@ -29,6 +58,9 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt releases the GIL, so a small thread pool keeps hashing off the event loop
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '4'))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
 security = HTTPBearer()
 
 # Create the main app without a prefix
@@ -78,12 +110,20 @@ class AdminPasswordChange(BaseModel):
     current_password: str
     new_password: str
 
+class ProfilingConfig(BaseModel):
+    enabled: bool = False
+    routes: Dict[str, float] = {}  # route template -> fraction of requests to profile
+    header: bool = False  # issue a token that profiles any request sending it as X-Profile-Token
+    cprofile: bool = False  # also capture function-level stats
+    duration_minutes: Optional[int] = Field(60, ge=1)  # switch off automatically after this long; None keeps it on
+
 class UserSettings(BaseModel):
     user_id: str
     shopify_url: Optional[str] = None
     shopify_token: Optional[str] = None
     zrexpress_token: Optional[str] = None
     zrexpress_key: Optional[str] = None
+    shopify_webhook_secret: Optional[str] = None  # signs order webhooks; see /webhooks/shopify/{user_id}
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class UserSettingsUpdate(BaseModel):
@@ -91,6 +131,7 @@ class UserSettingsUpdate(BaseModel):
     shopify_token: Optional[str] = None
     zrexpress_token: Optional[str] = None
     zrexpress_key: Optional[str] = None
+    shopify_webhook_secret: Optional[str] = None
 
 class ShopifyOrder(BaseModel):
     id: str
@@ -100,6 +141,9 @@ class ShopifyOrder(BaseModel):
     customer_email: Optional[str] = None
     shipping_address: str
     city: str
+    id_wilaya: Optional[str] = None  # resolved from city/province, see wilayas.py
+    commune: Optional[str] = None
+    location_confidence: float = 0.0
     total_price: str
     status: str
     created_at: str
@@ -131,9 +175,29 @@ class EditableOrder(BaseModel):
     total_price: str
     status: str
     tracking: Optional[str] = None
-    id_wilaya: str = "31"  # Default Algiers
+    id_wilaya: Optional[str] = None  # resolved from city when missing
+    # Of an id_wilaya resolved by wilayas.py (ShopifyOrder.location_confidence); None when entered by hand
+    location_confidence: Optional[float] = None
     items: List[dict] = []
 
+class ZRExpressOrderResult(BaseModel):
+    shopify_id: str
+    tracking: Optional[str] = None
+    status: str  # "accepted", "rejected" (by ZRExpress or validation) or "error" (not delivered upstream)
+    message: str = ""
+    # An error after which ZRExpress may still have created the parcel; its ledger row is kept until verified
+    uncertain: bool = Field(False, exclude=True)
+
+class Shipment(BaseModel):
+    tracking: str
+    id_externe: str
+    status: Optional[str] = None  # ZRExpress "Situation", as written by the courier
+    state: str = "pending"  # "pending", "in_transit", "delivered", "returned" or "cancelled"
+    final: bool = False  # delivered, returned or cancelled: no longer synced
+    created_at: datetime
+    checked_at: datetime
+    status_changed_at: Optional[datetime] = None
+
 # Utility functions
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -141,6 +205,22 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def verify_password_async(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(password_executor, verify_password, plain_password, hashed_password)
+    finally:
+        record_wait("password_hash", time.perf_counter() - started)
+
+async def get_password_hash_async(password):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(password_executor, get_password_hash, password)
+    finally:
+        record_wait("password_hash", time.perf_counter() - started)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -151,24 +231,118 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+class AuthCache:
+    """
+    In-process TTL/LRU cache of verified bearer tokens to their user record.
+    
+    Entries never outlive the token's own `exp`. Writes to a user must call
+    `invalidate_user` (this process) and bump `version` (every process).
+    `check_version` reads the counter at most once per `version_check_interval`
+    and empties the cache when another worker changed a user, so a deactivation
+    reaches all workers within that interval (0 checks on every request).
+    """
+    
+    def __init__(
+        self,
+        ttl: float,
+        max_size: int,
+        version: Optional[VersionCounter] = None,
+        version_check_interval: float = 1.0
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.version = version
+        self.version_check_interval = version_check_interval
+        self._entries: OrderedDict = OrderedDict()
+        # Bumped on every invalidation so a lookup that raced with a write is not cached
+        self.generation = 0
+        self._seen_version: Optional[str] = None
+        self._version_checked_at = float("-inf")
+    
+    async def check_version(self):
+        if self.version is None or time.monotonic() - self._version_checked_at < self.version_check_interval:
+            return
+        # Set before awaiting, so concurrent requests do not all read the counter
+        self._version_checked_at = time.monotonic()
+        current = await self.version.current()
+        if current != self._seen_version:
+            if self._seen_version is not None:
+                self.clear()
+            self._seen_version = current
+    
+    def get(self, token: str) -> Optional[dict]:
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        user, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[token]
+            return None
+        self._entries.move_to_end(token)
+        return user
+    
+    def set(self, token: str, user: dict, token_exp: Optional[float] = None, generation: Optional[int] = None):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        ttl = self.ttl
+        if token_exp is not None:
+            ttl = min(ttl, token_exp - time.time())
+        if ttl <= 0:
+            return
+        self._entries[token] = (user, time.monotonic() + ttl)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def invalidate_user(self, user_id: str):
+        self.generation += 1
+        stale = [token for token, (user, _) in self._entries.items() if user.get("id") == user_id]
+        for token in stale:
+            del self._entries[token]
+    
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+# Bumped on every write to a user; the ETag of GET /users, and how other workers learn to drop cached users
+users_version = VersionCounter(db.counters, "users_version")
+
+auth_cache = AuthCache(
+    ttl=float(os.environ.get('AUTH_CACHE_TTL', '30')),
+    max_size=int(os.environ.get('AUTH_CACHE_SIZE', '10000')),
+    version=users_version,
+    # Longest time a user written on another worker may still be served from this one's cache
+    version_check_interval=float(os.environ.get('AUTH_CACHE_VERSION_CHECK_INTERVAL', '1'))
+)
+
+async def authenticate_token(token: str) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except jwt.PyJWTError:
-        raise credentials_exception
-    
-    user = await db.users.find_one({"username": username})
+    await auth_cache.check_version()
+    user = auth_cache.get(token)
     if user is None:
-        raise credentials_exception
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+        except jwt.PyJWTError:
+            raise credentials_exception
+        
+        generation = auth_cache.generation
+        user = await db.users.find_one({"username": username})
+        if user is None:
+            raise credentials_exception
+        auth_cache.set(token, user, payload.get("exp"), generation)
     
+    return active_user(user)
+
+def active_user(user: dict) -> User:
     # Check if user is active
     if not user.get("is_active", True):
         raise HTTPException(
@@ -189,6 +363,29 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     
     return User(**user)
 
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await authenticate_token(credentials.credentials)
+
+# EventSource cannot send an Authorization header, and a token in the URL ends up in access and proxy logs.
+# The dashboard trades its token for a ticket (POST /events/ticket) that opens one stream within STREAM_TICKET_TTL.
+STREAM_TICKET_TTL = int(os.environ.get('STREAM_TICKET_TTL', '30'))  # seconds
+
+def stream_ticket_id(ticket: str) -> str:
+    # Only the hash is stored, so a database read does not yield usable tickets
+    return hashlib.sha256(ticket.encode()).hexdigest()
+
+async def get_stream_user(ticket: Optional[str] = Query(None, description="Single-use ticket from POST /events/ticket")):
+    if not ticket:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+    issued = await db.stream_tickets.find_one_and_delete({
+        "_id": stream_ticket_id(ticket),
+        "expires_at": {"$gt": datetime.utcnow()}
+    })
+    user = await db.users.find_one({"id": issued["user_id"]}) if issued else None
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired stream ticket")
+    return active_user(user)
+
 async def get_current_admin_user(current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(
@@ -203,7 +400,7 @@ async def init_admin():
     if not admin_exists:
         admin_user = User(
             username="A7JMILO",
-            password=get_password_hash("436b0bc9005add01239a43435d502d197a647de839285829215bdd04a21de/RAOUF@20006"),
+            password=await get_password_hash_async("436b0bc9005add01239a43435d502d197a647de839285829215bdd04a21de/RAOUF@20006"),
             role="admin"
         )
         await db.users.insert_one(admin_user.dict())
@@ -212,7 +409,7 @@ async def init_admin():
         # Update admin password if it exists
         await db.users.update_one(
             {"username": "A7JMILO"},
-            {"$set": {"password": get_password_hash("436b0bc9005add01239a43435d502d197a647de839285829215bdd04a21de/RAOUF@20006")}}
+            {"$set": {"password": await get_password_hash_async("436b0bc9005add01239a43435d502d197a647de839285829215bdd04a21de/RAOUF@20006")}}
         )
         logging.info("Admin password updated successfully")
 
@@ -220,7 +417,7 @@ async def init_admin():
 @api_router.post("/auth/login", response_model=Token)
 async def login(user_credentials: LoginRequest):
     user = await db.users.find_one({"username": user_credentials.username})
-    if not user or not verify_password(user_credentials.password, user["password"]):
+    if not user or not await verify_password_async(user_credentials.password, user["password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -258,6 +455,21 @@ async def login(user_credentials: LoginRequest):
     }
 
 # Enhanced User Management Routes
+USERS_PAGE_SIZE = int(os.environ.get('USERS_PAGE_SIZE', '100'))
+USERS_MAX_PAGE_SIZE = 500
+USERS_SORT = ["created_at", "id"]  # keyset; matches the role_created_at_id index
+USER_RESPONSE_PROJECTION = {"_id": 0, **{field: 1 for field in UserResponse.model_fields}}
+
+def user_status_filter(user_status: Optional[str], now: datetime) -> dict:
+    # Same rules as the status badges in the admin panel
+    if user_status == "inactive":
+        return {"is_active": False}
+    if user_status == "expired":
+        return {"expiry_date": {"$lte": now}}
+    if user_status == "active":
+        return {"is_active": True, "$or": [{"expiry_date": None}, {"expiry_date": {"$gt": now}}]}
+    return {}
+
 @api_router.post("/users", response_model=UserResponse)
 async def create_user(user_data: UserCreate, current_admin: User = Depends(get_current_admin_user)):
     # Check if user already exists
@@ -270,18 +482,81 @@ async def create_user(user_data: UserCreate, current_admin: User = Depends(get_c
     
     new_user = User(
         username=user_data.username,
-        password=get_password_hash(user_data.password),
+        password=await get_password_hash_async(user_data.password),
         expiry_date=user_data.expiry_date,
         created_by=current_admin.id
     )
     
-    await db.users.insert_one(new_user.dict())
+    try:
+        await db.users.insert_one(new_user.dict())
+    except DuplicateKeyError:
+        # Lost a race with a concurrent create for the same username
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username already registered"
+        )
+    await users_version.bump()
     return UserResponse(**new_user.dict())
 
-@api_router.get("/users", response_model=List[UserResponse])
-async def get_users(current_admin: User = Depends(get_current_admin_user)):
-    users = await db.users.find({"role": "user"}).to_list(1000)
-    return [UserResponse(**user) for user in users]
+@api_router.get("/users", response_model=List[UserResponse], response_class=FastJSONResponse)
+async def get_users(
+    limit: int = Query(USERS_PAGE_SIZE, ge=1, le=USERS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    q: Optional[str] = Query(None, description="Username prefix"),
+    user_status: Optional[str] = Query(None, alias="status", pattern="^(active|expired|inactive)$"),
+    if_none_match: Optional[str] = Header(None),
+    current_admin: User = Depends(get_current_admin_user)
+):
+    """
+    Users in creation order, one page at a time. When there are more, the
+    response carries an X-Next-Cursor header to pass back as `cursor`.
+    """
+    query = {"role": "user", **user_status_filter(user_status, datetime.utcnow())}
+    if q:
+        # Anchored and case-sensitive, so the prefix can use the username index
+        query["username"] = {"$regex": "^" + re.escape(q)}
+    if cursor:
+        try:
+            position = after(USERS_SORT, decode_cursor(cursor))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = {"$and": [query, position]}
+    
+    # Read the version before the users, so a concurrent write can only make the ETag older than the body.
+    # Active/expired membership changes as time passes, without any write, so those pages get no ETag.
+    etag = None
+    if user_status not in ("active", "expired"):
+        etag = etag_for("users", await users_version.current(), limit, cursor, q, user_status)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    
+    users = await db.users.find(query, USER_RESPONSE_PROJECTION).sort(
+        [(field, 1) for field in USERS_SORT]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    response = FastJSONResponse([UserResponse(**user) for user in users[:limit]])
+    if len(users) > limit:
+        last = users[limit - 1]
+        response.headers["X-Next-Cursor"] = encode_cursor([last[field] for field in USERS_SORT])
+    if etag:
+        set_etag(response, etag)
+    return response
+
+@api_router.get("/users/counts")
+async def get_user_counts(
+    q: Optional[str] = Query(None, description="Username prefix"),
+    current_admin: User = Depends(get_current_admin_user)
+):
+    """Number of users in each status, for the stats cards above the paged user list."""
+    query = {"role": "user"}
+    if q:
+        query["username"] = {"$regex": "^" + re.escape(q)}
+    now = datetime.utcnow()
+    total, active, expired, inactive = await asyncio.gather(*(
+        db.users.count_documents({**query, **user_status_filter(user_status, now)})
+        for user_status in (None, "active", "expired", "inactive")
+    ))
+    return {"total": total, "active": active, "expired": expired, "inactive": inactive}
 
 @api_router.put("/users/{user_id}", response_model=UserResponse)
 async def update_user(user_id: str, user_update: UserUpdate, current_admin: User = Depends(get_current_admin_user)):
@@ -297,6 +572,8 @@ async def update_user(user_id: str, user_update: UserUpdate, current_admin: User
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    auth_cache.invalidate_user(user_id)
+    await users_version.bump()
     
     updated_user = await db.users.find_one({"id": user_id})
     return UserResponse(**updated_user)
@@ -306,39 +583,63 @@ async def delete_user(user_id: str, current_admin: User = Depends(get_current_ad
     result = await db.users.delete_one({"id": user_id, "role": "user"})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    auth_cache.invalidate_user(user_id)
+    await users_version.bump()
     
-    # Also delete user settings
+    # Also delete user settings and mirrored orders
     await db.user_settings.delete_one({"user_id": user_id})
+    webhook_secrets.invalidate(user_id)
+    await reset_shopify_mirror(user_id)
     return {"message": "User deleted successfully"}
 
 @api_router.post("/admin/change-password")
 async def change_admin_password(password_data: AdminPasswordChange, current_admin: User = Depends(get_current_admin_user)):
     # Verify current password
     admin_user = await db.users.find_one({"id": current_admin.id})
-    if not verify_password(password_data.current_password, admin_user["password"]):
+    if not await verify_password_async(password_data.current_password, admin_user["password"]):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Current password is incorrect"
         )
     
     # Update password
-    new_password_hash = get_password_hash(password_data.new_password)
+    new_password_hash = await get_password_hash_async(password_data.new_password)
     await db.users.update_one(
         {"id": current_admin.id},
         {"$set": {"password": new_password_hash}}
     )
+    auth_cache.invalidate_user(current_admin.id)
     
     return {"message": "Password changed successfully"}
 
 # Settings Routes (unchanged)
+def settings_etag(settings: dict) -> str:
+    # Every write to the settings sets updated_at. MongoDB keeps milliseconds, so a
+    # just-created document hashes the same as when it is read back.
+    updated_at = settings.get("updated_at")
+    if updated_at is not None:
+        updated_at = updated_at.replace(microsecond=updated_at.microsecond // 1000 * 1000)
+    return etag_for("settings", settings["user_id"], updated_at)
+
 @api_router.get("/settings", response_model=UserSettings)
-async def get_user_settings(current_user: User = Depends(get_current_user)):
+async def get_user_settings(
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user)
+):
     settings = await db.user_settings.find_one({"user_id": current_user.id})
     if not settings:
         # Create default settings
-        default_settings = UserSettings(user_id=current_user.id)
-        await db.user_settings.insert_one(default_settings.dict())
-        return default_settings
+        settings = UserSettings(user_id=current_user.id).dict()
+        try:
+            await db.user_settings.insert_one(dict(settings))
+        except DuplicateKeyError:
+            settings = await db.user_settings.find_one({"user_id": current_user.id})
+    
+    etag = settings_etag(settings)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
     return UserSettings(**settings)
 
 @api_router.put("/settings", response_model=UserSettings)
@@ -349,173 +650,1483 @@ async def update_user_settings(
     update_data = settings_data.dict(exclude_unset=True)
     update_data["updated_at"] = datetime.utcnow()
     
+    previous = await db.user_settings.find_one({"user_id": current_user.id}) or {}
     await db.user_settings.update_one(
         {"user_id": current_user.id},
         {"$set": update_data},
         upsert=True
     )
+    webhook_secrets.invalidate(current_user.id)
+    
+    # After the update, so a sync started from here on already uses the new store
+    if "shopify_url" in update_data and previous.get("shopify_url") != update_data["shopify_url"]:
+        # The mirror belongs to the old store; start over from a full sync
+        await reset_shopify_mirror(current_user.id)
+    elif "shopify_token" in update_data and previous.get("shopify_token") != update_data["shopify_token"]:
+        # New credentials may fix the failing syncs: retry without waiting out the backoff
+        await db.shopify_sync.update_one({"user_id": current_user.id}, {"$unset": SYNC_FAILURE_FIELDS})
     
     settings = await db.user_settings.find_one({"user_id": current_user.id})
     return UserSettings(**settings)
 
-@api_router.post("/settings/test")
-async def test_api_connections(current_user: User = Depends(get_current_user)):
-    settings = await db.user_settings.find_one({"user_id": current_user.id})
-    if not settings:
-        raise HTTPException(status_code=404, detail="Settings not found")
-    
+async def check_connections(settings: dict) -> dict:
+    """Whether the stored Shopify and ZRExpress credentials work; False for any not configured."""
     results = {"shopify": False, "zrexpress": False}
     
     # Test Shopify connection
     if settings.get("shopify_url") and settings.get("shopify_token"):
         try:
-            async with httpx.AsyncClient() as client:
-                headers = {"X-Shopify-Access-Token": settings["shopify_token"]}
-                url = f"https://{settings['shopify_url']}/admin/api/2023-10/orders.json?limit=1"
-                response = await client.get(url, headers=headers)
-                results["shopify"] = response.status_code == 200
+            url = shopify_api_url(settings, "orders.json")
+            response = await upstream_request("shopify", "GET", url, headers=shopify_headers(settings), params={"limit": 1})
+            results["shopify"] = response.status_code == 200
         except Exception:
             results["shopify"] = False
     
     # Test ZRExpress connection
     if settings.get("zrexpress_token") and settings.get("zrexpress_key"):
         try:
-            async with httpx.AsyncClient() as client:
-                headers = {
-                    "token": settings["zrexpress_token"],
-                    "key": settings["zrexpress_key"]
-                }
-                response = await client.get("https://procolis.com/api_v1/token", headers=headers)
-                results["zrexpress"] = response.status_code == 200
+            headers = {
+                "token": settings["zrexpress_token"],
+                "key": settings["zrexpress_key"]
+            }
+            response = await upstream_request("zrexpress", "GET", f"{ZREXPRESS_BASE_URL}/token", headers=headers)
+            results["zrexpress"] = response.status_code == 200
         except Exception:
             results["zrexpress"] = False
     
     return results
 
-# Shopify Routes (unchanged)
+@api_router.post("/settings/test")
+async def test_api_connections(current_user: User = Depends(get_current_user)):
+    settings = await db.user_settings.find_one({"user_id": current_user.id})
+    if not settings:
+        raise HTTPException(status_code=404, detail="Settings not found")
+    return await check_connections(settings)
+
+@api_router.get("/settings/health")
+async def get_connection_health(current_user: User = Depends(get_current_user)):
+    """The result of the last background connection check (see the scheduler section)."""
+    health = await db.connection_health.find_one({"user_id": current_user.id}, {"_id": 0, "user_id": 0})
+    if not health:
+        raise HTTPException(status_code=404, detail="Connections not checked yet")
+    return health
+
+# Shopify helpers
+SHOPIFY_API_VERSION = "2023-10"
+SHOPIFY_MAX_PAGE_SIZE = 250
+SHOPIFY_URL_SCHEME = os.environ.get('SHOPIFY_URL_SCHEME', 'https')  # "http" only for local stand-ins (benchmarks/)
+
+def shopify_headers(settings: dict) -> dict:
+    return {"X-Shopify-Access-Token": settings["shopify_token"]}
+
+def shopify_api_url(settings: dict, resource: str) -> str:
+    return f"{SHOPIFY_URL_SCHEME}://{settings['shopify_url']}/admin/api/{SHOPIFY_API_VERSION}/{resource}"
+
+async def iter_shopify_order_pages(
+    settings: dict,
+    params: Optional[dict] = None,
+    page_size: int = SHOPIFY_MAX_PAGE_SIZE
+) -> AsyncIterator[List[dict]]:
+    """Yield raw Shopify order pages, following the `Link: rel="next"` page_info cursor."""
+    headers = shopify_headers(settings)
+    url = shopify_api_url(settings, "orders.json")
+    query = {"status": "any", **(params or {}), "limit": page_size}
+    
+    while url:
+        try:
+            response = await upstream_request("shopify", "GET", url, headers=headers, params=query)
+        except UpstreamUnavailable as e:
+            raise HTTPException(
+                status_code=503,
+                detail="Shopify is not responding, try again shortly",
+                headers={"Retry-After": str(max(1, round(e.retry_after)))}
+            )
+        except httpx.TimeoutException:
+            raise HTTPException(status_code=504, detail="Shopify took too long to respond")
+        except httpx.RequestError:
+            raise HTTPException(status_code=500, detail="Error connecting to Shopify")
+        
+        if response.status_code in (502, 503, 504):
+            raise HTTPException(status_code=502, detail="Shopify is not responding, try again shortly")
+        if response.status_code != 200:
+            raise HTTPException(status_code=400, detail="Failed to fetch Shopify orders")
+        
+        yield response.json().get("orders", [])
+        
+        # The next-page URL already carries page_info and limit; Shopify rejects other filters with it
+        next_link = response.links.get("next")
+        url = next_link["url"] if next_link else None
+        query = None
+
+async def live_order_pages(settings: dict, page_size: int, params: Optional[dict] = None) -> AsyncIterator[List[dict]]:
+    async for page in iter_shopify_order_pages(settings, params=params, page_size=page_size):
+        yield shopify_order_records(page)
+
+async def stream_orders_response(pages: AsyncIterator[List[dict]], output_format: str) -> StreamingResponse:
+    """
+    Stream order pages to the client as they arrive.
+    
+    The first page is fetched before the response starts so credential and
+    connection errors still surface as regular HTTP errors.
+    """
+    first_page = await anext(pages, [])
+    
+    async def ndjson_body():
+        page = first_page
+        while True:
+            if page:
+                yield b"".join(dumps(order) + b"\n" for order in page)
+            try:
+                page = await pages.__anext__()
+            except StopAsyncIteration:
+                return
+            except HTTPException as e:
+                logger.warning("Order stream interrupted: %s", e.detail)
+                yield dumps({"error": e.detail}) + b"\n"
+                return
+    
+    async def json_array_body():
+        page = first_page
+        separator = b""
+        yield b"["
+        while True:
+            if page:
+                # One native encoding pass per page; drop the page's own brackets
+                yield separator + dumps(page)[1:-1]
+                separator = b","
+            try:
+                page = await pages.__anext__()
+            except StopAsyncIteration:
+                break
+            except HTTPException as e:
+                # Leave the array unterminated so the client cannot mistake it for a complete list
+                logger.warning("Order stream interrupted: %s", e.detail)
+                return
+        yield b"]"
+    
+    if output_format == "ndjson":
+        return StreamingResponse(ndjson_body(), media_type="application/x-ndjson")
+    return StreamingResponse(json_array_body(), media_type="application/json")
+
+# Shopify order mirror
+SHOPIFY_SYNC_INTERVAL = int(os.environ.get('SHOPIFY_SYNC_INTERVAL', '60'))  # seconds between automatic delta syncs
+# With webhooks set up, the delta sync only catches deliveries that were missed
+SHOPIFY_WEBHOOK_SYNC_INTERVAL = int(os.environ.get('SHOPIFY_WEBHOOK_SYNC_INTERVAL', '3600'))
+SHOPIFY_ORDER_PROJECTION = {"_id": 0, **{field: 1 for field in ShopifyOrder.model_fields}}
+# After a failed sync, automatic ones wait SHOPIFY_SYNC_RETRY_BACKOFF seconds, doubling per failure up to the max
+SHOPIFY_SYNC_RETRY_BACKOFF = int(os.environ.get('SHOPIFY_SYNC_RETRY_BACKOFF', '30'))
+SHOPIFY_SYNC_RETRY_MAX = int(os.environ.get('SHOPIFY_SYNC_RETRY_MAX', '900'))
+SYNC_FAILURE_FIELDS = {"last_error": "", "last_failed_at": "", "failed_syncs": ""}
+
+_shopify_sync_locks: dict = {}
+
+def parse_shopify_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """Parse a Shopify ISO 8601 timestamp into a naive UTC datetime (the format stored everywhere else)."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def shopify_mirror_documents(user_id: str, orders: List[dict]) -> List[dict]:
+    synced_at = datetime.utcnow()
+    documents = shopify_order_records(orders)
+    for document, order in zip(documents, orders):
+        document.update({
+            "user_id": user_id,
+            "created_at_ts": parse_shopify_timestamp(order.get("created_at")),
+            "updated_at": parse_shopify_timestamp(order.get("updated_at")),
+            "synced_at": synced_at,
+        })
+    return documents
+
+async def record_sync_failure(user_id: str, error: Exception):
+    if isinstance(error, HTTPException):
+        last_error = {"status_code": error.status_code, "detail": error.detail}
+    else:
+        last_error = {"status_code": 502, "detail": "Could not import orders from Shopify"}
+    await db.shopify_sync.update_one(
+        {"user_id": user_id},
+        {
+            "$set": {"last_error": last_error, "last_failed_at": datetime.utcnow()},
+            "$inc": {"failed_syncs": 1},
+            "$setOnInsert": {"mirror_id": str(uuid.uuid4())},
+        },
+        upsert=True
+    )
+
+def sync_retry_in(state: dict) -> float:
+    """Seconds before an automatic sync may run again after failed ones (0 when it may run now)."""
+    failed = state.get("failed_syncs", 0)
+    if not failed:
+        return 0.0
+    delay = min(SHOPIFY_SYNC_RETRY_BACKOFF * 2 ** (failed - 1), SHOPIFY_SYNC_RETRY_MAX)
+    return max(0.0, (state["last_failed_at"] + timedelta(seconds=delay) - datetime.utcnow()).total_seconds())
+
+async def sync_shopify_orders(user_id: str, settings: dict) -> int:
+    """
+    Pull orders updated since the stored high-water mark into `shopify_orders`.
+    
+    Pages are requested oldest-update first and the mark is advanced after each
+    page is written, so an interrupted sync resumes where it stopped.
+    A failure is recorded on the sync state (see sync_retry_in) and re-raised.
+    Returns the number of orders written.
+    """
+    lock = _shopify_sync_locks.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        current = await db.user_settings.find_one({"user_id": user_id}) or {}
+        if current.get("shopify_url") != settings.get("shopify_url"):
+            # The store changed while this sync waited for the lock (see reset_shopify_mirror)
+            settings = current
+            if not settings.get("shopify_url") or not settings.get("shopify_token"):
+                return 0
+        try:
+            return await pull_shopify_orders(user_id, settings)
+        except Exception as e:
+            await record_sync_failure(user_id, e)
+            raise
+
+async def pull_shopify_orders(user_id: str, settings: dict) -> int:
+    """The body of sync_shopify_orders, run under the user's sync lock."""
+    state = await db.shopify_sync.find_one({"user_id": user_id}) or {}
+    high_water_mark = state.get("high_water_mark")
+    
+    params = {"order": "updated_at asc"}
+    if high_water_mark:
+        # updated_at_min is inclusive; re-fetching the boundary orders is harmless as writes are upserts
+        params["updated_at_min"] = high_water_mark.isoformat() + "Z"
+    
+    written = 0
+    async for page in iter_shopify_order_pages(settings, params=params):
+        if not page:
+            continue
+        documents = shopify_mirror_documents(user_id, page)
+        await db.shopify_orders.bulk_write(
+            [
+                UpdateOne({"user_id": user_id, "id": document["id"]}, {"$set": document}, upsert=True)
+                for document in documents
+            ],
+            ordered=False
+        )
+        written += len(documents)
+        publish_order_changes(user_id, documents)
+        
+        # Every page written bumps the mirror version, which the order list ETag is derived from
+        update = {"$inc": {"version": 1}, "$setOnInsert": {"mirror_id": str(uuid.uuid4())}}
+        page_mark = max((d["updated_at"] for d in documents if d["updated_at"]), default=None)
+        if page_mark and (high_water_mark is None or page_mark > high_water_mark):
+            high_water_mark = page_mark
+            update["$set"] = {"high_water_mark": high_water_mark}
+        await db.shopify_sync.update_one({"user_id": user_id}, update, upsert=True)
+    
+    await db.shopify_sync.update_one(
+        {"user_id": user_id},
+        {
+            "$set": {"last_synced_at": datetime.utcnow()},
+            "$unset": SYNC_FAILURE_FIELDS,
+            "$setOnInsert": {"mirror_id": str(uuid.uuid4())},
+        },
+        upsert=True
+    )
+    return written
+
+async def cursor_pages(cursor, batch_size: int = 500) -> AsyncIterator[List[dict]]:
+    cursor.batch_size(batch_size)
+    while True:
+        page = await cursor.to_list(length=batch_size)
+        if not page:
+            return
+        yield page
+
+async def mirror_order_pages(user_id: str, batch_size: int = 500) -> AsyncIterator[List[dict]]:
+    cursor = db.shopify_orders.find({"user_id": user_id}, SHOPIFY_ORDER_PROJECTION).sort("created_at_ts", -1)
+    async for page in cursor_pages(cursor, batch_size):
+        yield page
+
+async def refresh_stale_mirror(user_id: str, settings: dict, refresh: bool = False) -> dict:
+    """
+    Pull a delta from Shopify when the mirror is older than SHOPIFY_SYNC_INTERVAL,
+    or SHOPIFY_WEBHOOK_SYNC_INTERVAL when the store pushes order webhooks (or on request).
+    After failed syncs, automatic ones wait for the retry backoff.
+    Returns the mirror's sync state as of the end of the refresh.
+    """
+    interval = SHOPIFY_WEBHOOK_SYNC_INTERVAL if settings.get("shopify_webhook_secret") else SHOPIFY_SYNC_INTERVAL
+    state = await db.shopify_sync.find_one({"user_id": user_id}) or {}
+    last_synced_at = state.get("last_synced_at")
+    due = last_synced_at is None or datetime.utcnow() - last_synced_at > timedelta(seconds=interval)
+    if refresh or (due and sync_retry_in(state) <= 0):
+        await sync_shopify_orders(user_id, settings)
+        state = await db.shopify_sync.find_one({"user_id": user_id}) or {}
+    return state
+
+_initial_syncs: Dict[str, asyncio.Task] = {}
+
+def start_initial_sync(user_id: str, settings: dict):
+    """Build a new mirror in the background; its pages reach open dashboards as they are written."""
+    task = _initial_syncs.get(user_id)
+    if task is not None and not task.done():
+        return
+    
+    async def run():
+        try:
+            await sync_shopify_orders(user_id, settings)
+        except Exception as e:
+            # Recorded on the sync state; readable_mirror reports it until a sync succeeds
+            logger.warning("Initial Shopify order sync failed for user %s: %s", user_id, getattr(e, "detail", e))
+        finally:
+            if _initial_syncs.get(user_id) is asyncio.current_task():
+                del _initial_syncs[user_id]
+    
+    _initial_syncs[user_id] = asyncio.create_task(run())
+
+async def reset_shopify_mirror(user_id: str):
+    """
+    Drop the mirror of a store the user no longer uses. A first sync still
+    running for it is cancelled, and the reset waits for any other sync, so
+    none of the old store's orders or its high-water mark survive it.
+    """
+    task = _initial_syncs.pop(user_id, None)
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    async with _shopify_sync_locks.setdefault(user_id, asyncio.Lock()):
+        await db.shopify_orders.delete_many({"user_id": user_id})
+        await db.shopify_sync.delete_one({"user_id": user_id})
+
+async def readable_mirror(user_id: str, settings: dict, refresh: bool = False) -> Tuple[dict, str]:
+    """
+    `refresh_stale_mirror` for routes that serve the mirror: a Shopify outage
+    must not hide orders already stored. Returns the sync state and the mirror
+    status for X-Mirror-Status: "fresh", "stale" (the last sync failed; the
+    stored orders are served) or "syncing" (the first sync of this store was
+    started in the background; the orders written so far are served).
+    
+    Until a first sync succeeds, its last failure is raised instead: an empty
+    mirror would read as a store without orders. It is retried in the
+    background after the backoff (see sync_retry_in).
+    """
+    state = await db.shopify_sync.find_one({"user_id": user_id}) or {}
+    if state.get("last_synced_at") is None:
+        retry_in = sync_retry_in(state)
+        if retry_in <= 0:
+            # A large store's first sync takes minutes; an interrupted one resumes from its high-water mark
+            start_initial_sync(user_id, settings)
+        error = state.get("last_error")
+        if error:
+            raise HTTPException(
+                status_code=error["status_code"],
+                detail=error["detail"],
+                headers={"Retry-After": str(max(1, round(retry_in)))}
+            )
+        return state, "syncing"
+    try:
+        state = await refresh_stale_mirror(user_id, settings, refresh)
+    except Exception as e:
+        logger.warning("Serving the stored orders of user %s; Shopify sync failed: %s", user_id, getattr(e, "detail", e))
+        return await db.shopify_sync.find_one({"user_id": user_id}) or state, "stale"
+    # Within the retry backoff the refresh is skipped, and the last sync is still the failed one
+    return state, "stale" if state.get("last_error") else "fresh"
+
+def set_mirror_headers(response: Response, state: dict, mirror_status: str):
+    response.headers["X-Mirror-Status"] = mirror_status
+    if state.get("last_synced_at"):
+        response.headers["X-Mirror-Synced-At"] = state["last_synced_at"].isoformat() + "Z"
+
+def mirror_etag(user_id: str, state: dict, output_format: str) -> str:
+    # A reset deletes the sync state, so a rebuilt mirror gets a new mirror_id even if its version repeats
+    return etag_for("shopify_orders", user_id, state.get("mirror_id"), state.get("version", 0), output_format)
+
+# Live order events (Server-Sent Events, see events.py)
+order_events = EventHub()
+
+def publish_order_changes(user_id: str, documents: List[dict]):
+    """Push orders just written to the mirror to the user's open dashboards."""
+    if documents and order_events.has_subscribers(user_id):
+        order_events.publish(user_id, "orders", [
+            {field: document.get(field) for field in ShopifyOrder.model_fields} for document in documents
+        ])
+
+# Shopify Routes
 @api_router.get("/shopify/orders", response_model=List[ShopifyOrder])
-async def get_shopify_orders(current_user: User = Depends(get_current_user)):
+async def get_shopify_orders(
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    source: str = Query("mirror", pattern="^(mirror|live)$"),
+    refresh: bool = False,
+    page_size: int = Query(SHOPIFY_MAX_PAGE_SIZE, ge=1, le=SHOPIFY_MAX_PAGE_SIZE),
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user)
+):
     settings = await db.user_settings.find_one({"user_id": current_user.id})
     if not settings or not settings.get("shopify_url") or not settings.get("shopify_token"):
         raise HTTPException(status_code=400, detail="Shopify credentials not configured")
     
+    if source == "live":
+        return await stream_orders_response(live_order_pages(settings, page_size), format)
+    
+    # Serve from the local mirror, pulling a delta from Shopify when it is stale (or on request)
+    state, mirror_status = await readable_mirror(current_user.id, settings, refresh)
+    etag = mirror_etag(current_user.id, state, format)
+    if etag_matches(if_none_match, etag):
+        response = not_modified(etag)
+    else:
+        response = await stream_orders_response(mirror_order_pages(current_user.id), format)
+        set_etag(response, etag)
+    set_mirror_headers(response, state, mirror_status)
+    return response
+
+@api_router.post("/shopify/sync")
+async def sync_shopify_orders_now(current_user: User = Depends(get_current_user)):
+    settings = await db.user_settings.find_one({"user_id": current_user.id})
+    if not settings or not settings.get("shopify_url") or not settings.get("shopify_token"):
+        raise HTTPException(status_code=400, detail="Shopify credentials not configured")
+    
+    synced = await sync_shopify_orders(current_user.id, settings)
+    return {"synced": synced}
+
+# Shopify webhooks
+async def load_webhook_secret(user_id: str) -> Optional[str]:
+    settings = await db.user_settings.find_one({"user_id": user_id}, {"_id": 0, "shopify_webhook_secret": 1})
+    return (settings or {}).get("shopify_webhook_secret")
+
+def newer_or_same(document: dict) -> dict:
+    # Lets a delivery replace the stored order only if it is not older; an older one then fails
+    # the filter, tries to insert and hits the unique (user_id, id) index, and is dropped
+    if document["updated_at"] is None:
+        return {}
+    return {"$or": [{"updated_at": None}, {"updated_at": {"$lte": document["updated_at"]}}]}
+
+async def write_webhook_orders(deliveries: List[dict]):
+    """Flush a batch of buffered order webhooks into the mirror (see webhooks.py)."""
+    received_at = datetime.utcnow()
     try:
-        async with httpx.AsyncClient() as client:
-            headers = {"X-Shopify-Access-Token": settings["shopify_token"]}
-            url = f"https://{settings['shopify_url']}/admin/api/2023-10/orders.json?status=any&limit=50"
-            response = await client.get(url, headers=headers)
-            
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail="Failed to fetch Shopify orders")
-            
-            data = response.json()
-            orders = []
-            
-            for order in data.get("orders", []):
-                shipping_address = order.get("shipping_address", {})
-                line_items = [
-                    {
-                        "name": item.get("name", ""),
-                        "quantity": item.get("quantity", 0),
-                        "price": item.get("price", "0")
-                    }
-                    for item in order.get("line_items", [])
-                ]
-                
-                shopify_order = ShopifyOrder(
-                    id=str(order.get("id", "")),
-                    order_number=str(order.get("order_number", "")),
-                    customer_name=f"{order.get('customer', {}).get('first_name', '')} {order.get('customer', {}).get('last_name', '')}".strip(),
-                    customer_phone=order.get("customer", {}).get("phone", "") or shipping_address.get("phone", ""),
-                    customer_email=order.get("customer", {}).get("email", ""),
-                    shipping_address=f"{shipping_address.get('address1', '')} {shipping_address.get('address2', '')}".strip(),
-                    city=shipping_address.get("city", ""),
-                    total_price=str(order.get("total_price", "0")),
-                    status=order.get("financial_status", "pending"),
-                    created_at=order.get("created_at", ""),
-                    items=line_items
+        await db.shopify_webhooks.insert_many(
+            [
+                {"user_id": d["user_id"], "webhook_id": d["webhook_id"], "topic": d["topic"], "received_at": received_at}
+                for d in deliveries
+            ],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        # Deliveries another worker has already recorded
+        duplicates = {error["index"] for error in e.details["writeErrors"] if error["code"] == 11000}
+        if len(duplicates) < len(e.details["writeErrors"]):
+            raise
+        deliveries = [d for index, d in enumerate(deliveries) if index not in duplicates]
+    
+    by_user: Dict[str, List[dict]] = {}
+    for delivery in deliveries:
+        by_user.setdefault(delivery["user_id"], []).append(delivery["order"])
+    
+    for user_id, orders in by_user.items():
+        documents = shopify_mirror_documents(user_id, orders)
+        stale = set()
+        try:
+            await db.shopify_orders.bulk_write(
+                [
+                    UpdateOne(
+                        {"user_id": user_id, "id": document["id"], **newer_or_same(document)},
+                        {"$set": document},
+                        upsert=True
+                    )
+                    for document in documents
+                ],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            stale = {error["index"] for error in e.details["writeErrors"]}
+        publish_order_changes(user_id, [d for index, d in enumerate(documents) if index not in stale])
+        # Bump the mirror version so order list ETags change (see sync_shopify_orders)
+        await db.shopify_sync.update_one(
+            {"user_id": user_id},
+            {"$inc": {"version": 1}, "$setOnInsert": {"mirror_id": str(uuid.uuid4())}},
+            upsert=True
+        )
+
+webhook_secrets = SecretCache(load_webhook_secret)
+recent_webhooks = RecentIds()
+webhook_writer = BufferedWriter(write_webhook_orders)
+
+@api_router.post("/webhooks/shopify/{user_id}")
+async def receive_shopify_webhook(
+    user_id: str,
+    request: Request,
+    x_shopify_topic: Optional[str] = Header(None),
+    x_shopify_hmac_sha256: Optional[str] = Header(None),
+    x_shopify_webhook_id: Optional[str] = Header(None)
+):
+    body = await request.body()
+    if not verify_shopify_hmac(body, await webhook_secrets.get(user_id), x_shopify_hmac_sha256):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+    
+    if x_shopify_topic not in SHOPIFY_ORDER_TOPICS:
+        return {"status": "ignored"}
+    
+    webhook_id = x_shopify_webhook_id or str(uuid.uuid4())
+    if (user_id, webhook_id) in recent_webhooks:
+        return {"status": "duplicate"}
+    
+    try:
+        order = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    if not isinstance(order, dict) or "id" not in order:
+        raise HTTPException(status_code=400, detail="Payload is not an order")
+    
+    delivery = {"user_id": user_id, "webhook_id": webhook_id, "topic": x_shopify_topic, "order": order}
+    if not webhook_writer.add(delivery):
+        # Shopify retries failed deliveries, so shed load rather than buffer without bound
+        raise HTTPException(status_code=503, detail="Webhook buffer full, retry later")
+    recent_webhooks.add((user_id, webhook_id))
+    return {"status": "accepted"}
+
+@api_router.post("/events/ticket")
+async def create_stream_ticket(current_user: User = Depends(get_current_user)):
+    """A single-use ticket for opening /events/orders, valid for STREAM_TICKET_TTL seconds."""
+    ticket = secrets.token_urlsafe(32)
+    await db.stream_tickets.insert_one({
+        "_id": stream_ticket_id(ticket),
+        "user_id": current_user.id,
+        "expires_at": datetime.utcnow() + timedelta(seconds=STREAM_TICKET_TTL)
+    })
+    return {"ticket": ticket, "expires_in": STREAM_TICKET_TTL}
+
+@api_router.get("/events/orders")
+async def stream_order_events(current_user: User = Depends(get_stream_user)):
+    """
+    Server-Sent Events stream of the current user's order changes. Each
+    `orders` event carries a JSON list of changed orders, in the order list format.
+    """
+    return StreamingResponse(
+        order_events.stream(current_user.id),
+        media_type="text/event-stream",
+        # no-transform and X-Accel-Buffering keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"}
+    )
+
+# ZRExpress helpers
+ZREXPRESS_CHUNK_SIZE = int(os.environ.get('ZREXPRESS_CHUNK_SIZE', '50'))
+ZREXPRESS_CONCURRENCY = int(os.environ.get('ZREXPRESS_CONCURRENCY', '4'))
+# MessageRetour values ZRExpress uses for a colis it accepted
+ZREXPRESS_ACCEPTED_MESSAGES = {"", "good", "ok", "success"}
+# Below this, an order without an id_wilaya is not sent to the resolved wilaya
+WILAYA_MIN_CONFIDENCE = float(os.environ.get('WILAYA_MIN_CONFIDENCE', '0.75'))
+# Optional wilaya to use instead; empty rejects the order so the merchant can set it
+WILAYA_FALLBACK = os.environ.get('WILAYA_FALLBACK', '')
+
+def zrexpress_headers(settings: dict) -> dict:
+    return {
+        "token": settings["zrexpress_token"],
+        "key": settings["zrexpress_key"],
+        "Content-Type": "application/json"
+    }
+
+tracking_allocator = TrackingNumberAllocator(db.counters)
+
+async def assign_tracking_numbers(orders: List[EditableOrder]):
+    """Give every order without a tracking number a freshly allocated one, so retries reuse it."""
+    missing = [order for order in orders if not order.tracking]
+    for order, tracking in zip(missing, await tracking_allocator.allocate(len(missing))):
+        order.tracking = tracking
+
+def parse_add_colis_response(response: httpx.Response, colis: List[dict]) -> List[ZRExpressOrderResult]:
+    """Match the per-colis entries of an add_colis response back to the colis that were sent."""
+    try:
+        body = response.json() if response.text else {}
+    except ValueError:
+        body = {}
+    entries = body.get("Colis") if isinstance(body, dict) else None
+    by_tracking = {
+        entry.get("Tracking"): entry
+        for entry in entries or []
+        if isinstance(entry, dict)
+    }
+    
+    results = []
+    for item in colis:
+        entry = by_tracking.get(item["Tracking"])
+        if entry is None:
+            if entries is not None:
+                # Per-colis results were sent but this one is missing: its outcome is unknown
+                results.append(ZRExpressOrderResult(
+                    shopify_id=item["id_Externe"],
+                    status="error",
+                    message="ZRExpress returned no result for this colis",
+                    uncertain=True
+                ))
+                continue
+            entry = {}  # no per-colis results at all: a 200 accepts the whole batch
+        message = str(entry.get("MessageRetour") or "")
+        accepted = message.strip().lower() in ZREXPRESS_ACCEPTED_MESSAGES
+        results.append(ZRExpressOrderResult(
+            shopify_id=item["id_Externe"],
+            tracking=item["Tracking"] if accepted else None,
+            status="accepted" if accepted else "rejected",
+            message=message
+        ))
+    return results
+
+async def send_zrexpress_chunk(settings: dict, colis: List[dict]) -> List[ZRExpressOrderResult]:
+    def failed(status_name: str, message: str, uncertain: bool = False) -> List[ZRExpressOrderResult]:
+        return [
+            ZRExpressOrderResult(shopify_id=item["id_Externe"], status=status_name, message=message, uncertain=uncertain)
+            for item in colis
+        ]
+    
+    try:
+        response = await upstream_request(
+            "zrexpress",
+            "POST",
+            f"{ZREXPRESS_BASE_URL}/add_colis",
+            headers=zrexpress_headers(settings),
+            json={"Colis": colis}
+        )
+    except NOT_SENT_ERRORS as e:
+        return failed("error", f"Error connecting to ZRExpress: {str(e)}")
+    except httpx.RequestError as e:
+        # Timed out or cut off after sending: ZRExpress may have created the parcels
+        return failed("error", f"No answer from ZRExpress: {str(e)}", uncertain=True)
+    
+    if response.status_code == 429:
+        return failed("error", f"ZRExpress unavailable ({response.status_code}): {response.text}")
+    if response.status_code >= 500:
+        return failed("error", f"ZRExpress unavailable ({response.status_code}): {response.text}", uncertain=True)
+    if response.status_code != 200:
+        return failed("rejected", response.text)
+    return parse_add_colis_response(response, colis)
+
+# Dispatch ledger: one row per (user, id_Externe) sent, or being sent, to ZRExpress.
+# Status "pending" while a send is in flight, "sent" once accepted, and "unknown" when the send failed in a way
+# that may have created the parcel anyway; such rows (and abandoned pending ones) are checked with `lire` before
+# the order is sent again, and resent with the same tracking number.
+DISPATCH_PENDING_TIMEOUT = int(os.environ.get('DISPATCH_PENDING_TIMEOUT', '600'))  # seconds before an unfinished send may be retried
+
+def dispatch_ledger_entry(user_id: str, order: EditableOrder, now: datetime, job_id: Optional[str] = None) -> dict:
+    return {
+        "user_id": user_id,
+        "job_id": job_id,  # the dispatch job sending it, if any
+        "id_externe": order.shopify_id,
+        "tracking": order.tracking,
+        "status": "pending",
+        "customer_name": order.customer_name,
+        "customer_phone": order.customer_phone,
+        "city": order.city,
+        "id_wilaya": order.id_wilaya,
+        "total_price": order.total_price,
+        "created_at": now,
+        "updated_at": now,
+        "sent_at": None,
+    }
+
+async def reserve_dispatches(
+    settings: dict,
+    user_id: str,
+    orders: List[Tuple[int, EditableOrder]],
+    job_id: Optional[str] = None
+) -> Tuple[List[int], dict]:
+    """
+    Claim ledger rows for orders about to be sent, on behalf of dispatch job
+    `job_id` if given.
+    
+    Returns the indexes that may be sent, and results for the ones that must
+    be skipped: already dispatched (reported with their existing tracking
+    number), currently being sent by another request, or whose earlier send
+    could not be confirmed or ruled out with ZRExpress.
+    """
+    existing = {}
+    async for entry in db.dispatches.find({
+        "user_id": user_id,
+        "id_externe": {"$in": [order.shopify_id for _, order in orders]}
+    }):
+        existing[entry["id_externe"]] = entry
+    
+    now = datetime.utcnow()
+    stale_before = now - timedelta(seconds=DISPATCH_PENDING_TIMEOUT)
+    reserved, skipped, new, unresolved = [], {}, [], []
+    
+    def in_progress(order):
+        return ZRExpressOrderResult(shopify_id=order.shopify_id, status="error", message="Dispatch already in progress")
+    
+    def already_dispatched(order, tracking):
+        return ZRExpressOrderResult(shopify_id=order.shopify_id, tracking=tracking, status="accepted", message="Already dispatched")
+    
+    for index, order in orders:
+        entry = existing.get(order.shopify_id)
+        if entry is None:
+            new.append((index, order))
+        elif entry["status"] == "sent":
+            skipped[index] = already_dispatched(order, entry["tracking"])
+        elif (
+            entry["status"] == "unknown"
+            or entry["updated_at"] < stale_before
+            or (job_id is not None and entry.get("job_id") == job_id)
+        ):
+            # An earlier send ended without a clear answer, or was abandoned by a request that died mid-send.
+            # A job re-claimed after its worker died gets its own rows back without waiting for the timeout.
+            unresolved.append((index, order, entry))
+        else:
+            skipped[index] = in_progress(order)
+    
+    if unresolved:
+        known = await find_zrexpress_parcels(settings, [entry["tracking"] for _, _, entry in unresolved])
+        for index, order, entry in unresolved:
+            unchanged = {"_id": entry["_id"], "status": entry["status"], "updated_at": entry["updated_at"]}
+            if known is None:
+                skipped[index] = ZRExpressOrderResult(
+                    shopify_id=order.shopify_id,
+                    status="error",
+                    message="Could not check with ZRExpress whether this order was already sent; try again later"
+                )
+            elif entry["tracking"] in known:
+                # It did get through: record it as sent instead of creating a second parcel
+                confirmed = await db.dispatches.update_one(unchanged, {"$set": {
+                    "status": "sent", "sent_at": now, "updated_at": now
+                }})
+                if confirmed.modified_count:
+                    await db.shipments.bulk_write([shipment_upsert(user_id, entry["tracking"], order.shopify_id, now)])
+                    skipped[index] = already_dispatched(order, entry["tracking"])
+                else:
+                    skipped[index] = in_progress(order)
+            else:
+                # Not there: take the row over and resend under the same tracking number
+                order.tracking = entry["tracking"] or order.tracking
+                takeover = await db.dispatches.update_one(
+                    unchanged,
+                    {"$set": {**dispatch_ledger_entry(user_id, order, now, job_id), "created_at": entry["created_at"]}}
+                )
+                if takeover.modified_count:
+                    reserved.append(index)
+                else:
+                    skipped[index] = in_progress(order)
+    
+    if new:
+        lost = set()
+        try:
+            await db.dispatches.insert_many(
+                [dispatch_ledger_entry(user_id, order, now, job_id) for _, order in new],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            lost = {error["index"] for error in e.details["writeErrors"] if error["code"] == 11000}
+            if len(lost) != len(e.details["writeErrors"]):
+                raise
+        for position, (index, order) in enumerate(new):
+            if position in lost:
+                skipped[index] = in_progress(order)
+            else:
+                reserved.append(index)
+    
+    return reserved, skipped
+
+def shipment_upsert(user_id: str, tracking: str, id_externe: str, now: datetime) -> UpdateOne:
+    return UpdateOne(
+        {"user_id": user_id, "tracking": tracking},
+        {"$setOnInsert": Shipment(tracking=tracking, id_externe=id_externe, created_at=now, checked_at=now).dict()},
+        upsert=True
+    )
+
+async def record_dispatches(user_id: str, results: List[ZRExpressOrderResult]):
+    """
+    Mark accepted orders as sent, and start tracking their parcels. Mark the
+    rows of uncertain failures "unknown", and release the rows of orders that
+    were rejected or never reached ZRExpress.
+    """
+    now = datetime.utcnow()
+    operations = []
+    shipments = []
+    for result in results:
+        selector = {"user_id": user_id, "id_externe": result.shopify_id, "status": "pending"}
+        if result.status == "accepted":
+            operations.append(UpdateOne(selector, {"$set": {
+                "status": "sent",
+                "tracking": result.tracking,
+                "sent_at": now,
+                "updated_at": now,
+            }}))
+            shipments.append(shipment_upsert(user_id, result.tracking, result.shopify_id, now))
+        elif result.uncertain:
+            operations.append(UpdateOne(selector, {"$set": {"status": "unknown", "updated_at": now}}))
+        else:
+            operations.append(DeleteOne(selector))
+    if operations:
+        await db.dispatches.bulk_write(operations, ordered=False)
+    if shipments:
+        await db.shipments.bulk_write(shipments, ordered=False)
+
+async def dispatch_to_zrexpress(
+    settings: dict,
+    user_id: str,
+    orders: List[EditableOrder],
+    on_chunk: Optional[Callable[[List[Tuple[int, ZRExpressOrderResult]]], Awaitable[None]]] = None,
+    job_id: Optional[str] = None
+) -> List[ZRExpressOrderResult]:
+    """
+    Send orders to ZRExpress in chunks of ZREXPRESS_CHUNK_SIZE, at most
+    ZREXPRESS_CONCURRENCY chunks at a time, and return one result per order
+    in input order. Orders without an id_wilaya, or with one resolved below
+    WILAYA_MIN_CONFIDENCE, get one resolved from their city (or
+    WILAYA_FALLBACK, if set). Rows that
+    cannot be mapped are rejected without being sent, and
+    orders already in the dispatch ledger are not sent again.
+    `on_chunk` is awaited with the (order index, result) pairs of each chunk.
+    `job_id` identifies the dispatch job sending them (see reserve_dispatches).
+    """
+    await assign_tracking_numbers(orders)
+    
+    results: dict = {}
+    candidates = []
+    seen = set()
+    for index, order in enumerate(orders):
+        if order.shopify_id in seen:
+            results[index] = ZRExpressOrderResult(shopify_id=order.shopify_id, status="rejected", message="Duplicate order in batch")
+            continue
+        seen.add(order.shopify_id)
+        guessed = order.location_confidence is not None and order.location_confidence < WILAYA_MIN_CONFIDENCE
+        if not order.id_wilaya or guessed:
+            location = get_wilaya_resolver().resolve(order.city)
+            if location.id_wilaya is not None and location.confidence >= WILAYA_MIN_CONFIDENCE:
+                order.id_wilaya = location.id_wilaya
+            elif WILAYA_FALLBACK:
+                order.id_wilaya = WILAYA_FALLBACK
+            else:
+                results[index] = ZRExpressOrderResult(
+                    shopify_id=order.shopify_id,
+                    status="rejected",
+                    message=f"Could not determine the wilaya of {order.city!r}; set id_wilaya"
                 )
-                orders.append(shopify_order)
-            
-            return orders
-            
-    except httpx.RequestError:
-        raise HTTPException(status_code=500, detail="Error connecting to Shopify")
-
-# ZRExpress Routes (unchanged)
+                continue
+        candidates.append(index)
+    
+    valid = []
+    for index, item in zip(candidates, zrexpress_colis_records([orders[index] for index in candidates])):
+        if item is None:
+            results[index] = ZRExpressOrderResult(
+                shopify_id=orders[index].shopify_id,
+                status="rejected",
+                message=f"Invalid total_price: {orders[index].total_price!r}"
+            )
+        else:
+            valid.append((index, item))
+    
+    colis_by_index = dict(valid)
+    reserved, skipped = await reserve_dispatches(
+        settings, user_id, [(index, orders[index]) for index, _ in valid], job_id
+    )
+    results.update(skipped)
+    # A resend reuses the tracking number of the unconfirmed earlier attempt
+    colis = [(index, {**colis_by_index[index], "Tracking": orders[index].tracking}) for index in sorted(reserved)]
+    
+    semaphore = asyncio.Semaphore(ZREXPRESS_CONCURRENCY)
+    
+    async def send_chunk(chunk):
+        async with semaphore:
+            chunk_results = await send_zrexpress_chunk(settings, [item for _, item in chunk])
+        await record_dispatches(user_id, chunk_results)
+        indexed_results = [(index, result) for (index, _), result in zip(chunk, chunk_results)]
+        results.update(indexed_results)
+        if on_chunk is not None:
+            await on_chunk(indexed_results)
+    
+    chunks = [colis[i:i + ZREXPRESS_CHUNK_SIZE] for i in range(0, len(colis), ZREXPRESS_CHUNK_SIZE)]
+    await asyncio.gather(*(send_chunk(chunk) for chunk in chunks))
+    return [results[index] for index in range(len(orders))]
+
+# Idempotency keys for whole-request retries (expired by the TTL index in indexes.py)
+IDEMPOTENCY_PENDING_TIMEOUT = int(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT', '300'))  # seconds before an unfinished request may be retried
+
+def request_fingerprint(body) -> str:
+    return hashlib.sha256(dumps(jsonable_encoder(body))).hexdigest()
+
+async def run_idempotent(
+    user_id: str,
+    key: Optional[str],
+    route: str,
+    fingerprint: str,
+    operation: Callable[[], Awaitable[dict]]
+) -> dict:
+    """
+    Run `operation` once per (user, Idempotency-Key) and replay its stored
+    response for repeated requests. Without a key the operation just runs.
+    
+    A key is bound to the route and request body (`fingerprint`) it was first
+    used with; reusing it for anything else is a 422. A key left pending for
+    IDEMPOTENCY_PENDING_TIMEOUT, by a process that died mid-request, is taken
+    over by the next retry. The dispatch ledger still keeps a takeover from
+    sending an order twice.
+    """
+    if not key:
+        return await operation()
+    
+    now = datetime.utcnow()
+    try:
+        await db.idempotency_keys.insert_one({
+            "user_id": user_id,
+            "key": key,
+            "route": route,
+            "fingerprint": fingerprint,
+            "status": "pending",
+            "response": None,
+            "created_at": now
+        })
+    except DuplicateKeyError:
+        stored = await db.idempotency_keys.find_one({"user_id": user_id, "key": key})
+        if stored is None:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        if stored.get("route", route) != route or stored.get("fingerprint", fingerprint) != fingerprint:
+            raise HTTPException(status_code=422, detail="This Idempotency-Key was already used for a different request")
+        if stored["status"] == "done":
+            return stored["response"]
+        taken_over = False
+        if stored["created_at"] < now - timedelta(seconds=IDEMPOTENCY_PENDING_TIMEOUT):
+            taken = await db.idempotency_keys.update_one(
+                {"_id": stored["_id"], "status": "pending", "created_at": stored["created_at"]},
+                {"$set": {"created_at": now}}
+            )
+            taken_over = taken.modified_count == 1
+        if not taken_over:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+    
+    # Only touch the key while this request still owns it
+    owned = {"user_id": user_id, "key": key, "status": "pending", "created_at": now}
+    try:
+        response = jsonable_encoder(await operation())
+    except BaseException:
+        # Failed requests may be retried with the same key
+        await db.idempotency_keys.delete_one(owned)
+        raise
+    
+    await db.idempotency_keys.update_one(owned, {"$set": {"status": "done", "response": response}})
+    return response
+
+# ZRExpress Routes
 @api_router.post("/zrexpress/send")
 async def send_to_zrexpress(
     orders: List[EditableOrder], 
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     current_user: User = Depends(get_current_user)
 ):
     settings = await db.user_settings.find_one({"user_id": current_user.id})
     if not settings or not settings.get("zrexpress_token") or not settings.get("zrexpress_key"):
         raise HTTPException(status_code=400, detail="ZRExpress credentials not configured")
     
-    try:
-        zr_orders = []
-        for order in orders:
-            tracking = f"A7D-{order.shopify_id[-6:]}-{datetime.now().strftime('%m%d')}"
-            
-            zr_order = {
-                "Tracking": tracking,
-                "TypeLivraison": "0",  # Domicile
-                "TypeColis": "0",     # Normal
-                "Confrimee": "",      # Not pre-confirmed
-                "Client": order.customer_name,
-                "MobileA": order.customer_phone,
-                "MobileB": "",
-                "Adresse": order.shipping_address,
-                "IDWilaya": order.id_wilaya,
-                "Commune": order.city,
-                "Total": str(int(float(order.total_price) * 100)),  # Convert to cents
-                "Note": f"Order #{order.shopify_id}",
-                "TProduit": ", ".join([item.get("name", "") for item in order.items]),
-                "id_Externe": order.shopify_id,
-                "Source": "A7delivery"
-            }
-            zr_orders.append(zr_order)
+    async def send():
+        results = await dispatch_to_zrexpress(settings, current_user.id, orders)
+        accepted = [result for result in results if result.status == "accepted"]
         
-        # Send to ZRExpress
-        async with httpx.AsyncClient() as client:
-            headers = {
-                "token": settings["zrexpress_token"],
-                "key": settings["zrexpress_key"],
-                "Content-Type": "application/json"
-            }
-            
-            payload = {"Colis": zr_orders}
-            response = await client.post(
-                "https://procolis.com/api_v1/add_colis",
-                headers=headers,
-                json=payload
+        # Nothing got through: keep reporting it as a failed request, as before
+        if orders and not accepted:
+            if all(result.status == "error" for result in results):
+                raise HTTPException(status_code=500, detail=results[0].message)
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Failed to send orders to ZRExpress: {results[0].message}"
             )
-            
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Failed to send orders to ZRExpress: {response.text}"
-                )
-            
-            return {
-                "message": f"Successfully sent {len(orders)} orders to ZRExpress",
-                "tracking_numbers": [order["Tracking"] for order in zr_orders],
-                "response": response.json() if response.text else {}
-            }
-            
+        
+        return {
+            "message": f"Successfully sent {len(accepted)} of {len(orders)} orders to ZRExpress",
+            "tracking_numbers": [result.tracking for result in accepted],
+            "accepted": len(accepted),
+            "rejected": len(results) - len(accepted),
+            "results": results
+        }
+    
+    return await run_idempotent(
+        current_user.id, idempotency_key, "zrexpress_send", request_fingerprint(orders), send
+    )
+
+# ZRExpress dispatch jobs
+ZREXPRESS_WORKERS = int(os.environ.get('ZREXPRESS_WORKERS', '2'))
+ZREXPRESS_JOB_VISIBILITY_TIMEOUT = float(os.environ.get('ZREXPRESS_JOB_VISIBILITY_TIMEOUT', '120'))
+ZREXPRESS_JOB_MAX_ATTEMPTS = int(os.environ.get('ZREXPRESS_JOB_MAX_ATTEMPTS', '5'))
+
+async def run_zrexpress_job(job: dict, queue: JobQueue):
+    """Send the orders of a job that have no final result yet (first run or retry)."""
+    settings = await db.user_settings.find_one({"user_id": job["user_id"]})
+    if not settings or not settings.get("zrexpress_token") or not settings.get("zrexpress_key"):
+        raise FailJob("ZRExpress credentials not configured")
+    
+    pending = [
+        index for index, result in enumerate(job["results"])
+        if result is None or result["status"] == "error"
+    ]
+    orders = [EditableOrder(**job["payload"]["orders"][index]) for index in pending]
+    
+    async def record(indexed_results: List[Tuple[int, ZRExpressOrderResult]]):
+        await queue.update(job, {"$set": {
+            f"results.{pending[index]}": result.dict() for index, result in indexed_results
+        }})
+    
+    results = await dispatch_to_zrexpress(settings, job["user_id"], orders, on_chunk=record, job_id=job["id"])
+    # Rows rejected by validation never reach on_chunk
+    await record(list(enumerate(results)))
+    
+    errors = sum(1 for result in results if result.status == "error")
+    if errors:
+        raise RetryJob(f"{errors} orders could not be delivered to ZRExpress")
+
+zrexpress_queue = JobQueue(
+    db.zrexpress_jobs,
+    run_zrexpress_job,
+    workers=ZREXPRESS_WORKERS,
+    visibility_timeout=ZREXPRESS_JOB_VISIBILITY_TIMEOUT,
+    max_attempts=ZREXPRESS_JOB_MAX_ATTEMPTS
+)
+
+def zrexpress_job_response(job: dict) -> dict:
+    results = job.get("results", [])
+    progress = {"total": len(results), "accepted": 0, "rejected": 0, "error": 0, "pending": 0}
+    for result in results:
+        progress[result["status"] if result else "pending"] += 1
+    
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "progress": progress,
+        "results": results,
+        "last_error": job.get("last_error"),
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+        "completed_at": job.get("completed_at"),
+    }
+
+@api_router.post("/zrexpress/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_zrexpress_job(
+    orders: List[EditableOrder],
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    current_user: User = Depends(get_current_user)
+):
+    settings = await db.user_settings.find_one({"user_id": current_user.id})
+    if not settings or not settings.get("zrexpress_token") or not settings.get("zrexpress_key"):
+        raise HTTPException(status_code=400, detail="ZRExpress credentials not configured")
+    
+    # Taken before tracking numbers are assigned to the orders
+    fingerprint = request_fingerprint(orders)
+    
+    async def submit():
+        await assign_tracking_numbers(orders)
+        job = await zrexpress_queue.enqueue(
+            "zrexpress_send",
+            current_user.id,
+            {"orders": [order.dict() for order in orders]},
+            results=[None] * len(orders)
+        )
+        return {"job_id": job["id"], "status": job["status"]}
+    
+    return await run_idempotent(current_user.id, idempotency_key, "zrexpress_jobs", fingerprint, submit)
+
+@api_router.get("/zrexpress/jobs/{job_id}")
+async def get_zrexpress_job(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await db.zrexpress_jobs.find_one({"id": job_id, "user_id": current_user.id}, {"_id": 0, "payload": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return zrexpress_job_response(job)
+
+# Shipment tracking: the latest ZRExpress status of every parcel sent, refreshed in the background
+SHIPMENT_SYNC_INTERVAL = int(os.environ.get('SHIPMENT_SYNC_INTERVAL', '900'))  # seconds between status checks of an open parcel
+SHIPMENT_SYNC_BATCH_SIZE = int(os.environ.get('SHIPMENT_SYNC_BATCH_SIZE', '100'))  # tracking numbers per ZRExpress lookup
+SHIPMENTS_PAGE_SIZE = 100
+SHIPMENTS_SORT = ["created_at", "tracking"]  # newest first; matches the user_id_created_at index
+SHIPMENT_PROJECTION = {"_id": 0, **{field: 1 for field in Shipment.model_fields}}
+
+# Situations, with accents and case folded; anything else is a parcel still on its way
+SHIPMENT_STATE_PATTERNS = [
+    ("pending", re.compile(r"^(en preparation|en attente|prete? a expedier)")),  # not picked up yet
+    ("delivered", re.compile(r"^livre")),  # "Livré", "Livrée", "Livré et encaissé"; not "Livraison en cours"
+    ("returned", re.compile(r"^(retourne|retour (recu|livre|vendeur|expediteur))")),  # not "Retour en cours"
+    ("cancelled", re.compile(r"^annule")),
+]
+FINAL_SHIPMENT_STATES = {"delivered", "returned", "cancelled"}
+
+def shipment_state(situation: Optional[str]) -> str:
+    if not situation:
+        return "pending"
+    folded = "".join(
+        ch for ch in unicodedata.normalize("NFKD", situation.strip().lower()) if not unicodedata.combining(ch)
+    )
+    for state, pattern in SHIPMENT_STATE_PATTERNS:
+        if pattern.match(folded):
+            return state
+    return "in_transit"
+
+async def lookup_zrexpress_status(settings: dict, trackings: List[str]) -> Optional[Dict[str, str]]:
+    """
+    Situation per tracking number from one `lire` call; None when ZRExpress could not be asked.
+    Only parcels with a Situation are included: `lire` may echo an unknown tracking number with an empty one.
+    """
+    try:
+        response = await upstream_request(
+            "zrexpress",
+            "POST",
+            f"{ZREXPRESS_BASE_URL}/lire",
+            headers=zrexpress_headers(settings),
+            json={"Colis": [{"Tracking": tracking} for tracking in trackings]},
+            idempotent=True  # a read, safe to retry
+        )
     except httpx.RequestError as e:
-        raise HTTPException(status_code=500, detail=f"Error connecting to ZRExpress: {str(e)}")
+        logger.warning("ZRExpress status lookup failed: %s", e)
+        return None
+    if response.status_code != 200:
+        logger.warning("ZRExpress status lookup failed (%s): %s", response.status_code, response.text[:200])
+        return None
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    entries = body.get("Colis") if isinstance(body, dict) else None
+    return {
+        entry["Tracking"]: str(entry["Situation"])
+        for entry in entries or []
+        if isinstance(entry, dict) and entry.get("Tracking") and entry.get("Situation")
+    }
+
+async def find_zrexpress_parcels(settings: dict, trackings: List[str]) -> Optional[set]:
+    """The tracking numbers ZRExpress knows among `trackings`; None when it could not be asked."""
+    known = set()
+    for start in range(0, len(trackings), SHIPMENT_SYNC_BATCH_SIZE):
+        situations = await lookup_zrexpress_status(settings, trackings[start:start + SHIPMENT_SYNC_BATCH_SIZE])
+        if situations is None:
+            return None
+        known.update(situations)
+    return known
+
+async def sync_user_shipments(user_id: str, settings: dict) -> int:
+    """
+    Refresh the status of the user's open parcels not checked for SHIPMENT_SYNC_INTERVAL,
+    SHIPMENT_SYNC_BATCH_SIZE tracking numbers per ZRExpress call. Returns how many changed.
+    """
+    changed = 0
+    checked_before = datetime.utcnow() - timedelta(seconds=SHIPMENT_SYNC_INTERVAL)
+    while True:
+        # Every parcel in a batch gets a new checked_at, so the next query moves on to the following ones
+        batch = await db.shipments.find(
+            {"user_id": user_id, "final": False, "checked_at": {"$lt": checked_before}},
+            {"_id": 0, "tracking": 1, "status": 1}
+        ).sort("checked_at", 1).limit(SHIPMENT_SYNC_BATCH_SIZE).to_list(SHIPMENT_SYNC_BATCH_SIZE)
+        if not batch:
+            return changed
+        
+        situations = await lookup_zrexpress_status(settings, [shipment["tracking"] for shipment in batch])
+        if situations is None:
+            return changed  # retried on the next round
+        
+        now = datetime.utcnow()
+        operations = []
+        for shipment in batch:
+            update = {"checked_at": now}
+            situation = situations.get(shipment["tracking"])
+            if situation and situation != shipment.get("status"):
+                state = shipment_state(situation)
+                update.update({
+                    "status": situation,
+                    "state": state,
+                    "final": state in FINAL_SHIPMENT_STATES,
+                    "status_changed_at": now,
+                })
+                changed += 1
+            operations.append(UpdateOne({"user_id": user_id, "tracking": shipment["tracking"]}, {"$set": update}))
+        await db.shipments.bulk_write(operations, ordered=False)
+        if len(batch) < SHIPMENT_SYNC_BATCH_SIZE:
+            return changed
+
+# Shipment Routes
+@api_router.get("/shipments", response_model=List[Shipment], response_class=FastJSONResponse)
+async def get_shipments(
+    limit: int = Query(SHIPMENTS_PAGE_SIZE, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    state: Optional[str] = Query(None, pattern="^(pending|in_transit|delivered|returned|cancelled|open)$"),
+    tracking: Optional[str] = Query(None, description="Tracking number or order id"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    The cached status of the user's parcels, newest first (state=open for
+    those still on their way). Pages continue through X-Next-Cursor, as for /users.
+    """
+    query = {"user_id": current_user.id}
+    if state == "open":
+        query["final"] = False
+    elif state:
+        query["state"] = state
+    if tracking:
+        query["$or"] = [{"tracking": tracking}, {"id_externe": tracking}]
+    if cursor:
+        try:
+            position = after(SHIPMENTS_SORT, decode_cursor(cursor), descending=True)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = {"$and": [query, position]}
+    
+    shipments = await db.shipments.find(query, SHIPMENT_PROJECTION).sort(
+        [(field, -1) for field in SHIPMENTS_SORT]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    response = FastJSONResponse([Shipment(**shipment) for shipment in shipments[:limit]])
+    if len(shipments) > limit:
+        last = shipments[limit - 1]
+        response.headers["X-Next-Cursor"] = encode_cursor([last[field] for field in SHIPMENTS_SORT])
+    return response
+
+# Background sync scheduler (see scheduler.py): periodic jobs for every active user with settings
+CONNECTION_HEALTH_INTERVAL = int(os.environ.get('CONNECTION_HEALTH_INTERVAL', '900'))
+
+def has_shopify_credentials(settings: dict) -> bool:
+    return bool(settings.get("shopify_url") and settings.get("shopify_token"))
+
+def has_zrexpress_credentials(settings: dict) -> bool:
+    return bool(settings.get("zrexpress_token") and settings.get("zrexpress_key"))
+
+async def load_scheduler_tenants() -> Dict[str, dict]:
+    """Settings of every active, unexpired user, by user id."""
+    user_ids = await db.users.distinct("id", user_status_filter("active", datetime.utcnow()))
+    tenants = {}
+    async for settings in db.user_settings.find({"user_id": {"$in": user_ids}}, {"_id": 0}):
+        tenants[settings["user_id"]] = settings
+    return tenants
+
+async def sync_orders_job(user_id: str, settings: dict):
+    # A no-op when a dashboard request or webhook kept the mirror fresh
+    await refresh_stale_mirror(user_id, settings)
+
+async def connection_health_job(user_id: str, settings: dict):
+    results = await check_connections(settings)
+    await db.connection_health.update_one(
+        {"user_id": user_id},
+        {"$set": {**results, "checked_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+sync_scheduler = Scheduler(load_scheduler_tenants)
+sync_scheduler.add_job(Job("order_sync", SHOPIFY_SYNC_INTERVAL, sync_orders_job, has_shopify_credentials))
+# Each run only looks up parcels not checked for SHIPMENT_SYNC_INTERVAL, so run at a fraction of it
+sync_scheduler.add_job(
+    Job("shipment_sync", max(SHIPMENT_SYNC_INTERVAL / 10, 1), sync_user_shipments, has_zrexpress_credentials)
+)
+sync_scheduler.add_job(
+    Job(
+        "connection_health",
+        CONNECTION_HEALTH_INTERVAL,
+        connection_health_job,
+        lambda settings: has_shopify_credentials(settings) or has_zrexpress_credentials(settings)
+    )
+)
+
+@api_router.get("/admin/scheduler")
+async def get_scheduler_state(current_admin: User = Depends(get_current_admin_user)):
+    return sync_scheduler.snapshot()
+
+# Exports
+ORDER_EXPORT_COLUMNS = [
+    "order_number", "id", "created_at", "status", "customer_name", "customer_phone", "customer_email",
+    "shipping_address", "city", "id_wilaya", "commune", "location_confidence", "total_price", "items",
+]
+DISPATCH_EXPORT_COLUMNS = [
+    "id_externe", "tracking", "status", "customer_name", "customer_phone", "city", "id_wilaya",
+    "total_price", "created_at", "sent_at",
+]
+
+def export_columns(requested: Optional[str], available: List[str]) -> List[str]:
+    if not requested:
+        return available
+    columns = [column.strip() for column in requested.split(",") if column.strip()]
+    unknown = [column for column in columns if column not in available]
+    if unknown or not columns:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown export columns: {', '.join(unknown)}. Available: {', '.join(available)}"
+        )
+    return columns
+
+def naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def date_range_filter(field: str, start: Optional[datetime], end: Optional[datetime]) -> dict:
+    bounds = {}
+    if start:
+        bounds["$gte"] = start
+    if end:
+        bounds["$lte"] = end
+    return {field: bounds} if bounds else {}
+
+async def stream_export_response(
+    pages: AsyncIterator[List[dict]],
+    columns: List[str],
+    output_format: str,
+    name: str
+) -> StreamingResponse:
+    """
+    Stream an export as CSV (row pages as they arrive) or XLSX.
+    
+    As with `stream_orders_response`, the first page is fetched before the
+    response starts so upstream errors are still returned as HTTP errors.
+    A failure later on aborts the download rather than leaving a file that
+    looks complete.
+    """
+    if output_format == "xlsx" and not xlsx_available():
+        raise HTTPException(status_code=501, detail="XLSX export requires the openpyxl package")
+    
+    first_page = await anext(pages, [])
+    
+    async def rows():
+        yield first_page
+        try:
+            async for page in pages:
+                yield page
+        except HTTPException as e:
+            logger.warning("Export of %s interrupted: %s", name, e.detail)
+            raise
+    
+    filename = f"{name}-{datetime.utcnow():%Y%m%d-%H%M%S}.{output_format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if output_format == "xlsx":
+        output = await xlsx_file(rows(), columns, title=name)
+        return StreamingResponse(
+            file_chunks(output),
+            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            headers=headers
+        )
+    return StreamingResponse(csv_chunks(rows(), columns), media_type="text/csv; charset=utf-8", headers=headers)
+
+# Export Routes
+@api_router.get("/orders/export")
+async def export_orders(
+    format: str = Query("csv", pattern="^(csv|xlsx)$"),
+    source: str = Query("mirror", pattern="^(mirror|live)$"),
+    columns: Optional[str] = Query(None, description="Comma-separated column names; all columns by default"),
+    created_at_min: Optional[datetime] = None,
+    created_at_max: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
+    settings = await db.user_settings.find_one({"user_id": current_user.id})
+    if not settings or not settings.get("shopify_url") or not settings.get("shopify_token"):
+        raise HTTPException(status_code=400, detail="Shopify credentials not configured")
+    
+    selected = export_columns(columns, ORDER_EXPORT_COLUMNS)
+    created_at_min, created_at_max = naive_utc(created_at_min), naive_utc(created_at_max)
+    
+    if source == "live":
+        params = {}
+        if created_at_min:
+            params["created_at_min"] = created_at_min.isoformat() + "Z"
+        if created_at_max:
+            params["created_at_max"] = created_at_max.isoformat() + "Z"
+        pages = live_order_pages(settings, SHOPIFY_MAX_PAGE_SIZE, params)
+    else:
+        state, mirror_status = await readable_mirror(current_user.id, settings)
+        if mirror_status == "syncing":
+            # An export of a half-built mirror would look complete but miss orders
+            raise HTTPException(
+                status_code=503,
+                detail="Orders are still being imported from Shopify, try again shortly",
+                headers={"Retry-After": "30"}
+            )
+        cursor = db.shopify_orders.find(
+            {"user_id": current_user.id, **date_range_filter("created_at_ts", created_at_min, created_at_max)},
+            {"_id": 0, **{column: 1 for column in selected}}
+        ).sort("created_at_ts", -1)
+        pages = cursor_pages(cursor)
+    
+    response = await stream_export_response(pages, selected, format, "orders")
+    if source == "mirror":
+        set_mirror_headers(response, state, mirror_status)
+    return response
+
+@api_router.get("/zrexpress/export")
+async def export_dispatches(
+    format: str = Query("csv", pattern="^(csv|xlsx)$"),
+    columns: Optional[str] = Query(None, description="Comma-separated column names; all columns by default"),
+    dispatch_status: Optional[str] = Query(None, alias="status", pattern="^(pending|sent|unknown)$"),
+    created_at_min: Optional[datetime] = None,
+    created_at_max: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
+    selected = export_columns(columns, DISPATCH_EXPORT_COLUMNS)
+    query = {
+        "user_id": current_user.id,
+        **date_range_filter("created_at", naive_utc(created_at_min), naive_utc(created_at_max))
+    }
+    if dispatch_status:
+        query["status"] = dispatch_status
+    
+    cursor = db.dispatches.find(query, {"_id": 0, **{column: 1 for column in selected}}).sort("created_at", -1)
+    return await stream_export_response(cursor_pages(cursor), selected, format, "dispatches")
+
+# Request profiling (admin only)
+request_profiler = RequestProfiler(db.profiling_config, db.request_profiles)
+
+@api_router.get("/admin/profiling")
+async def get_profiling_config(current_admin: User = Depends(get_current_admin_user)):
+    return await request_profiler.config_collection.find_one({"_id": "profiling"}, {"_id": 0}) or {"enabled": False}
+
+@api_router.put("/admin/profiling")
+async def update_profiling_config(config: ProfilingConfig, current_admin: User = Depends(get_current_admin_user)):
+    known_routes = {route.path for route in app.routes}
+    unknown = [route for route in config.routes if route not in known_routes]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown routes: {', '.join(unknown)}")
+    if any(not 0 <= rate <= 1 for rate in config.routes.values()):
+        raise HTTPException(status_code=400, detail="Sample rates must be between 0 and 1")
+    
+    current = await request_profiler.config_collection.find_one({"_id": "profiling"}) or {}
+    document = config.dict(exclude={"header", "duration_minutes"})
+    # Keep an issued token while header triggering stays on, so clients already using it keep working
+    document["header_token"] = (current.get("header_token") or secrets.token_urlsafe(16)) if config.header else None
+    document["expires_at"] = (
+        datetime.utcnow() + timedelta(minutes=config.duration_minutes) if config.duration_minutes else None
+    )
+    document["updated_by"] = current_admin.username
+    return await request_profiler.set_config(document)
+
+@api_router.get("/admin/profiles")
+async def list_request_profiles(
+    route: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    current_admin: User = Depends(get_current_admin_user)
+):
+    query = {"route": route} if route else {}
+    cursor = db.request_profiles.find(query, {"_id": 0, "cprofile": 0}).sort("created_at", -1)
+    return await cursor.to_list(length=limit)
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_request_profile(profile_id: str, current_admin: User = Depends(get_current_admin_user)):
+    profile = await db.request_profiles.find_one({"id": profile_id}, {"_id": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile
+
+# Upstream health (admin only): circuit breakers and Shopify rate limiters, see upstream.py
+@api_router.get("/admin/upstreams")
+async def get_upstream_state(current_admin: User = Depends(get_current_admin_user)):
+    return {"circuit_breakers": circuit_breaker_states(), "shopify_rate_limiters": shopify_limiter_states()}
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# Large list and export responses are compressed when the client accepts it
+COMPRESSED_ROUTES = ["/api/users", "/api/shopify/orders", "/api/orders/export", "/api/zrexpress/export"]
+app.add_middleware(CompressionMiddleware, routes=COMPRESSED_ROUTES)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Mirror-Status", "X-Mirror-Synced-At"],
 )
+app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+app.add_middleware(MetricsMiddleware)
+
+# Prometheus scrape endpoint (outside /api, not in the OpenAPI schema)
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics() -> Response:
+    return metrics_response()
 
 # Configure logging
 logging.basicConfig(
@@ -526,8 +2137,26 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("startup")
 async def startup_event():
+    start_loop_lag_monitor()
+    get_wilaya_resolver()  # build the index before the first order page needs it
+    await open_clients()
+    await ensure_indexes(db)
     await init_admin()
+    zrexpress_queue.start()
+    webhook_writer.start()
+    order_events.start()
+    if SCHEDULER_ENABLED:
+        sync_scheduler.start()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await zrexpress_queue.stop()
+    await webhook_writer.stop()
+    await order_events.stop()
+    await sync_scheduler.stop()
+    for task in list(_initial_syncs.values()):
+        task.cancel()
+    await close_clients()
+    password_executor.shutdown(wait=False)
+    await stop_loop_lag_monitor()
     client.close()
\ No newline at end of file
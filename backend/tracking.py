@@ -0,0 +1,57 @@
+"""
+Tracking number allocation.
+
+Numbers come from a sequence kept in a MongoDB counter document. Each process
+reserves a block of sequence numbers with a single atomic `$inc` and then hands
+them out locally, so issuing a number normally needs no database round trip
+and two uvicorn workers can never issue the same number. Numbers left in a
+block when a process exits are simply skipped.
+"""
+
+import asyncio
+import os
+from typing import List
+
+from pymongo import ReturnDocument
+
+TRACKING_PREFIX = "A7D-"
+TRACKING_BLOCK_SIZE = int(os.environ.get('TRACKING_BLOCK_SIZE', '100'))
+
+
+class TrackingNumberAllocator:
+    def __init__(self, collection, counter: str = "tracking", block_size: int = TRACKING_BLOCK_SIZE, prefix: str = TRACKING_PREFIX):
+        self.collection = collection
+        self.counter = counter
+        self.block_size = block_size
+        self.prefix = prefix
+        self._next = 0
+        self._end = 0  # exclusive
+        self._lock = asyncio.Lock()
+
+    def format(self, sequence: int) -> str:
+        return f"{self.prefix}{sequence:08d}"
+
+    async def _reserve(self, size: int):
+        counter = await self.collection.find_one_and_update(
+            {"_id": self.counter},
+            {"$inc": {"seq": size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._end = counter["seq"] + 1
+        self._next = self._end - size
+
+    async def allocate(self, count: int) -> List[str]:
+        """Return `count` unique tracking numbers, reserving a new block only when the current one runs out."""
+        async with self._lock:
+            sequences = []
+            while len(sequences) < count:
+                if self._next >= self._end:
+                    await self._reserve(max(self.block_size, count - len(sequences)))
+                take = min(count - len(sequences), self._end - self._next)
+                sequences.extend(range(self._next, self._next + take))
+                self._next += take
+        return [self.format(sequence) for sequence in sequences]
+
+    async def next(self) -> str:
+        return (await self.allocate(1))[0]
@@ -0,0 +1,533 @@
+"""
+Shared HTTP client pool for the upstream APIs (Shopify and ZRExpress).
+
+One ``httpx.AsyncClient`` is kept per upstream for the lifetime of the app so
+that connections (and their DNS/TCP/TLS setup) are reused across requests.
+Clients are opened from the FastAPI ``startup`` hook and closed on ``shutdown``.
+Shopify calls are paced per store to stay under its REST API rate limit.
+Every attempt is timed into the upstream metrics (see metrics.py) and the
+profile of the request that made it, if it is being profiled (profiling.py).
+
+Every call goes through the same policy:
+
+- A deadline budget (SHOPIFY_CALL_BUDGET / ZREXPRESS_CALL_BUDGET, or the
+  caller's `budget`) covers the whole call: waiting for a rate limiter or
+  connection slot, every attempt and the pauses between them. Each attempt
+  gets only the time left, so a slow upstream cannot hold a request for
+  longer than the budget.
+- Idempotent calls (GET/HEAD/OPTIONS/PUT/DELETE, or `idempotent=True`) are
+  retried after a transport error or a 502/503/504, up to
+  UPSTREAM_MAX_RETRIES times with full-jitter exponential backoff. A
+  connection that could not be opened is retried for any method, because
+  nothing was sent.
+- A circuit breaker per upstream host opens after UPSTREAM_BREAKER_FAILURES
+  consecutive failures (transport errors and 502/503/504). While it is open,
+  calls fail at once with `UpstreamUnavailable`. After
+  UPSTREAM_BREAKER_COOLDOWN seconds a single probe call is let through; it
+  closes the breaker or opens it again. Shopify breakers are per store, so
+  one store being down does not affect the others.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from metrics import (
+    observe_upstream,
+    observe_upstream_queue,
+    observe_upstream_rejected,
+    observe_upstream_retry,
+    set_upstream_circuits_open,
+)
+from profiling import record_wait
+
+logger = logging.getLogger(__name__)
+
+# Pool configuration
+UPSTREAM_HTTP2 = os.environ.get('UPSTREAM_HTTP2', 'false').lower() in ('1', 'true', 'yes')
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '5'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', '30'))
+UPSTREAM_POOL_TIMEOUT = float(os.environ.get('UPSTREAM_POOL_TIMEOUT', '10'))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get('UPSTREAM_KEEPALIVE_EXPIRY', '60'))
+
+ZREXPRESS_BASE_URL = os.environ.get('ZREXPRESS_BASE_URL', 'https://procolis.com/api_v1').rstrip('/')
+
+# Per-upstream connection limits: (max connections for the pool, max connections per host)
+UPSTREAM_LIMITS = {
+    "shopify": (
+        int(os.environ.get('SHOPIFY_MAX_CONNECTIONS', '100')),
+        int(os.environ.get('SHOPIFY_MAX_CONNECTIONS_PER_HOST', '10')),
+    ),
+    "zrexpress": (
+        int(os.environ.get('ZREXPRESS_MAX_CONNECTIONS', '20')),
+        int(os.environ.get('ZREXPRESS_MAX_CONNECTIONS_PER_HOST', '20')),
+    ),
+}
+
+SHOPIFY_MAX_THROTTLE_RETRIES = int(os.environ.get('SHOPIFY_MAX_THROTTLE_RETRIES', '3'))
+
+# Seconds one call may take in total, retries included
+UPSTREAM_BUDGETS = {
+    "shopify": float(os.environ.get('SHOPIFY_CALL_BUDGET', '15')),
+    "zrexpress": float(os.environ.get('ZREXPRESS_CALL_BUDGET', '20')),
+}
+UPSTREAM_MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', '2'))
+UPSTREAM_RETRY_BASE = float(os.environ.get('UPSTREAM_RETRY_BASE', '0.25'))  # seconds; the backoff ceiling doubles per retry
+UPSTREAM_RETRY_CAP = float(os.environ.get('UPSTREAM_RETRY_CAP', '4'))
+UPSTREAM_BREAKER_FAILURES = int(os.environ.get('UPSTREAM_BREAKER_FAILURES', '5'))  # consecutive failures that open a breaker
+UPSTREAM_BREAKER_COOLDOWN = float(os.environ.get('UPSTREAM_BREAKER_COOLDOWN', '30'))  # seconds before a probe is let through
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUSES = {502, 503, 504}  # also count as breaker failures; other statuses mean the host is up
+
+_clients: Dict[str, httpx.AsyncClient] = {}
+_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+_shopify_limiters: Dict[str, "ShopifyRateLimiter"] = {}
+_breakers: Dict[Tuple[str, str], "CircuitBreaker"] = {}
+
+
+class UpstreamUnavailable(httpx.TransportError):
+    """Raised without calling the upstream while its circuit breaker is open."""
+
+    def __init__(self, message: str, *, request: httpx.Request, retry_after: float):
+        super().__init__(message, request=request)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    """The call's budget ran out before (another) attempt could be sent."""
+
+
+# Failures that guarantee the upstream never received the request, so even non-idempotent calls may be resent
+NOT_SENT_ERRORS = (UpstreamUnavailable, DeadlineExceeded, httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _build_client(upstream: str) -> httpx.AsyncClient:
+    max_connections, _ = UPSTREAM_LIMITS[upstream]
+    http2 = UPSTREAM_HTTP2
+    if http2 and not _http2_available():
+        logger.warning("UPSTREAM_HTTP2 is enabled but the 'h2' package is not installed; using HTTP/1.1")
+        http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            UPSTREAM_READ_TIMEOUT,
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            pool=UPSTREAM_POOL_TIMEOUT,
+        ),
+    )
+
+
+async def open_clients():
+    for upstream in UPSTREAM_LIMITS:
+        if upstream not in _clients:
+            _clients[upstream] = _build_client(upstream)
+
+
+async def close_clients():
+    clients = list(_clients.values())
+    _clients.clear()
+    _host_semaphores.clear()
+    _shopify_limiters.clear()
+    _breakers.clear()
+    for http_client in clients:
+        await http_client.aclose()
+
+
+def get_client(upstream: str) -> httpx.AsyncClient:
+    """Return the pooled client for ``upstream``, creating it lazily if the app was not started."""
+    http_client = _clients.get(upstream)
+    if http_client is None:
+        http_client = _clients[upstream] = _build_client(upstream)
+    return http_client
+
+
+class ShopifyRateLimiter:
+    """
+    Client-side model of one store's Shopify REST leaky bucket.
+
+    The bucket level is re-synchronised from every `X-Shopify-Shop-Api-Call-Limit`
+    header ("used/capacity") and drained at capacity/20 calls per second between
+    responses (2/s for the standard 40-call bucket). Calls wait before they would
+    overflow the bucket minus `headroom`. Concurrency grows by one per response
+    while the bucket is less than half full and halves on a 429, after which
+    the store is paused for its `Retry-After`.
+    """
+
+    def __init__(self, capacity: int = 40, headroom: int = 4, max_concurrency: int = 10, min_concurrency: int = 1):
+        self.capacity = capacity
+        self.leak_rate = capacity / 20
+        self.headroom = headroom
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = max(min_concurrency, max_concurrency // 2)
+        self.level = 0.0
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self._updated = time.monotonic()
+        self._condition = asyncio.Condition()
+
+    def _drain(self, now: float):
+        self.level = max(0.0, self.level - (now - self._updated) * self.leak_rate)
+        self._updated = now
+
+    def _wait_time(self) -> float:
+        now = time.monotonic()
+        self._drain(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= self.concurrency:
+            return 1.0  # woken early by release()
+        overflow = self.level + self.in_flight + 1 - (self.capacity - self.headroom)
+        if overflow > 0:
+            return overflow / self.leak_rate
+        return 0.0
+
+    async def acquire(self):
+        async with self._condition:
+            while True:
+                delay = self._wait_time()
+                if delay <= 0:
+                    self.in_flight += 1
+                    return
+                try:
+                    await asyncio.wait_for(self._condition.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, response: Optional[httpx.Response] = None):
+        async with self._condition:
+            self.in_flight -= 1
+            if response is not None:
+                self._observe(response)
+            self._condition.notify_all()
+
+    def _observe(self, response: httpx.Response):
+        now = time.monotonic()
+        call_limit = response.headers.get("X-Shopify-Shop-Api-Call-Limit")
+        if call_limit:
+            try:
+                used, capacity = (int(part) for part in call_limit.split("/", 1))
+            except ValueError:
+                pass
+            else:
+                self.capacity = capacity
+                self.leak_rate = capacity / 20
+                self.level = float(used)
+                self._updated = now
+
+        if response.status_code == 429:
+            self.throttled += 1
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+            self.blocked_until = max(self.blocked_until, now + retry_after_seconds(response))
+        elif self.level < self.capacity / 2:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    def snapshot(self) -> dict:
+        self._drain(time.monotonic())
+        return {
+            "level": round(self.level, 2),
+            "capacity": self.capacity,
+            "in_flight": self.in_flight,
+            "concurrency": self.concurrency,
+            "throttled": self.throttled,
+        }
+
+
+def retry_after_seconds(response: httpx.Response, default: float = 2.0) -> float:
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", default)))
+    except ValueError:
+        return default
+
+
+def shopify_limiter(host: str) -> ShopifyRateLimiter:
+    limiter = _shopify_limiters.get(host)
+    if limiter is None:
+        _, per_host = UPSTREAM_LIMITS["shopify"]
+        limiter = _shopify_limiters[host] = ShopifyRateLimiter(max_concurrency=per_host)
+    return limiter
+
+
+def shopify_limiter_states() -> Dict[str, dict]:
+    return {host: limiter.snapshot() for host, limiter in _shopify_limiters.items()}
+
+
+class Deadline:
+    def __init__(self, budget: float):
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def timeout(self) -> httpx.Timeout:
+        """httpx timeouts for an attempt: the pool's own, but never past the deadline."""
+        remaining = self.remaining()
+        return httpx.Timeout(
+            min(UPSTREAM_READ_TIMEOUT, remaining),
+            connect=min(UPSTREAM_CONNECT_TIMEOUT, remaining),
+            pool=min(UPSTREAM_POOL_TIMEOUT, remaining),
+        )
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker for one upstream host: closed, open, then half open for a single probe."""
+
+    def __init__(
+        self,
+        upstream: str,
+        failure_threshold: int = UPSTREAM_BREAKER_FAILURES,
+        cooldown: float = UPSTREAM_BREAKER_COOLDOWN,
+    ):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and self.retry_after() <= 0:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+        if self.state != "closed":
+            self.state = "closed"
+            _update_open_circuits(self.upstream)
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.trips += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            _update_open_circuits(self.upstream)
+
+    def abandon(self):
+        """The allowed call ended without reaching the host (deadline, cancellation); free the probe slot."""
+        self.probing = False
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "retry_after": round(self.retry_after(), 1) if self.state != "closed" else 0,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+def circuit_breaker(upstream: str, host: str) -> CircuitBreaker:
+    breaker = _breakers.get((upstream, host))
+    if breaker is None:
+        breaker = _breakers[(upstream, host)] = CircuitBreaker(upstream)
+    return breaker
+
+
+def circuit_breaker_states() -> Dict[str, Dict[str, dict]]:
+    states: Dict[str, Dict[str, dict]] = {upstream: {} for upstream in UPSTREAM_LIMITS}
+    for (upstream, host), breaker in _breakers.items():
+        states[upstream][host] = breaker.snapshot()
+    return states
+
+
+def _update_open_circuits(upstream: str):
+    set_upstream_circuits_open(
+        upstream,
+        sum(1 for (name, _), breaker in _breakers.items() if name == upstream and breaker.state != "closed"),
+    )
+
+
+def backoff_delay(retry: int) -> float:
+    """Full jitter: uniform between 0 and the exponential ceiling for this retry."""
+    return random.uniform(0, min(UPSTREAM_RETRY_CAP, UPSTREAM_RETRY_BASE * 2 ** retry))
+
+
+def _observe_queue(upstream: str, duration: float):
+    observe_upstream_queue(upstream, duration)
+    record_wait(f"upstream_queue:{upstream}", duration)
+
+
+async def _wait_for_slot(upstream: str, acquire, deadline: Deadline, request: httpx.Request):
+    queued = time.perf_counter()
+    try:
+        await asyncio.wait_for(acquire(), timeout=deadline.remaining())
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"Waited the whole {upstream} call budget for a slot", request=request) from None
+    finally:
+        _observe_queue(upstream, time.perf_counter() - queued)
+
+
+async def _send(
+    upstream: str, method: str, url: str, headers: Optional[dict], deadline: Deadline, **kwargs
+) -> httpx.Response:
+    request = httpx.Request(method, url)
+    if deadline.remaining() <= 0:
+        raise DeadlineExceeded(f"{upstream} call budget exhausted", request=request)
+    started = time.perf_counter()
+    status_code = None
+    try:
+        # httpx's timeouts apply per network operation; wait_for caps the attempt as a whole
+        response = await asyncio.wait_for(
+            get_client(upstream).request(method, url, headers=headers, timeout=deadline.timeout(), **kwargs),
+            timeout=deadline.remaining(),
+        )
+        status_code = response.status_code
+        return response
+    except asyncio.TimeoutError:
+        raise httpx.ReadTimeout(f"{upstream} call budget exhausted while waiting for a response", request=request) from None
+    finally:
+        duration = time.perf_counter() - started
+        observe_upstream(upstream, method, status_code, duration)
+        record_wait(f"upstream:{upstream}", duration)
+
+
+async def _shopify_request(
+    host: str, method: str, url: str, headers: Optional[dict], deadline: Deadline, **kwargs
+) -> httpx.Response:
+    limiter = shopify_limiter(host)
+    for attempt in range(SHOPIFY_MAX_THROTTLE_RETRIES + 1):
+        await _wait_for_slot("shopify", limiter.acquire, deadline, httpx.Request(method, url))
+        response = None
+        try:
+            response = await _send("shopify", method, url, headers, deadline, **kwargs)
+        finally:
+            await limiter.release(response)
+        # A 429 was rejected before doing anything, so every method is safe to resend
+        if (
+            response.status_code != 429
+            or attempt == SHOPIFY_MAX_THROTTLE_RETRIES
+            or retry_after_seconds(response) >= deadline.remaining()
+        ):
+            return response
+        logger.info("Shopify throttled %s, retrying after %.1fs", host, retry_after_seconds(response))
+    return response
+
+
+def _host_semaphore(upstream: str, host: str) -> asyncio.Semaphore:
+    key = f"{upstream}:{host}"
+    semaphore = _host_semaphores.get(key)
+    if semaphore is None:
+        _, per_host = UPSTREAM_LIMITS[upstream]
+        semaphore = _host_semaphores[key] = asyncio.Semaphore(per_host)
+    return semaphore
+
+
+async def _attempt(
+    upstream: str, host: str, method: str, url: str, headers: Optional[dict], deadline: Deadline, **kwargs
+) -> httpx.Response:
+    if upstream == "shopify":
+        return await _shopify_request(host, method, url, headers, deadline, **kwargs)
+    semaphore = _host_semaphore(upstream, host)
+    await _wait_for_slot(upstream, semaphore.acquire, deadline, httpx.Request(method, url))
+    try:
+        return await _send(upstream, method, url, headers, deadline, **kwargs)
+    finally:
+        semaphore.release()
+
+
+async def upstream_request(
+    upstream: str,
+    method: str,
+    url: str,
+    *,
+    headers: Optional[dict] = None,
+    budget: Optional[float] = None,
+    idempotent: Optional[bool] = None,
+    **kwargs,
+) -> httpx.Response:
+    """
+    Send a request through the shared pool for ``upstream``, capped per destination host.
+    Shopify calls are additionally paced by the store's rate limiter and retried on 429.
+
+    The whole call, retries included, is limited to ``budget`` seconds (the
+    upstream's default budget when None). ``idempotent`` overrides the
+    method-based decision of whether the call may be retried, e.g. for a
+    read-only POST. Raises an httpx.RequestError when no response could be
+    obtained: `UpstreamUnavailable` while the host's breaker is open,
+    a timeout once the budget runs out.
+    """
+    host = urlsplit(url).netloc
+    deadline = Deadline(UPSTREAM_BUDGETS[upstream] if budget is None else budget)
+    retryable = method.upper() in IDEMPOTENT_METHODS if idempotent is None else idempotent
+    breaker = circuit_breaker(upstream, host)
+    retry = 0
+    while True:
+        if not breaker.allow():
+            observe_upstream_rejected(upstream, "circuit_open")
+            raise UpstreamUnavailable(
+                f"{upstream} host {host} is failing; not calling it for {breaker.retry_after():.0f}s",
+                request=httpx.Request(method, url),
+                retry_after=breaker.retry_after(),
+            )
+        try:
+            response = await _attempt(upstream, host, method, url, headers, deadline, **kwargs)
+        except DeadlineExceeded:
+            breaker.abandon()
+            observe_upstream_rejected(upstream, "deadline")
+            raise
+        except httpx.TransportError as e:
+            breaker.record_failure()
+            if not (retryable or isinstance(e, NOT_SENT_ERRORS)):
+                raise
+            failure: Optional[Exception] = e
+            response = None
+        except BaseException:
+            breaker.abandon()
+            raise
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                breaker.record_success()
+                return response
+            breaker.record_failure()
+            if not retryable:
+                return response
+            failure = None
+
+        delay = backoff_delay(retry)
+        if retry >= UPSTREAM_MAX_RETRIES or delay >= deadline.remaining():
+            if failure is not None:
+                raise failure
+            return response
+        retry += 1
+        observe_upstream_retry(upstream)
+        logger.info("Retrying %s %s %s in %.2fs (retry %d)", upstream, method, host, delay, retry)
+        await asyncio.sleep(delay)
@@ -0,0 +1,181 @@
+"""
+Shopify webhook ingestion.
+
+Each user's store pushes `orders/create` and `orders/updated` to
+/api/webhooks/shopify/{user_id}. The receiver does only the cheap work
+before it acknowledges a delivery:
+
+- verify X-Shopify-Hmac-Sha256 in constant time, with the user's secret
+  cached in-process (`SecretCache`);
+- drop a delivery whose X-Shopify-Webhook-Id this worker has seen recently
+  (`RecentIds`);
+- parse the payload and hand it to a `BufferedWriter`.
+
+The writer flushes batches to MongoDB in the background, every
+WEBHOOK_FLUSH_INTERVAL seconds or once WEBHOOK_BATCH_SIZE deliveries are
+waiting. The flush also records the webhook ids under a unique index, which
+catches duplicates delivered to another worker. When the buffer is full the
+receiver answers 503 and Shopify retries later. Deliveries lost to a failed
+flush are recovered by the periodic delta sync, which keeps running as a
+safety net at a much longer interval.
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', '200'))
+WEBHOOK_FLUSH_INTERVAL = float(os.environ.get('WEBHOOK_FLUSH_INTERVAL', '0.5'))  # seconds a delivery may wait in the buffer
+WEBHOOK_MAX_PENDING = int(os.environ.get('WEBHOOK_MAX_PENDING', '10000'))  # beyond this, deliveries are refused with 503
+WEBHOOK_SEEN_CACHE_SIZE = int(os.environ.get('WEBHOOK_SEEN_CACHE_SIZE', '50000'))
+WEBHOOK_SECRET_CACHE_TTL = float(os.environ.get('WEBHOOK_SECRET_CACHE_TTL', '30'))
+WEBHOOK_SECRET_CACHE_SIZE = int(os.environ.get('WEBHOOK_SECRET_CACHE_SIZE', '10000'))
+
+SHOPIFY_ORDER_TOPICS = {"orders/create", "orders/updated"}
+
+
+def verify_shopify_hmac(body: bytes, secret: Optional[str], signature: Optional[str]) -> bool:
+    """Check X-Shopify-Hmac-Sha256: the base64 HMAC-SHA256 of the raw body, keyed with the app's secret."""
+    if not secret or not signature:
+        return False
+    expected = base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest())
+    return hmac.compare_digest(expected, signature.encode())
+
+
+class RecentIds:
+    """Bounded LRU set of recently accepted delivery ids."""
+
+    def __init__(self, max_size: int = WEBHOOK_SEEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids: OrderedDict = OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        if key in self._ids:
+            self._ids.move_to_end(key)
+            return True
+        return False
+
+    def add(self, key):
+        self._ids[key] = None
+        self._ids.move_to_end(key)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+
+class SecretCache:
+    """
+    In-process TTL cache of per-user webhook secrets, so verifying a delivery
+    needs no database round trip. Settings writes must call `invalidate`;
+    other workers pick the change up once their entry's TTL runs out.
+
+    The webhook route is unauthenticated, so the path's user id cannot be
+    trusted to be real: only users that have a secret are cached, and the
+    cache is a bounded LRU.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[str], Awaitable[Optional[str]]],
+        ttl: float = WEBHOOK_SECRET_CACHE_TTL,
+        max_size: int = WEBHOOK_SECRET_CACHE_SIZE,
+    ):
+        self.load = load
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()  # user_id -> (secret, expires_at)
+
+    async def get(self, user_id: str) -> Optional[str]:
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() < entry[1]:
+            self._entries.move_to_end(user_id)
+            return entry[0]
+        secret = await self.load(user_id)
+        if secret is None:
+            self._entries.pop(user_id, None)
+            return None
+        self._entries[user_id] = (secret, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return secret
+
+    def invalidate(self, user_id: str):
+        self._entries.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class BufferedWriter:
+    """Collects items and passes them to `flush` in batches from a background task."""
+
+    def __init__(
+        self,
+        flush: Callable[[List[dict]], Awaitable[None]],
+        batch_size: int = WEBHOOK_BATCH_SIZE,
+        interval: float = WEBHOOK_FLUSH_INTERVAL,
+        max_pending: int = WEBHOOK_MAX_PENDING,
+    ):
+        self.flush = flush
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: List[dict] = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, item: dict) -> bool:
+        """Buffer an item; False when the buffer is full."""
+        if len(self._pending) >= self.max_pending:
+            return False
+        self._pending.append(item)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and write out whatever is still buffered."""
+        task, self._task = self._task, None
+        if task is not None:
+            # Let the task finish its current flush rather than cancelling it halfway
+            self._stopping = True
+            self._wakeup.set()
+            await task
+            self._stopping = False
+        while self._pending:
+            await self._flush_batch()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._pending:
+                await self._flush_batch()
+
+    async def _flush_batch(self):
+        batch = self._pending[:self.batch_size]
+        del self._pending[:self.batch_size]
+        try:
+            await self.flush(batch)
+        except Exception:
+            logger.exception("Could not write %d buffered webhook deliveries", len(batch))
@@ -0,0 +1,226 @@
+"""
+Wilaya / commune resolution for shipping addresses.
+
+Shopify addresses carry free-text `city` and `province` fields. ZRExpress needs
+the wilaya code (1-58) and a commune. `WilayaResolver` builds an in-memory index
+of every wilaya name (Latin and Arabic, plus common alternative spellings)
+and every commune in the dataset.
+
+Lookups normalise the text: case, accents, Arabic hamza/ta marbuta/alef
+maqsura forms, punctuation and the usual transliteration variants (dj/j,
+ou/u, sh/ch, ...). Exact matches are a single dict lookup. Typos fall back to a
+symmetric-deletion index (one edit for short names, two for longer ones), so
+no lookup scans the whole dataset. Results are cached per (city, province).
+
+The bundled dataset (data/wilayas.json) has all 58 wilayas and their 1,541
+communes with Arabic names, built from the algeria-wilayas-communes package
+(CC0). The wilayas created in the 2025 reform (59-69) are not yet ZRExpress
+codes, so their communes stay under the wilaya they were split from and their
+names are aliases of it. WILAYA_DATASET points at another file of the same
+shape; a commune may be a plain name or an object with `name`, `name_ar` and
+`aliases`.
+"""
+
+import json
+import os
+import re
+import unicodedata
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+WILAYA_DATASET = os.environ.get('WILAYA_DATASET', str(Path(__file__).parent / 'data' / 'wilayas.json'))
+WILAYA_CACHE_SIZE = int(os.environ.get('WILAYA_CACHE_SIZE', '20000'))
+
+# Confidence of a match with typos never reaches that of an exact one
+TYPO_CONFIDENCE_CAP = 0.9
+
+_ARABIC_FOLDING = str.maketrans({"ة": "ه", "ى": "ي", "ـ": None})
+_SEPARATORS = re.compile(r"[\W_]+")
+_PARTS = re.compile(r"[,;/|(){}\[\]]|\s-\s")
+_PROVINCE_CODE = re.compile(r"^(?:dz-?)?(\d{1,2})$", re.IGNORECASE)
+_REPEATED = re.compile(r"(.)\1+")
+_LATIN_SPELLINGS = (("tch", "ch"), ("dj", "j"), ("sh", "ch"), ("ou", "u"), ("w", "u"), ("y", "i"), ("q", "k"), ("ph", "f"))
+_NOISE_WORDS = {"wilaya", "wilayat", "commune", "daira", "province", "ولايه", "بلديه", "دائره"}
+
+
+class Resolution(NamedTuple):
+    id_wilaya: Optional[str]
+    commune: Optional[str]
+    confidence: float
+
+
+UNRESOLVED = Resolution(None, None, 0.0)
+
+# (wilaya id, commune name or None when the key names the wilaya itself)
+Entry = Tuple[str, Optional[str]]
+
+
+def normalize(text: Optional[str]) -> str:
+    """Reduce a place name to its lookup key."""
+    if not text:
+        return ""
+    # NFKD splits accents and Arabic hamza/madda into combining marks, which are dropped with the harakat
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).translate(_ARABIC_FOLDING)
+    words = [word for word in _SEPARATORS.split(text) if word and word not in _NOISE_WORDS]
+    key = "".join(words)
+    for spelling, replacement in _LATIN_SPELLINGS:
+        key = key.replace(spelling, replacement)
+    return _REPEATED.sub(r"\1", key)
+
+
+def _max_distance(key: str) -> int:
+    if len(key) < 4:
+        return 0
+    return 1 if len(key) < 8 else 2
+
+
+def _deletions(key: str, distance: int) -> Set[str]:
+    variants = {key}
+    frontier = {key}
+    for _ in range(distance):
+        frontier = {word[:i] + word[i + 1:] for word in frontier for i in range(len(word))}
+        variants |= frontier
+    return variants
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """Optimal string alignment distance (adjacent transpositions count as one edit), capped at limit + 1."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class WilayaResolver:
+    def __init__(self, wilayas: Dict[str, dict], cache_size: int = WILAYA_CACHE_SIZE):
+        self.wilayas = wilayas
+        self._exact: Dict[str, Set[Entry]] = {}
+        self._deletes: Dict[str, Set[str]] = {}
+        for wilaya_id, wilaya in wilayas.items():
+            for name in [wilaya["name"], wilaya.get("name_ar"), *wilaya.get("aliases", [])]:
+                self._add(name, (wilaya_id, None))
+            for commune in wilaya.get("communes", []):
+                if isinstance(commune, str):
+                    commune = {"name": commune}
+                for name in [commune["name"], commune.get("name_ar"), *commune.get("aliases", [])]:
+                    self._add(name, (wilaya_id, commune["name"]))
+        for key in self._exact:
+            for variant in _deletions(key, _max_distance(key)):
+                self._deletes.setdefault(variant, set()).add(key)
+        self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+
+    @classmethod
+    def from_file(cls, path: str = WILAYA_DATASET) -> "WilayaResolver":
+        with open(path, encoding="utf-8") as dataset:
+            return cls(json.load(dataset))
+
+    def _add(self, name: Optional[str], entry: Entry):
+        key = normalize(name)
+        if key:
+            self._exact.setdefault(key, set()).add(entry)
+
+    def _lookup(self, key: str) -> Tuple[Set[Entry], float]:
+        """Entries for the closest indexed key(s) and the confidence of that match."""
+        entries = self._exact.get(key)
+        if entries:
+            return entries, 1.0
+
+        limit = _max_distance(key)
+        if not limit:
+            return set(), 0.0
+        best, best_distance = set(), limit + 1
+        candidates = set()
+        for variant in _deletions(key, limit):
+            candidates |= self._deletes.get(variant, set())
+        for candidate in candidates:
+            distance = _edit_distance(key, candidate, min(limit, _max_distance(candidate)))
+            if distance < best_distance:
+                best, best_distance = set(self._exact[candidate]), distance
+            elif distance == best_distance:
+                best |= self._exact[candidate]
+        if best_distance > limit:
+            return set(), 0.0
+        return best, min(TYPO_CONFIDENCE_CAP, 1 - best_distance / max(len(key), 4))
+
+    def match(self, text: Optional[str]) -> List[Resolution]:
+        """
+        Candidate wilayas for one place name, one per wilaya.
+        A name shared by several wilayas splits the confidence between them,
+        except that a wilaya's own name wins over a commune of the same name elsewhere.
+        """
+        entries, confidence = self._lookup(normalize(text))
+        if not entries:
+            return []
+        by_wilaya: Dict[str, Optional[str]] = {}
+        named = set()
+        for wilaya_id, commune in sorted(entries, key=lambda entry: (int(entry[0]), entry[1] or "")):
+            if commune is None:
+                named.add(wilaya_id)
+                by_wilaya.setdefault(wilaya_id, None)
+            elif by_wilaya.get(wilaya_id) is None:
+                by_wilaya[wilaya_id] = commune
+        if named:
+            by_wilaya = {wilaya_id: by_wilaya[wilaya_id] for wilaya_id in by_wilaya if wilaya_id in named}
+        share = confidence / len(by_wilaya)
+        return [Resolution(wilaya_id, commune, round(share, 3)) for wilaya_id, commune in by_wilaya.items()]
+
+    def _province(self, province: Optional[str]) -> Optional[Resolution]:
+        if not province:
+            return None
+        code = _PROVINCE_CODE.match(province.strip())
+        if code and str(int(code.group(1))) in self.wilayas:
+            return Resolution(str(int(code.group(1))), None, 1.0)
+        matches = [match for part in _PARTS.split(province) for match in self.match(part)]
+        return max(matches, key=lambda match: match.confidence, default=None)
+
+    def _resolve(self, city: Optional[str], province: Optional[str] = None) -> Resolution:
+        wilaya = self._province(province)
+        matches = [match for part in _PARTS.split(city or "") for match in self.match(part)]
+
+        if wilaya is None:
+            if not matches:
+                return UNRESOLVED
+            # A commune and its wilaya written together ("Hydra, Alger") reinforce each other
+            best = max(matches, key=lambda match: match.confidence)
+            support = [m for m in matches if m.id_wilaya == best.id_wilaya and m is not best]
+            confidence = best.confidence
+            for other in support:
+                confidence = 1 - (1 - confidence) * (1 - other.confidence)
+            commune = best.commune or next((m.commune for m in support if m.commune), None)
+            return Resolution(best.id_wilaya, commune, round(confidence, 3))
+
+        consistent = [match for match in matches if match.id_wilaya == wilaya.id_wilaya]
+        if consistent:
+            best = max(consistent, key=lambda match: (match.commune is not None, match.confidence))
+            confidence = 1 - (1 - wilaya.confidence) * (1 - best.confidence)
+            return Resolution(wilaya.id_wilaya, best.commune, round(confidence, 3))
+        # The city is unknown, or names a place in another wilaya: trust the province, less so on a conflict
+        return Resolution(wilaya.id_wilaya, None, round(wilaya.confidence * (0.7 if matches else 0.9), 3))
+
+    def resolve_many(self, places: Iterable[Tuple[Optional[str], Optional[str]]]) -> List[Resolution]:
+        """Resolve (city, province) pairs, e.g. for a whole page of orders."""
+        resolve = self.resolve
+        return [resolve(city, province) for city, province in places]
+
+
+_resolver: Optional[WilayaResolver] = None
+
+
+def get_wilaya_resolver() -> WilayaResolver:
+    """The process-wide resolver, built from WILAYA_DATASET on first use (the app builds it at startup)."""
+    global _resolver
+    if _resolver is None:
+        _resolver = WilayaResolver.from_file()
+    return _resolver
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Order transformation micro-benchmark.
+
+Compares the original per-row mapping (a Pydantic `ShopifyOrder` per Shopify
+order, one dict at a time per colis; reproduced below) against the batch stage
+in transforms.py, on synthetic batches. Prints the best-of-N wall time per
+size as JSON.
+
+Note that the batch colis mapping also normalises phone numbers and validates
+totals, which the original loop did not do.
+
+Usage: python benchmarks/bench_order_transforms.py [--sizes 1000 10000 100000] [--repeat 3]
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+import transforms  # noqa: E402
+
+FIRST_NAMES = ["Ahmed", "Yacine", "Amina", "Sara", "Karim", "Nour", "Mohamed", "Lina"]
+LAST_NAMES = ["Benali", "Haddad", "Mansouri", "Bouzid", "Saidi", "Cherif", None]
+CITIES = ["Alger", "Oran", "Constantine", "Blida", "Sétif", "Annaba", "Tlemcen", "Béjaïa"]
+
+
+def shopify_payload(index: int) -> dict:
+    rng = random.Random(index)
+    return {
+        "id": 5000000000 + index,
+        "order_number": 1000 + index,
+        "customer": {
+            "first_name": rng.choice(FIRST_NAMES),
+            "last_name": rng.choice(LAST_NAMES),
+            "phone": rng.choice(["+213 5%08d" % rng.randrange(10**8), "05%08d" % rng.randrange(10**8), ""]),
+            "email": f"customer{index}@example.com",
+        },
+        "shipping_address": {
+            "address1": f"{rng.randrange(1, 200)} Rue Didouche Mourad",
+            "address2": rng.choice(["", "Bâtiment B"]),
+            "city": rng.choice(CITIES),
+            "phone": "0555%06d" % rng.randrange(10**6),
+        },
+        "total_price": "%d.%02d" % (rng.randrange(500, 20000), rng.randrange(100)),
+        "financial_status": rng.choice(["paid", "pending"]),
+        "created_at": "2024-05-01T10:00:00+01:00",
+        "line_items": [
+            {"name": f"Produit {rng.randrange(50)}", "quantity": rng.randrange(1, 3), "price": "1200.00"}
+            for _ in range(rng.randrange(1, 4))
+        ],
+    }
+
+
+def editable_order(record: dict, index: int) -> server.EditableOrder:
+    return server.EditableOrder(
+        shopify_id=record["id"],
+        customer_name=record["customer_name"],
+        customer_phone=record["customer_phone"],
+        shipping_address=record["shipping_address"],
+        city=record["city"],
+        total_price=record["total_price"],
+        status=record["status"],
+        tracking=f"A7D-{index:08d}",
+        items=record["items"],
+    )
+
+
+def best_of(repeat, function, *args):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def loop_shopify(payloads):
+    orders = []
+    for order in payloads:
+        shipping_address = order.get("shipping_address", {})
+        line_items = [
+            {
+                "name": item.get("name", ""),
+                "quantity": item.get("quantity", 0),
+                "price": item.get("price", "0")
+            }
+            for item in order.get("line_items", [])
+        ]
+        orders.append(server.ShopifyOrder(
+            id=str(order.get("id", "")),
+            order_number=str(order.get("order_number", "")),
+            customer_name=f"{order.get('customer', {}).get('first_name', '')} {order.get('customer', {}).get('last_name', '')}".strip(),
+            customer_phone=order.get("customer", {}).get("phone", "") or shipping_address.get("phone", ""),
+            customer_email=order.get("customer", {}).get("email", ""),
+            shipping_address=f"{shipping_address.get('address1', '')} {shipping_address.get('address2', '')}".strip(),
+            city=shipping_address.get("city", ""),
+            total_price=str(order.get("total_price", "0")),
+            status=order.get("financial_status", "pending"),
+            created_at=order.get("created_at", ""),
+            items=line_items
+        ).model_dump())
+    return orders
+
+
+def loop_colis(orders):
+    return [
+        {
+            "Tracking": order.tracking,
+            "TypeLivraison": "0",
+            "TypeColis": "0",
+            "Confrimee": "",
+            "Client": order.customer_name,
+            "MobileA": order.customer_phone,
+            "MobileB": "",
+            "Adresse": order.shipping_address,
+            "IDWilaya": order.id_wilaya,
+            "Commune": order.city,
+            "Total": str(int(float(order.total_price) * 100)),
+            "Note": f"Order #{order.shopify_id}",
+            "TProduit": ", ".join([item.get("name", "") for item in order.items]),
+            "id_Externe": order.shopify_id,
+            "Source": "A7delivery"
+        }
+        for order in orders
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        payloads = [shopify_payload(index) for index in range(size)]
+        editable = [
+            editable_order(record, index)
+            for index, record in enumerate(transforms.shopify_order_records(payloads))
+        ]
+
+        shopify_loop = best_of(args.repeat, loop_shopify, payloads)
+        shopify_batch = best_of(args.repeat, transforms.shopify_order_records, payloads)
+        colis_loop = best_of(args.repeat, loop_colis, editable)
+        colis_batch = best_of(args.repeat, transforms.zrexpress_colis_records, editable)
+
+        results.append({
+            "orders": size,
+            "shopify_to_order_ms": {
+                "loop": round(shopify_loop * 1000, 1),
+                "batch": round(shopify_batch * 1000, 1),
+                "speedup": round(shopify_loop / shopify_batch, 2),
+            },
+            "order_to_colis_ms": {
+                "loop": round(colis_loop * 1000, 1),
+                "batch": round(colis_batch * 1000, 1),
+                "speedup": round(colis_loop / colis_batch, 2),
+            },
+        })
+
+    print(json.dumps(results, indent=2))
+    server.password_executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Password hashing benchmark.
+
+Runs a burst of concurrent bcrypt verifications the way `login` does, once
+inline on the event loop (the old behaviour) and once through the server's
+password worker pool, while a probe coroutine measures how long an unrelated
+request would wait for the loop. Prints login throughput and probe latency
+percentiles for both modes as JSON.
+
+Usage: python benchmarks/bench_password_hashing.py [--logins 40] [--concurrency 20]
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+PASSWORD = "benchmark-password"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def inline_verify(plain, hashed):
+    return server.verify_password(plain, hashed)
+
+
+async def run(verify, hashed, logins, concurrency, probe_interval):
+    semaphore = asyncio.Semaphore(concurrency)
+    probe_latencies = []
+    done = asyncio.Event()
+
+    async def login():
+        async with semaphore:
+            assert await verify(PASSWORD, hashed)
+
+    async def probe():
+        # Stand-in for a cheap concurrent request: how late does the loop wake us up?
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(probe_interval)
+            probe_latencies.append((time.perf_counter() - started - probe_interval) * 1000)
+
+    probe_task = asyncio.create_task(probe())
+    started = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await probe_task
+
+    return {
+        "logins": logins,
+        "elapsed_s": round(elapsed, 3),
+        "logins_per_s": round(logins / elapsed, 2),
+        "probe_samples": len(probe_latencies),
+        "probe_delay_ms": {
+            "p50": round(percentile(probe_latencies, 50), 2),
+            "p95": round(percentile(probe_latencies, 95), 2),
+            "p99": round(percentile(probe_latencies, 99), 2),
+            "max": round(max(probe_latencies, default=0.0), 2),
+            "mean": round(statistics.fmean(probe_latencies), 2) if probe_latencies else 0.0,
+        },
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--probe-interval-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    hashed = server.get_password_hash(PASSWORD)
+    probe_interval = args.probe_interval_ms / 1000
+
+    results = {
+        "password_hash_workers": server.PASSWORD_HASH_WORKERS,
+        "before_inline": await run(inline_verify, hashed, args.logins, args.concurrency, probe_interval),
+        "after_worker_pool": await run(server.verify_password_async, hashed, args.logins, args.concurrency, probe_interval),
+    }
+    print(json.dumps(results, indent=2))
+    server.password_executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
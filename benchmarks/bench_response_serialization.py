@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Order list serialisation and compression benchmark.
+
+Serialises synthetic mirror order lists three ways:
+
+- response_model: FastAPI's default path for a route returning the list
+  (validate against List[ShopifyOrder], dump to plain Python, stdlib json);
+- per_order: the previous streaming body, one stdlib `json.dumps` per order;
+- fast: responses.dumps once per 250-order page, as the order list now does.
+
+It then compresses the body the way CompressionMiddleware does (one chunk per
+page, flushed after each) with gzip and, when installed, brotli.
+Prints best-of-N CPU milliseconds and sizes per list length as JSON.
+
+Usage: python benchmarks/bench_response_serialization.py [--sizes 250 5000] [--repeat 5]
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from pydantic import TypeAdapter  # noqa: E402
+
+import compression  # noqa: E402
+import responses  # noqa: E402
+import server  # noqa: E402
+from fake_upstreams import generate_shopify_orders  # noqa: E402
+from transforms import shopify_order_records  # noqa: E402
+
+PAGE_SIZE = 250
+
+order_list = TypeAdapter(List[server.ShopifyOrder])
+
+
+def response_model_body(orders: list) -> bytes:
+    value = order_list.validate_python(orders)
+    content = order_list.dump_python(value, mode="json")
+    # starlette's JSONResponse.render
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def per_order_chunks(orders: list) -> List[bytes]:
+    pages = [orders[i:i + PAGE_SIZE] for i in range(0, len(orders), PAGE_SIZE)]
+    chunks = [b"["]
+    separator = ""
+    for page in pages:
+        chunks.append((separator + ",".join(json.dumps(order) for order in page)).encode("utf-8"))
+        separator = ","
+    chunks.append(b"]")
+    return chunks
+
+
+def fast_chunks(orders: list) -> List[bytes]:
+    pages = [orders[i:i + PAGE_SIZE] for i in range(0, len(orders), PAGE_SIZE)]
+    chunks = [b"["]
+    separator = b""
+    for page in pages:
+        chunks.append(separator + responses.dumps(page)[1:-1])
+        separator = b","
+    chunks.append(b"]")
+    return chunks
+
+
+def compress_chunks(chunks: List[bytes], encoding: str) -> bytes:
+    encoder = compression._Encoder(encoding)
+    output = [encoder._compress(chunk, finish=False) for chunk in chunks]
+    output.append(encoder._compress(b"", finish=True))
+    return b"".join(output)
+
+
+def cpu_ms(function, *args, repeat: int):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = time.process_time()
+        result = function(*args)
+        best = min(best, time.process_time() - started)
+    return round(best * 1000, 2), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[250, 5000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    report = {"json_backend": responses.json_backend(), "encodings": compression.available_encodings(), "sizes": {}}
+    for size in args.sizes:
+        orders = shopify_order_records(generate_shopify_orders(size))
+        # What the mirror query returns
+        orders = [{field: order.get(field) for field in server.ShopifyOrder.model_fields} for order in orders]
+
+        default_ms, default_body = cpu_ms(response_model_body, orders, repeat=args.repeat)
+        per_order_ms, _ = cpu_ms(per_order_chunks, orders, repeat=args.repeat)
+        fast_ms, chunks = cpu_ms(fast_chunks, orders, repeat=args.repeat)
+        body = b"".join(chunks)
+        assert json.loads(body) == json.loads(default_body)
+
+        result = {
+            "serialize_cpu_ms": {"response_model": default_ms, "per_order": per_order_ms, "fast": fast_ms},
+            "speedup_vs_response_model": round(default_ms / fast_ms, 1) if fast_ms else None,
+            "bytes": {"identity": len(body)},
+            "compress_cpu_ms": {},
+        }
+        for encoding in compression.available_encodings():
+            compress_ms, compressed = cpu_ms(compress_chunks, chunks, encoding, repeat=args.repeat)
+            result["bytes"][encoding] = len(compressed)
+            result["compress_cpu_ms"][encoding] = compress_ms
+        report["sizes"][size] = result
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
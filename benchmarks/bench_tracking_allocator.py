@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Tracking number allocator load test.
+
+Starts several processes (standing in for uvicorn workers), each running many
+concurrent coroutines that draw tracking numbers from its own
+TrackingNumberAllocator against the same MongoDB counter. Verifies that no
+number was issued twice and prints throughput as JSON. Exits non-zero on a
+collision.
+
+Uses MONGO_URL / DB_NAME from backend/.env unless overridden; the counter
+document used is separate from the production one.
+
+Usage: python benchmarks/bench_tracking_allocator.py [--processes 4] [--tasks 50] [--per-task 200]
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+from dotenv import load_dotenv  # noqa: E402
+from motor.motor_asyncio import AsyncIOMotorClient  # noqa: E402
+
+from tracking import TrackingNumberAllocator  # noqa: E402
+
+load_dotenv(BACKEND_DIR / ".env")
+COUNTER = "tracking-benchmark"
+
+
+async def draw(tasks, per_task, block_size):
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    allocator = TrackingNumberAllocator(client[os.environ["DB_NAME"]].counters, counter=COUNTER, block_size=block_size)
+
+    async def task():
+        numbers = []
+        for _ in range(per_task):
+            numbers.append(await allocator.next())
+        return numbers
+
+    try:
+        batches = await asyncio.gather(*(task() for _ in range(tasks)))
+    finally:
+        client.close()
+    return [number for batch in batches for number in batch]
+
+
+def worker(args):
+    tasks, per_task, block_size = args
+    return asyncio.run(draw(tasks, per_task, block_size))
+
+
+async def reset_counter():
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    await client[os.environ["DB_NAME"]].counters.delete_one({"_id": COUNTER})
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--tasks", type=int, default=50)
+    parser.add_argument("--per-task", type=int, default=200)
+    parser.add_argument("--block-size", type=int, default=100)
+    args = parser.parse_args()
+
+    asyncio.run(reset_counter())
+
+    started = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        batches = pool.map(worker, [(args.tasks, args.per_task, args.block_size)] * args.processes)
+    elapsed = time.perf_counter() - started
+
+    numbers = [number for batch in batches for number in batch]
+    duplicates = len(numbers) - len(set(numbers))
+    print(json.dumps({
+        "processes": args.processes,
+        "issued": len(numbers),
+        "duplicates": duplicates,
+        "block_size": args.block_size,
+        "counter_round_trips_max": len(numbers) // args.block_size + args.processes,
+        "elapsed_s": round(elapsed, 3),
+        "numbers_per_s": round(len(numbers) / elapsed, 1),
+    }, indent=2))
+
+    asyncio.run(reset_counter())
+    sys.exit(1 if duplicates else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Wilaya resolver micro-benchmark.
+
+Builds the resolver from the configured dataset and resolves synthetic city
+strings: exact names, accent/case variants, Arabic names and one-letter typos.
+Reports index build time and cold (uncached) and warm (cached) resolutions
+per second as JSON.
+
+Usage: python benchmarks/bench_wilaya_resolver.py [--cities 50000]
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+import unicodedata
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from wilayas import WilayaResolver  # noqa: E402
+
+
+def strip_accents(text: str) -> str:
+    return "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+
+
+def typo(text: str, rng: random.Random) -> str:
+    if len(text) < 5:
+        return text
+    i = rng.randrange(1, len(text) - 1)
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+def synthetic_cities(resolver: WilayaResolver, count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    names = []
+    for wilaya in resolver.wilayas.values():
+        names.append(wilaya["name"])
+        names.append(wilaya["name_ar"])
+        names.extend(commune if isinstance(commune, str) else commune["name"] for commune in wilaya["communes"])
+    variants = [lambda n: n, str.lower, str.upper, strip_accents, lambda n: typo(n, rng)]
+    return [(rng.choice(variants)(rng.choice(names)), None) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cities", type=int, default=50000)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    resolver = WilayaResolver.from_file()
+    build = time.perf_counter() - started
+
+    places = synthetic_cities(resolver, args.cities)
+    started = time.perf_counter()
+    results = resolver.resolve_many(places)
+    cold = time.perf_counter() - started
+    started = time.perf_counter()
+    resolver.resolve_many(places)
+    warm = time.perf_counter() - started
+
+    print(json.dumps({
+        "cities": len(places),
+        "build_ms": round(build * 1000, 1),
+        "cold_per_s": round(len(places) / cold),
+        "warm_per_s": round(len(places) / warm),
+        "resolved": sum(1 for result in results if result.id_wilaya),
+        "distinct_inputs": len(set(places)),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
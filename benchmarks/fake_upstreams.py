@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the ZRExpress (procolis.com) and Shopify Admin REST APIs.
+
+Point the backend at them with ZREXPRESS_BASE_URL=http://127.0.0.1:9001/api_v1
+and, for Shopify, SHOPIFY_URL_SCHEME=http plus a store URL of 127.0.0.1:9002
+in the user's settings. Latency and error rate are configurable so workers,
+retries and timeouts can be exercised without touching the real services.
+
+The Shopify stand-in serves a fixed set of generated orders with `page_info`
+cursor pagination (`Link: rel="next"`), the created_at/updated_at filters the
+backend uses, and a leaky-bucket rate limit reported through
+`X-Shopify-Shop-Api-Call-Limit` (429 with `Retry-After` when full).
+
+Usage:
+    python benchmarks/fake_upstreams.py zrexpress [--port 9001] [--latency-ms 50] [--error-rate 0.0]
+    python benchmarks/fake_upstreams.py shopify [--port 9002] [--orders 1000] [--bucket-size 40]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+class UpstreamBehaviour:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    async def delay(self):
+        latency = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+def create_zrexpress_app(behaviour: UpstreamBehaviour) -> FastAPI:
+    app = FastAPI(title="Fake ZRExpress")
+    app.state.colis = {}
+
+    @app.get("/api_v1/token")
+    async def token(request: Request):
+        await behaviour.delay()
+        if not request.headers.get("token") or not request.headers.get("key"):
+            return JSONResponse({"Statut": "Accès refusé"}, status_code=401)
+        return {"Statut": "Accès activé"}
+
+    @app.post("/api_v1/add_colis")
+    async def add_colis(request: Request):
+        await behaviour.delay()
+        if behaviour.should_fail():
+            return JSONResponse({"error": "Service temporarily unavailable"}, status_code=503)
+
+        body = await request.json()
+        results = []
+        for colis in body.get("Colis", []):
+            if not colis.get("Client") or not colis.get("IDWilaya"):
+                message = "Champs obligatoires manquants"
+            else:
+                message = "Good"
+                app.state.colis[colis["Tracking"]] = {**colis, "Situation": "En préparation"}
+            results.append({"Tracking": colis.get("Tracking"), "MessageRetour": message})
+        return {"Colis": results}
+
+    @app.post("/api_v1/lire")
+    async def lire(request: Request):
+        await behaviour.delay()
+        if behaviour.should_fail():
+            return JSONResponse({"error": "Service temporarily unavailable"}, status_code=503)
+
+        body = await request.json()
+        results = []
+        for item in body.get("Colis", []):
+            colis = app.state.colis.get(item.get("Tracking"))
+            if colis is None:
+                continue
+            # Each lookup may move a parcel one step further along its route
+            step = SITUATIONS.index(colis["Situation"])
+            if step < len(SITUATIONS) - 1 and random.random() < 0.5:
+                colis["Situation"] = SITUATIONS[step + 1]
+            results.append({"Tracking": item["Tracking"], "Situation": colis["Situation"]})
+        return {"Colis": results}
+
+    return app
+
+
+SITUATIONS = ["En préparation", "Expédié", "En livraison", "Livré"]
+
+
+FIRST_NAMES = ["Ahmed", "Yacine", "Amina", "Sara", "Karim", "Nour", "Mohamed", "Lina"]
+LAST_NAMES = ["Benali", "Haddad", "Mansouri", "Bouzid", "Saidi", "Cherif"]
+CITIES = ["Alger", "Oran", "Constantine", "Blida", "Sétif", "Annaba", "Tlemcen", "Béjaïa"]
+
+
+def shopify_timestamp(value: datetime) -> str:
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def generate_shopify_orders(count: int, seed: int = 0) -> list:
+    """Deterministic orders, one per minute going back from now (newest last)."""
+    rng = random.Random(seed)
+    start = datetime.utcnow().replace(microsecond=0) - timedelta(minutes=count)
+    orders = []
+    for index in range(count):
+        created_at = start + timedelta(minutes=index)
+        orders.append({
+            "id": 5000000000 + index,
+            "order_number": 1001 + index,
+            "customer": {
+                "first_name": rng.choice(FIRST_NAMES),
+                "last_name": rng.choice(LAST_NAMES),
+                "phone": "+213 5%08d" % rng.randrange(10**8),
+                "email": f"customer{index}@example.com",
+            },
+            "shipping_address": {
+                "address1": f"{rng.randrange(1, 200)} Rue Didouche Mourad",
+                "address2": "",
+                "city": rng.choice(CITIES),
+                "phone": "0555%06d" % rng.randrange(10**6),
+            },
+            "total_price": "%d.00" % rng.randrange(500, 20000),
+            "financial_status": rng.choice(["paid", "pending"]),
+            "created_at": shopify_timestamp(created_at),
+            "updated_at": shopify_timestamp(created_at + timedelta(seconds=rng.randrange(60))),
+            "line_items": [
+                {"name": f"Produit {rng.randrange(50)}", "quantity": rng.randrange(1, 3), "price": "1200.00"}
+                for _ in range(rng.randrange(1, 4))
+            ],
+        })
+    return orders
+
+
+class LeakyBucket:
+    """Shopify's REST limit: `size` calls, draining at `leak_rate` calls per second."""
+
+    def __init__(self, size: int = 40, leak_rate: float = 2.0):
+        self.size = size
+        self.leak_rate = leak_rate
+        self.level = 0.0
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self.updated) * self.leak_rate)
+        self.updated = now
+        if self.level + 1 > self.size:
+            return False
+        self.level += 1
+        return True
+
+    def header(self) -> str:
+        return f"{math.ceil(self.level)}/{self.size}"
+
+
+def _encode_page_info(state: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state).encode()).decode()
+
+
+def _decode_page_info(page_info: str) -> dict:
+    return json.loads(base64.urlsafe_b64decode(page_info.encode()))
+
+
+def create_shopify_app(
+    behaviour: UpstreamBehaviour,
+    order_count: int = 1000,
+    bucket_size: int = 40,
+    leak_rate: float = 2.0
+) -> FastAPI:
+    app = FastAPI(title="Fake Shopify")
+    app.state.orders = generate_shopify_orders(order_count)
+    buckets = {}
+
+    def limited(request: Request):
+        bucket = buckets.setdefault(request.headers.get("X-Shopify-Access-Token"), LeakyBucket(bucket_size, leak_rate))
+        if not bucket.take():
+            return bucket, JSONResponse(
+                {"errors": "Exceeded 2 calls per second for api client. Reduce request rates to resume uninterrupted service."},
+                status_code=429,
+                headers={"Retry-After": "1.0", "X-Shopify-Shop-Api-Call-Limit": bucket.header()},
+            )
+        return bucket, None
+
+    @app.get("/admin/api/{version}/orders.json")
+    async def orders(version: str, request: Request):
+        if not request.headers.get("X-Shopify-Access-Token"):
+            return JSONResponse({"errors": "[API] Invalid API key or access token"}, status_code=401)
+        bucket, throttled = limited(request)
+        if throttled:
+            return throttled
+        await behaviour.delay()
+        if behaviour.should_fail():
+            return JSONResponse({"errors": "Internal Server Error"}, status_code=503)
+
+        params = request.query_params
+        limit = min(int(params.get("limit", 50)), 250)
+        if "page_info" in params:
+            # Shopify only accepts limit alongside page_info; the filters travel inside the cursor
+            state = _decode_page_info(params["page_info"])
+        else:
+            state = {
+                "offset": 0,
+                "updated_at_min": params.get("updated_at_min"),
+                "created_at_min": params.get("created_at_min"),
+                "created_at_max": params.get("created_at_max"),
+                "ascending": params.get("order", "created_at desc").endswith("asc"),
+                "sort_key": params.get("order", "created_at desc").split()[0],
+            }
+
+        def timestamp(value):
+            # All generated timestamps are UTC with a Z suffix; normalise the filter values likewise
+            return shopify_timestamp(datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None))
+
+        matching = app.state.orders
+        if state["updated_at_min"]:
+            matching = [o for o in matching if o["updated_at"] >= timestamp(state["updated_at_min"])]
+        if state["created_at_min"]:
+            matching = [o for o in matching if o["created_at"] >= timestamp(state["created_at_min"])]
+        if state["created_at_max"]:
+            matching = [o for o in matching if o["created_at"] <= timestamp(state["created_at_max"])]
+        matching = sorted(matching, key=lambda o: o[state["sort_key"]], reverse=not state["ascending"])
+
+        offset = state["offset"]
+        headers = {"X-Shopify-Shop-Api-Call-Limit": bucket.header()}
+        if offset + limit < len(matching):
+            page_info = _encode_page_info({**state, "offset": offset + limit})
+            next_url = f"{request.url.scheme}://{request.url.netloc}{request.url.path}?limit={limit}&page_info={page_info}"
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return JSONResponse({"orders": matching[offset:offset + limit]}, headers=headers)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("service", choices=["zrexpress", "shopify"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="default: 9001 for zrexpress, 9002 for shopify")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--orders", type=int, default=1000, help="shopify: number of orders in the store")
+    parser.add_argument("--bucket-size", type=int, default=40, help="shopify: leaky bucket size per access token")
+    parser.add_argument("--leak-rate", type=float, default=2.0, help="shopify: calls per second drained from the bucket")
+    args = parser.parse_args()
+
+    behaviour = UpstreamBehaviour(args.latency_ms, args.jitter_ms, args.error_rate)
+    if args.service == "shopify":
+        app = create_shopify_app(behaviour, args.orders, args.bucket_size, args.leak_rate)
+        port = args.port or 9002
+    else:
+        app = create_zrexpress_app(behaviour)
+        port = args.port or 9001
+    uvicorn.run(app, host=args.host, port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test.
+
+Starts the local Shopify and ZRExpress stand-ins (fake_upstreams.py) and
+`uvicorn server:app` against a throwaway database on a local MongoDB. It then
+drives concurrent load through one scenario at a time:
+
+    login     POST /api/auth/login
+    settings  GET  /api/settings
+    orders    GET  /api/shopify/orders           (served from the mirror)
+    send      POST /api/zrexpress/send           (--send-batch new orders per request)
+
+Each scenario runs for --duration seconds with --concurrency clients.
+Throughput and p50/p95/p99 latency per endpoint are printed as JSON (and
+written to --output). With --baseline, the run is compared against an earlier
+report and the script exits 1 if any endpoint's p95 latency or throughput
+regressed by more than --max-regression.
+
+The bench users and their settings are created through the API as the admin
+user, so no fixtures are needed. The database is dropped afterwards unless
+--keep-db is given.
+
+Usage:
+    python benchmarks/load_test.py [--scenarios login settings orders send] [--concurrency 20] [--duration 10]
+                                   [--shopify-latency-ms 100] [--zrexpress-latency-ms 150] [--zrexpress-error-rate 0.05]
+                                   [--output report.json] [--baseline previous.json]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+from dotenv import load_dotenv
+
+BENCH_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCH_DIR.parent / "backend"
+
+load_dotenv(BACKEND_DIR / ".env")
+
+# The admin account init_admin() creates on startup
+ADMIN_USERNAME = os.environ.get("LOAD_TEST_ADMIN_USERNAME", "A7JMILO")
+ADMIN_PASSWORD = os.environ.get(
+    "LOAD_TEST_ADMIN_PASSWORD",
+    "436b0bc9005add01239a43435d502d197a647de839285829215bdd04a21de/RAOUF@20006",
+)
+BENCH_PASSWORD = "load-test-password"
+SCENARIOS = ["login", "settings", "orders", "send"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_process(args, cwd, env=None) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, *args], cwd=cwd, env={**os.environ, **(env or {})})
+
+
+async def wait_until_up(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as http:
+        while True:
+            try:
+                await http.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+                await asyncio.sleep(0.2)
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed: float) -> dict:
+    latencies = sorted(latency for latency, _ in samples)
+    statuses = {}
+    for _, status_code in samples:
+        statuses[str(status_code)] = statuses.get(str(status_code), 0) + 1
+    errors = sum(count for status_code, count in statuses.items() if not status_code.startswith("2"))
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        "statuses": statuses,
+    }
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.users = []  # (username, token)
+        self.order_ids = itertools.count(1)
+
+    async def setup(self, http: httpx.AsyncClient, shopify_host: str):
+        response = await http.post("/api/auth/login", json={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD})
+        response.raise_for_status()
+        admin = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        for index in range(self.args.users):
+            username = f"loadtest{index}"
+            response = await http.post("/api/users", headers=admin, json={"username": username, "password": BENCH_PASSWORD})
+            response.raise_for_status()
+            response = await http.post("/api/auth/login", json={"username": username, "password": BENCH_PASSWORD})
+            response.raise_for_status()
+            token = response.json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            response = await http.put("/api/settings", headers=headers, json={
+                "shopify_url": shopify_host,
+                "shopify_token": f"shpat_loadtest{index}",
+                "zrexpress_token": "loadtest",
+                "zrexpress_key": "loadtest",
+            })
+            response.raise_for_status()
+            # Fill the order mirror up front so the orders scenario measures steady-state reads
+            response = await http.get("/api/shopify/orders", headers=headers, params={"refresh": "true"})
+            response.raise_for_status()
+            self.users.append((username, token))
+
+    def send_payload(self) -> list:
+        orders = []
+        for _ in range(self.args.send_batch):
+            order_id = next(self.order_ids)
+            orders.append({
+                "shopify_id": f"lt-{os.getpid()}-{order_id}",
+                "customer_name": f"Client {order_id}",
+                "customer_phone": "0555123456",
+                "shipping_address": "12 Rue Didouche Mourad",
+                "city": "Alger",
+                "total_price": "2500.00",
+                "status": "paid",
+                "id_wilaya": "16",
+                "items": [{"name": "Produit", "quantity": 1, "price": "2500.00"}],
+            })
+        return orders
+
+    async def request(self, http: httpx.AsyncClient, scenario: str, user) -> int:
+        username, token = user
+        headers = {"Authorization": f"Bearer {token}"}
+        if scenario == "login":
+            response = await http.post("/api/auth/login", json={"username": username, "password": BENCH_PASSWORD})
+        elif scenario == "settings":
+            response = await http.get("/api/settings", headers=headers)
+        elif scenario == "orders":
+            response = await http.get("/api/shopify/orders", headers=headers)
+        else:
+            response = await http.post("/api/zrexpress/send", headers=headers, json=self.send_payload())
+        await response.aread()
+        return response.status_code
+
+    async def run_scenario(self, http: httpx.AsyncClient, scenario: str) -> dict:
+        samples = []
+        users = itertools.cycle(self.users)
+        deadline = time.monotonic() + self.args.duration
+
+        async def client():
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    status_code = await self.request(http, scenario, next(users))
+                except httpx.TransportError as e:
+                    status_code = type(e).__name__
+                samples.append((time.perf_counter() - started, status_code))
+
+        started = time.monotonic()
+        await asyncio.gather(*(client() for _ in range(self.args.concurrency)))
+        return summarize(samples, time.monotonic() - started)
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> list:
+    regressions = []
+    for scenario, current in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(scenario)
+        if not previous:
+            continue
+        if previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{scenario}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current["throughput_rps"] < previous["throughput_rps"] * (1 - max_regression):
+            regressions.append(f"{scenario}: throughput {previous['throughput_rps']} -> {current['throughput_rps']} req/s")
+    return regressions
+
+
+async def drop_database(mongo_url: str, db_name: str):
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=5000)
+    try:
+        await client.drop_database(db_name)
+    finally:
+        client.close()
+
+
+async def run(args) -> dict:
+    shopify_port, zrexpress_port, server_port = free_port(), free_port(), free_port()
+    db_name = args.db_name or f"a7delivery_loadtest_{os.getpid()}"
+    processes = []
+    try:
+        processes.append(start_process([
+            "fake_upstreams.py", "shopify", "--port", str(shopify_port),
+            "--orders", str(args.orders),
+            "--latency-ms", str(args.shopify_latency_ms),
+            "--error-rate", str(args.shopify_error_rate),
+        ], cwd=BENCH_DIR))
+        processes.append(start_process([
+            "fake_upstreams.py", "zrexpress", "--port", str(zrexpress_port),
+            "--latency-ms", str(args.zrexpress_latency_ms),
+            "--error-rate", str(args.zrexpress_error_rate),
+        ], cwd=BENCH_DIR))
+        processes.append(start_process([
+            "-m", "uvicorn", "server:app",
+            "--host", "127.0.0.1", "--port", str(server_port),
+            "--workers", str(args.workers), "--log-level", "warning",
+        ], cwd=BACKEND_DIR, env={
+            "MONGO_URL": args.mongo_url,
+            "DB_NAME": db_name,
+            "SHOPIFY_URL_SCHEME": "http",
+            "ZREXPRESS_BASE_URL": f"http://127.0.0.1:{zrexpress_port}/api_v1",
+        }))
+
+        base_url = f"http://127.0.0.1:{server_port}"
+        await asyncio.gather(
+            wait_until_up(f"http://127.0.0.1:{shopify_port}/docs"),
+            wait_until_up(f"http://127.0.0.1:{zrexpress_port}/docs"),
+            wait_until_up(f"{base_url}/docs"),
+        )
+
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60.0) as http:
+            load_test = LoadTest(args)
+            await load_test.setup(http, f"127.0.0.1:{shopify_port}")
+            endpoints = {}
+            for scenario in args.scenarios:
+                endpoints[scenario] = await load_test.run_scenario(http, scenario)
+                print(f"{scenario}: {json.dumps(endpoints[scenario])}", file=sys.stderr)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if not args.keep_db:
+            try:
+                await drop_database(args.mongo_url, db_name)
+            except Exception as e:
+                print(f"Could not drop {db_name}: {e}", file=sys.stderr)
+
+    return {
+        "config": {
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "users": args.users,
+            "workers": args.workers,
+            "orders": args.orders,
+            "send_batch": args.send_batch,
+            "shopify_latency_ms": args.shopify_latency_ms,
+            "shopify_error_rate": args.shopify_error_rate,
+            "zrexpress_latency_ms": args.zrexpress_latency_ms,
+            "zrexpress_error_rate": args.zrexpress_error_rate,
+        },
+        "endpoints": endpoints,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--orders", type=int, default=1000, help="orders in the fake Shopify store")
+    parser.add_argument("--send-batch", type=int, default=5, help="orders per /api/zrexpress/send request")
+    parser.add_argument("--shopify-latency-ms", type=float, default=100.0)
+    parser.add_argument("--shopify-error-rate", type=float, default=0.0)
+    parser.add_argument("--zrexpress-latency-ms", type=float, default=150.0)
+    parser.add_argument("--zrexpress-error-rate", type=float, default=0.0)
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", help="default: a throwaway a7delivery_loadtest_<pid> database")
+    parser.add_argument("--keep-db", action="store_true")
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--baseline", type=Path, help="earlier report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed relative p95/throughput regression")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        args.output.write_text(output + "\n")
+
+    if args.baseline:
+        regressions = compare(report, json.loads(args.baseline.read_text()), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,10 @@ import './App.css';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+// Same default as the server's WILAYA_MIN_CONFIDENCE: below it a resolved wilaya is only a guess
+const WILAYA_MIN_CONFIDENCE = 0.75;
+// Delay before reopening the live order stream after it drops
+const STREAM_RETRY_MS = 3000;
 
 // Auth Context
 const AuthContext = createContext();
@@ -83,6 +87,28 @@ const apiCall = async (endpoint, options = {}) => {
   return response.json();
 };
 
+// Download an export endpoint as a file (the Authorization header rules out a plain link)
+const downloadExport = async (endpoint) => {
+  const token = localStorage.getItem('token');
+  const response = await fetch(`${API}${endpoint}`, {
+    headers: token ? { Authorization: `Bearer ${token}` } : {},
+  });
+
+  if (!response.ok) {
+    const error = await response.json();
+    throw new Error(error.detail || 'حدث خطأ');
+  }
+
+  const disposition = response.headers.get('Content-Disposition') || '';
+  const match = disposition.match(/filename="([^"]+)"/);
+  const url = URL.createObjectURL(await response.blob());
+  const link = document.createElement('a');
+  link.href = url;
+  link.download = match ? match[1] : 'export.csv';
+  link.click();
+  URL.revokeObjectURL(url);
+};
+
 // Flash Delivery inspired Login Component
 const LoginForm = () => {
   const [formData, setFormData] = useState({ username: '', password: '' });
@@ -191,6 +217,7 @@ const Sidebar = ({ onNavigate, currentPage }) => {
 
   const navigation = [
     { id: 'orders', label: 'الطلبات', icon: '📦', color: 'orange' },
+    { id: 'shipments', label: 'تتبع الشحنات', icon: '🚚', color: 'purple' },
     { id: 'settings', label: 'الإعدادات', icon: '⚙️', color: 'blue' },
   ];
 
@@ -273,6 +300,7 @@ const OrdersPage = () => {
   const [loading, setLoading] = useState(false);
   const [editingOrder, setEditingOrder] = useState(null);
   const [sendingOrders, setSendingOrders] = useState(false);
+  const [exporting, setExporting] = useState(false);
 
   const fetchOrders = async () => {
     setLoading(true);
@@ -285,6 +313,64 @@ const OrdersPage = () => {
     setLoading(false);
   };
 
+  // Live order changes pushed by the server (webhooks and syncs); no need to click refresh
+  useEffect(() => {
+    if (!localStorage.getItem('token') || typeof EventSource === 'undefined') return;
+
+    let source = null;
+    let retryTimer = null;
+    let stopped = false;
+    let connectedBefore = false;
+
+    const retry = () => {
+      if (!stopped) retryTimer = setTimeout(connect, STREAM_RETRY_MS);
+    };
+
+    // Each connection needs a new single-use ticket, so reconnect here instead of letting EventSource retry
+    const connect = async () => {
+      let ticket;
+      try {
+        ({ ticket } = await apiCall('/events/ticket', { method: 'POST' }));
+      } catch (error) {
+        retry();
+        return;
+      }
+      if (stopped) return;
+      source = new EventSource(`${API}/events/orders?ticket=${encodeURIComponent(ticket)}`);
+
+      source.onopen = () => {
+        // Changes made while disconnected were not pushed; reload the list once back
+        if (connectedBefore) {
+          apiCall('/shopify/orders').then(setOrders).catch(() => {});
+        }
+        connectedBefore = true;
+      };
+
+      source.onerror = () => {
+        source.close();
+        retry();
+      };
+
+      source.addEventListener('orders', (event) => {
+        const changed = JSON.parse(event.data);
+        setOrders(prev => {
+          const byId = new Map(changed.map(order => [order.id, order]));
+          const updated = prev.map(order => byId.has(order.id) ? { ...order, ...byId.get(order.id) } : order);
+          const known = new Set(prev.map(order => order.id));
+          const added = changed.filter(order => !known.has(order.id));
+          return [...added, ...updated];
+        });
+      });
+    };
+
+    connect();
+    return () => {
+      stopped = true;
+      clearTimeout(retryTimer);
+      if (source) source.close();
+    };
+  }, []);
+
   const handleSelectAll = () => {
     if (selectedOrders.length === orders.length) {
       setSelectedOrders([]);
@@ -311,31 +397,62 @@ const OrdersPage = () => {
     try {
       const ordersToSend = orders
         .filter(order => selectedOrders.includes(order.id))
-        .map(order => ({
-          shopify_id: order.id,
-          customer_name: order.customer_name,
-          customer_phone: order.customer_phone,
-          shipping_address: order.shipping_address,
-          city: order.city,
-          total_price: order.total_price,
-          status: order.status,
-          id_wilaya: "31", // Default Algiers
-          items: order.items
-        }));
-
-      const response = await apiCall('/zrexpress/send', {
+        .map(order => {
+          // Guesses are left to the server, which resolves the city again with its own threshold and fallback
+          const located = order.id_wilaya && order.location_confidence >= WILAYA_MIN_CONFIDENCE;
+          return {
+            shopify_id: order.id,
+            customer_name: order.customer_name,
+            customer_phone: order.customer_phone,
+            shipping_address: order.shipping_address,
+            city: (located && order.commune) || order.city,
+            total_price: order.total_price,
+            status: order.status,
+            id_wilaya: located ? order.id_wilaya : null,
+            location_confidence: located ? order.location_confidence : null,
+            items: order.items
+          };
+        });
+
+      const { job_id } = await apiCall('/zrexpress/jobs', {
         method: 'POST',
         body: JSON.stringify(ordersToSend)
       });
 
-      alert(`تم إرسال ${selectedOrders.length} طلب بنجاح إلى ZRExpress`);
-      setSelectedOrders([]);
+      // The batch is sent in the background; poll the job until it settles
+      let job;
+      do {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        job = await apiCall(`/zrexpress/jobs/${job_id}`);
+      } while (job.status === 'queued' || job.status === 'running');
+
+      // Keep the orders that did not go through selected so they can be fixed and re-sent
+      const notSent = ordersToSend
+        .map((order, index) => ({ shopify_id: order.shopify_id, result: job.results[index] }))
+        .filter(({ result }) => !result || result.status !== 'accepted');
+      if (notSent.length > 0) {
+        alert(`تم إرسال ${job.progress.accepted} طلب إلى ZRExpress، وفشل ${notSent.length} طلب:\n` +
+          notSent.map(({ shopify_id, result }) => `#${shopify_id}: ${result ? result.message : job.last_error}`).join('\n'));
+      } else {
+        alert(`تم إرسال ${job.progress.accepted} طلب بنجاح إلى ZRExpress`);
+      }
+      setSelectedOrders(notSent.map(({ shopify_id }) => shopify_id));
     } catch (error) {
       alert('فشل في إرسال الطلبات: ' + error.message);
     }
     setSendingOrders(false);
   };
 
+  const handleExport = async (endpoint) => {
+    setExporting(true);
+    try {
+      await downloadExport(endpoint);
+    } catch (error) {
+      alert('فشل في التصدير: ' + error.message);
+    }
+    setExporting(false);
+  };
+
   const headerActions = (
     <div className="header-action-group">
       <button
@@ -346,6 +463,22 @@ const OrdersPage = () => {
         <span className="button-icon">🔄</span>
         {loading ? 'جارٍ التحديث...' : 'تحديث من Shopify'}
       </button>
+      <button
+        onClick={() => handleExport('/orders/export')}
+        disabled={exporting}
+        className="action-button secondary"
+      >
+        <span className="button-icon">📄</span>
+        تصدير الطلبات CSV
+      </button>
+      <button
+        onClick={() => handleExport('/zrexpress/export')}
+        disabled={exporting}
+        className="action-button secondary"
+      >
+        <span className="button-icon">🚚</span>
+        تصدير الشحنات CSV
+      </button>
       {selectedOrders.length > 0 && (
         <button
           onClick={handleSendToZRExpress}
@@ -426,7 +559,12 @@ const OrdersPage = () => {
                     <td className="order-number">#{order.order_number}</td>
                     <td className="customer-name">{order.customer_name}</td>
                     <td className="customer-phone">{order.customer_phone || 'غير محدد'}</td>
-                    <td className="shipping-address">{order.shipping_address}, {order.city}</td>
+                    <td className="shipping-address">
+                      {order.shipping_address}, {order.city}
+                      {order.id_wilaya
+                        ? ` (${order.id_wilaya}${order.location_confidence < WILAYA_MIN_CONFIDENCE ? ' ؟' : ''})`
+                        : ' (ولاية غير معروفة)'}
+                    </td>
                     <td className="total-price">{order.total_price} د.ج</td>
                     <td>
                       <span className={`status-badge status-${order.status}`}>
@@ -456,6 +594,7 @@ const SettingsPage = () => {
   const [settings, setSettings] = useState({
     shopify_url: '',
     shopify_token: '',
+    shopify_webhook_secret: '',
     zrexpress_token: '',
     zrexpress_key: ''
   });
@@ -552,6 +691,27 @@ const SettingsPage = () => {
                 className="form-input"
               />
             </div>
+            <div className="form-group">
+              <label className="form-label">Webhook Secret (اختياري)</label>
+              <input
+                type="password"
+                placeholder="سر توقيع الـ Webhooks من إعدادات التطبيق"
+                value={settings.shopify_webhook_secret || ''}
+                onChange={(e) => setSettings({ ...settings, shopify_webhook_secret: e.target.value })}
+                className="form-input"
+              />
+            </div>
+            {settings.user_id && (
+              <div className="form-group">
+                <label className="form-label">رابط Webhook (orders/create و orders/updated)</label>
+                <input
+                  type="text"
+                  value={`${API}/webhooks/shopify/${settings.user_id}`}
+                  readOnly
+                  className="form-input"
+                />
+              </div>
+            )}
           </div>
         </div>
 
@@ -726,19 +886,58 @@ const UserModal = ({ user, isOpen, onClose, onSave, title }) => {
 
 const UsersPage = () => {
   const [users, setUsers] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [counts, setCounts] = useState({ total: 0, active: 0, expired: 0, inactive: 0 });
   const [loading, setLoading] = useState(false);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [modalData, setModalData] = useState({ isOpen: false, user: null, title: '' });
+  const [search, setSearch] = useState('');
+  const [statusFilter, setStatusFilter] = useState('');
 
   useEffect(() => {
-    fetchUsers();
-  }, []);
+    // Wait for the admin to stop typing before searching
+    const timer = setTimeout(refreshUsers, 300);
+    return () => clearTimeout(timer);
+  }, [search, statusFilter]);
+
+  const refreshUsers = () => {
+    fetchUsers(null);
+    fetchCounts();
+  };
+
+  // One page at a time; the stats cards come from /users/counts, not from the loaded pages
+  const fetchUsers = async (cursor) => {
+    const token = localStorage.getItem('token');
+    const params = new URLSearchParams();
+    if (search.trim()) params.set('q', search.trim());
+    if (statusFilter) params.set('status', statusFilter);
+    if (cursor) params.set('cursor', cursor);
 
-  const fetchUsers = async () => {
+    setLoadingMore(true);
     try {
-      const data = await apiCall('/users');
-      setUsers(data);
+      const response = await fetch(`${API}/users?${params.toString()}`, {
+        headers: token ? { Authorization: `Bearer ${token}` } : {},
+      });
+      if (!response.ok) {
+        const error = await response.json();
+        throw new Error(error.detail || 'حدث خطأ');
+      }
+      const data = await response.json();
+      setUsers(cursor ? (previous) => previous.concat(data) : data);
+      setNextCursor(response.headers.get('X-Next-Cursor'));
     } catch (error) {
       console.error('Failed to fetch users:', error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  const fetchCounts = async () => {
+    const query = search.trim() ? `?q=${encodeURIComponent(search.trim())}` : '';
+    try {
+      setCounts(await apiCall(`/users/counts${query}`));
+    } catch (error) {
+      console.error('Failed to fetch user counts:', error);
     }
   };
 
@@ -773,7 +972,7 @@ const UsersPage = () => {
       }
       
       setModalData({ isOpen: false, user: null, title: '' });
-      fetchUsers();
+      refreshUsers();
     } catch (error) {
       alert('فشل في حفظ بيانات المستخدم: ' + error.message);
     }
@@ -785,7 +984,7 @@ const UsersPage = () => {
 
     try {
       await apiCall(`/users/${userId}`, { method: 'DELETE' });
-      fetchUsers();
+      refreshUsers();
       alert('تم حذف المستخدم بنجاح');
     } catch (error) {
       alert('فشل في حذف المستخدم: ' + error.message);
@@ -810,6 +1009,23 @@ const UsersPage = () => {
 
   const headerActions = (
     <div className="header-action-group">
+      <input
+        type="text"
+        value={search}
+        onChange={(e) => setSearch(e.target.value)}
+        className="form-input"
+        placeholder="بحث باسم المستخدم"
+      />
+      <select
+        value={statusFilter}
+        onChange={(e) => setStatusFilter(e.target.value)}
+        className="form-input"
+      >
+        <option value="">كل الحالات</option>
+        <option value="active">نشط</option>
+        <option value="expired">منتهي الصالحية</option>
+        <option value="inactive">معطل</option>
+      </select>
       <button
         onClick={handleAddUser}
         className="action-button primary"
@@ -820,19 +1036,15 @@ const UsersPage = () => {
     </div>
   );
 
-  const activeUsers = users.filter(u => u.is_active && (!u.expiry_date || new Date(u.expiry_date) > new Date()));
-  const expiredUsers = users.filter(u => u.expiry_date && new Date(u.expiry_date) <= new Date());
-  const inactiveUsers = users.filter(u => !u.is_active);
-
   return (
     <div className="page-content">
       <Header title="إدارة المستخدمين" actions={headerActions} />
 
       <div className="stats-grid">
-        <StatsCard icon="👥" title="إجمالي المستخدمين" value={users.length} color="purple" />
-        <StatsCard icon="✅" title="مستخدمين نشطين" value={activeUsers.length} color="green" />
-        <StatsCard icon="⏰" title="منتهية الصالحية" value={expiredUsers.length} color="orange" />
-        <StatsCard icon="🔴" title="حسابات معطلة" value={inactiveUsers.length} color="red" />
+        <StatsCard icon="👥" title="إجمالي المستخدمين" value={counts.total} color="purple" />
+        <StatsCard icon="✅" title="مستخدمين نشطين" value={counts.active} color="green" />
+        <StatsCard icon="⏰" title="منتهية الصالحية" value={counts.expired} color="orange" />
+        <StatsCard icon="🔴" title="حسابات معطلة" value={counts.inactive} color="red" />
       </div>
 
       <div className="users-table-container">
@@ -898,6 +1110,16 @@ const UsersPage = () => {
         </div>
       </div>
 
+      {nextCursor && (
+        <button
+          onClick={() => fetchUsers(nextCursor)}
+          disabled={loadingMore}
+          className="action-button secondary"
+        >
+          {loadingMore ? 'جاري التحميل...' : 'عرض المزيد'}
+        </button>
+      )}
+
       <UserModal
         user={modalData.user}
         isOpen={modalData.isOpen}
@@ -909,6 +1131,134 @@ const UsersPage = () => {
   );
 };
 
+const SHIPMENT_STATES = {
+  pending: { label: 'قيد التحضير', color: 'yellow', icon: '🕐' },
+  in_transit: { label: 'في الطريق', color: 'blue', icon: '🚚' },
+  delivered: { label: 'تم التسليم', color: 'green', icon: '✅' },
+  returned: { label: 'مرتجع', color: 'red', icon: '↩️' },
+  cancelled: { label: 'ملغى', color: 'red', icon: '❌' },
+};
+
+const ShipmentsPage = () => {
+  const [shipments, setShipments] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loading, setLoading] = useState(false);
+  const [search, setSearch] = useState('');
+  const [stateFilter, setStateFilter] = useState('');
+
+  useEffect(() => {
+    // Wait for the user to stop typing before searching
+    const timer = setTimeout(() => fetchShipments(null), 300);
+    return () => clearTimeout(timer);
+  }, [search, stateFilter]);
+
+  // One page at a time: the list grows with every parcel ever sent
+  const fetchShipments = async (cursor) => {
+    const token = localStorage.getItem('token');
+    const params = new URLSearchParams();
+    if (search.trim()) params.set('tracking', search.trim());
+    if (stateFilter) params.set('state', stateFilter);
+    if (cursor) params.set('cursor', cursor);
+
+    setLoading(true);
+    try {
+      const response = await fetch(`${API}/shipments?${params.toString()}`, {
+        headers: token ? { Authorization: `Bearer ${token}` } : {},
+      });
+      if (!response.ok) {
+        const error = await response.json();
+        throw new Error(error.detail || 'حدث خطأ');
+      }
+      const data = await response.json();
+      setShipments(cursor ? (previous) => previous.concat(data) : data);
+      setNextCursor(response.headers.get('X-Next-Cursor'));
+    } catch (error) {
+      console.error('Failed to fetch shipments:', error);
+    } finally {
+      setLoading(false);
+    }
+  };
+
+  const headerActions = (
+    <div className="header-action-group">
+      <input
+        type="text"
+        value={search}
+        onChange={(e) => setSearch(e.target.value)}
+        className="form-input"
+        placeholder="رقم التتبع أو رقم الطلب"
+      />
+      <select
+        value={stateFilter}
+        onChange={(e) => setStateFilter(e.target.value)}
+        className="form-input"
+      >
+        <option value="">كل الحالات</option>
+        <option value="open">قيد التوصيل</option>
+        {Object.entries(SHIPMENT_STATES).map(([state, info]) => (
+          <option key={state} value={state}>{info.label}</option>
+        ))}
+      </select>
+    </div>
+  );
+
+  return (
+    <div className="page-content">
+      <Header title="تتبع الشحنات" actions={headerActions} />
+
+      <div className="users-table-container">
+        <div className="flash-table">
+          <table className="users-table">
+            <thead>
+              <tr>
+                <th>رقم التتبع</th>
+                <th>رقم الطلب</th>
+                <th>الحالة</th>
+                <th>حالة ZRExpress</th>
+                <th>تاريخ الإرسال</th>
+                <th>آخر تحديث</th>
+              </tr>
+            </thead>
+            <tbody>
+              {shipments.map((shipment) => {
+                const stateInfo = SHIPMENT_STATES[shipment.state] || SHIPMENT_STATES.pending;
+                return (
+                  <tr key={shipment.tracking}>
+                    <td className="username">{shipment.tracking}</td>
+                    <td>{shipment.id_externe}</td>
+                    <td>
+                      <span className={`status-badge status-${stateInfo.color}`}>
+                        {stateInfo.icon} {stateInfo.label}
+                      </span>
+                    </td>
+                    <td>{shipment.status || '-'}</td>
+                    <td className="created-date">
+                      {new Date(shipment.created_at).toLocaleDateString('ar-SA')}
+                    </td>
+                    <td className="created-date">
+                      {new Date(shipment.checked_at).toLocaleString('ar-SA')}
+                    </td>
+                  </tr>
+                );
+              })}
+            </tbody>
+          </table>
+        </div>
+      </div>
+
+      {nextCursor && (
+        <button
+          onClick={() => fetchShipments(nextCursor)}
+          disabled={loading}
+          className="action-button secondary"
+        >
+          {loading ? 'جاري التحميل...' : 'عرض المزيد'}
+        </button>
+      )}
+    </div>
+  );
+};
+
 const Dashboard = () => {
   const [currentPage, setCurrentPage] = useState('orders');
 
@@ -916,6 +1266,8 @@ const Dashboard = () => {
     switch (currentPage) {
       case 'orders':
         return <OrdersPage />;
+      case 'shipments':
+        return <ShipmentsPage />;
       case 'settings':
         return <SettingsPage />;
       case 'users':
@@ -0,0 +1,89 @@
+import json
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# The backend modules import each other flat, as they do when uvicorn runs from backend/
+sys.path.insert(0, str(ROOT / "backend"))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+# server.py reads these at import; the `backend` fixture swaps its database for mongomock
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "a7delivery_test")
+os.environ.setdefault("SCHEDULER_ENABLED", "false")
+
+
+class ZRExpressTransport(httpx.ASGITransport):
+    """
+    Routes ZRExpress calls to the fake app and records them as (endpoint, trackings).
+
+    Setting `lose` makes the next add_colis call time out: "request" before it
+    reaches ZRExpress, "answer" after ZRExpress created the parcels.
+    """
+
+    def __init__(self, app):
+        super().__init__(app=app)
+        self.calls = []
+        self.lose = None
+
+    def sent(self, endpoint: str) -> list:
+        return [trackings for called, trackings in self.calls if called == endpoint]
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = request.url.path.rsplit("/", 1)[-1]
+        self.calls.append((endpoint, [item["Tracking"] for item in json.loads(request.content)["Colis"]]))
+        lose = None
+        if endpoint == "add_colis":
+            lose, self.lose = self.lose, None
+        if lose == "request":
+            raise httpx.ReadTimeout("timed out", request=request)
+        response = await super().handle_async_request(request)
+        if lose == "answer":
+            raise httpx.ReadTimeout("timed out", request=request)
+        return response
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    """server.py on a fresh mongomock database, with ZRExpress calls going to the fake app."""
+    from mongomock_motor import AsyncMongoMockClient
+
+    import server
+    import upstream
+    from fake_upstreams import UpstreamBehaviour, create_zrexpress_app
+    from job_queue import JobQueue
+    from tracking import TrackingNumberAllocator
+
+    db = AsyncMongoMockClient()[os.environ["DB_NAME"]]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "tracking_allocator", TrackingNumberAllocator(db.counters))
+    monkeypatch.setattr(server, "auth_cache", server.AuthCache(ttl=0, max_size=0))
+    # The profiling middleware holds this object, and reads its config on every request
+    monkeypatch.setattr(server.request_profiler, "config_collection", db.profiling_config)
+    monkeypatch.setattr(server.request_profiler, "profiles_collection", db.request_profiles)
+    queue = JobQueue(db.zrexpress_jobs, server.run_zrexpress_job, workers=1, poll_interval=0.01, retry_backoff=0.01)
+    monkeypatch.setattr(server, "zrexpress_queue", queue)
+
+    behaviour = UpstreamBehaviour()
+    zrexpress = create_zrexpress_app(behaviour)
+    transport = ZRExpressTransport(zrexpress)
+    # Per-host state from other tests is bound to their event loops
+    monkeypatch.setattr(upstream, "_clients", {"zrexpress": httpx.AsyncClient(transport=transport)})
+    monkeypatch.setattr(upstream, "_host_semaphores", {})
+    monkeypatch.setattr(upstream, "_breakers", {})
+
+    return SimpleNamespace(
+        server=server,
+        db=db,
+        queue=queue,
+        behaviour=behaviour,
+        zrexpress=zrexpress,
+        transport=transport,
+        settings={"zrexpress_token": "token", "zrexpress_key": "key"},
+    )
@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+from mongomock_motor import AsyncMongoMockClient
+
+from etags import VersionCounter
+from server import AuthCache
+
+USER = {"id": "user-1", "username": "shop", "is_active": True}
+
+
+def test_get_and_set():
+    cache = AuthCache(ttl=30, max_size=10)
+    assert cache.get("token") is None
+    cache.set("token", USER)
+    assert cache.get("token") == USER
+
+
+def test_entries_expire():
+    cache = AuthCache(ttl=0.05, max_size=10)
+    cache.set("token", USER)
+    time.sleep(0.06)
+    assert cache.get("token") is None
+
+
+def test_entries_never_outlive_the_token():
+    cache = AuthCache(ttl=30, max_size=10)
+    cache.set("expired", USER, token_exp=time.time() - 1)
+    assert cache.get("expired") is None
+    cache.set("expiring", USER, token_exp=time.time() + 0.05)
+    assert cache.get("expiring") == USER
+    time.sleep(0.06)
+    assert cache.get("expiring") is None
+
+
+def test_least_recently_used_is_evicted():
+    cache = AuthCache(ttl=30, max_size=2)
+    cache.set("a", USER)
+    cache.set("b", USER)
+    cache.get("a")
+    cache.set("c", USER)
+    assert cache.get("a") == USER
+    assert cache.get("b") is None
+    assert cache.get("c") == USER
+
+
+def test_disabled():
+    cache = AuthCache(ttl=0, max_size=10)
+    cache.set("token", USER)
+    assert cache.get("token") is None
+
+
+def test_invalidate_user():
+    cache = AuthCache(ttl=30, max_size=10)
+    cache.set("a", USER)
+    cache.set("b", {**USER, "id": "user-2"})
+    cache.invalidate_user("user-1")
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+
+
+def test_lookup_racing_an_invalidation_is_not_cached():
+    cache = AuthCache(ttl=30, max_size=10)
+    generation = cache.generation
+    cache.invalidate_user("user-1")  # written while the lookup was reading the old record
+    cache.set("token", USER, generation=generation)
+    assert cache.get("token") is None
+
+
+def test_version_change_clears_the_cache():
+    async def scenario():
+        version = VersionCounter(AsyncMongoMockClient()["test"]["counters"], "users_version")
+        cache = AuthCache(ttl=30, max_size=10, version=version, version_check_interval=0)
+        await cache.check_version()
+        cache.set("token", USER)
+
+        await cache.check_version()
+        assert cache.get("token") == USER
+
+        await version.bump()  # another worker wrote a user
+        await cache.check_version()
+        assert cache.get("token") is None
+
+    asyncio.run(scenario())
+
+
+def test_version_is_read_at_most_once_per_interval():
+    async def scenario():
+        version = VersionCounter(AsyncMongoMockClient()["test"]["counters"], "users_version")
+        cache = AuthCache(ttl=30, max_size=10, version=version, version_check_interval=60)
+        await cache.check_version()
+        cache.set("token", USER)
+
+        await version.bump()
+        await cache.check_version()
+        assert cache.get("token") == USER
+
+    asyncio.run(scenario())
@@ -0,0 +1,35 @@
+import pytest
+
+import compression
+from compression import negotiate
+
+
+@pytest.fixture
+def without_brotli(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("identity", None),
+    ("gzip", "gzip"),
+    ("GZIP, deflate", "gzip"),
+    ("gzip;q=0", None),
+    ("gzip;q=0.5, br", "gzip"),
+    ("*", "gzip"),
+    ("*, gzip;q=0", None),
+    ("gzip;q=bogus", None),
+])
+def test_negotiate_gzip(without_brotli, header, expected):
+    assert negotiate(header) == expected
+
+
+@pytest.mark.skipif(compression.brotli is None, reason="brotli is not installed")
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, br", "br"),
+    ("gzip, br;q=0", "gzip"),
+    ("*", "br"),
+])
+def test_negotiate_prefers_brotli(header, expected):
+    assert negotiate(header) == expected
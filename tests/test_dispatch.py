@@ -0,0 +1,221 @@
+"""
+Sending orders to ZRExpress through the dispatch ledger and Idempotency-Key,
+against mongomock and the fake ZRExpress from benchmarks/fake_upstreams.py.
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+
+from indexes import ensure_indexes
+
+
+def order(shopify_id: str, **fields) -> dict:
+    return {
+        "shopify_id": shopify_id,
+        "customer_name": "Ahmed Benali",
+        "customer_phone": "0555123456",
+        "shipping_address": "12 rue Larbi Ben M'hidi",
+        "city": "Oran",
+        "total_price": "2500",
+        "status": "paid",
+        "items": [],
+        **fields,
+    }
+
+
+async def dispatch(backend, *shopify_ids, job_id=None):
+    orders = [backend.server.EditableOrder(**order(shopify_id)) for shopify_id in shopify_ids]
+    return await backend.server.dispatch_to_zrexpress(backend.settings, "user-1", orders, job_id=job_id)
+
+
+async def ledger(backend) -> dict:
+    return {
+        entry["id_externe"]: entry
+        async for entry in backend.db.dispatches.find({"user_id": "user-1"})
+    }
+
+
+async def abandoned_row(backend, shopify_id: str, tracking: str, age: float, job_id=None):
+    """A pending ledger row left `age` seconds ago by a send that never finished."""
+    server = backend.server
+    sending = server.EditableOrder(**order(shopify_id, tracking=tracking))
+    started = datetime.utcnow() - timedelta(seconds=age)
+    await backend.db.dispatches.insert_one(server.dispatch_ledger_entry("user-1", sending, started, job_id))
+
+
+def test_second_send_reports_the_existing_parcels(backend):
+    async def scenario():
+        await ensure_indexes(backend.db)
+        first = await dispatch(backend, "1", "2")
+        second = await dispatch(backend, "1", "2")
+
+        assert [(result.status, result.message) for result in first] == [("accepted", "Good")] * 2
+        assert [(result.status, result.message) for result in second] == [("accepted", "Already dispatched")] * 2
+        assert [result.tracking for result in second] == [result.tracking for result in first]
+        assert backend.transport.sent("add_colis") == [[result.tracking for result in first]]
+        assert len(backend.zrexpress.state.colis) == 2
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_sends_create_one_parcel_per_order(backend):
+    async def scenario():
+        await ensure_indexes(backend.db)
+        backend.behaviour.latency_ms = 50
+        first, second = await asyncio.gather(dispatch(backend, "1", "2"), dispatch(backend, "1", "2"))
+
+        for results in zip(first, second):
+            assert [result.message for result in results].count("Good") == 1
+        sent = [tracking for trackings in backend.transport.sent("add_colis") for tracking in trackings]
+        assert len(sent) == len(set(sent)) == 2
+        assert len(backend.zrexpress.state.colis) == 2
+
+    asyncio.run(scenario())
+
+
+def test_uncertain_failure_confirmed_by_lire(backend):
+    async def scenario():
+        await ensure_indexes(backend.db)
+        backend.transport.lose = "answer"
+        [failed] = await dispatch(backend, "1")
+        assert failed.status == "error" and failed.uncertain
+        row = (await ledger(backend))["1"]
+        assert row["status"] == "unknown"
+
+        # ZRExpress did create the parcel: the retry records it instead of sending it again
+        [retried] = await dispatch(backend, "1")
+        assert (retried.status, retried.tracking, retried.message) == ("accepted", row["tracking"], "Already dispatched")
+        assert backend.transport.sent("add_colis") == [[row["tracking"]]]
+        assert backend.transport.sent("lire") == [[row["tracking"]]]
+        assert (await ledger(backend))["1"]["status"] == "sent"
+        assert await backend.db.shipments.find_one({"tracking": row["tracking"]})
+
+    asyncio.run(scenario())
+
+
+def test_uncertain_failure_ruled_out_by_lire(backend):
+    async def scenario():
+        await ensure_indexes(backend.db)
+        backend.transport.lose = "request"
+        [failed] = await dispatch(backend, "1")
+        assert failed.status == "error" and failed.uncertain
+        row = (await ledger(backend))["1"]
+        assert row["status"] == "unknown"
+        assert backend.zrexpress.state.colis == {}
+
+        # lire does not know the parcel: it is sent again under the same tracking number
+        [retried] = await dispatch(backend, "1")
+        assert (retried.status, retried.tracking, retried.message) == ("accepted", row["tracking"], "Good")
+        assert backend.transport.sent("add_colis") == [[row["tracking"]], [row["tracking"]]]
+        assert backend.transport.sent("lire") == [[row["tracking"]]]
+        assert list(backend.zrexpress.state.colis) == [row["tracking"]]
+
+    asyncio.run(scenario())
+
+
+def test_abandoned_pending_row_is_taken_over(backend):
+    async def scenario():
+        await ensure_indexes(backend.db)
+        timeout = backend.server.DISPATCH_PENDING_TIMEOUT
+        await abandoned_row(backend, "1", "A7D-90000001", age=timeout + 60)
+        await abandoned_row(backend, "2", "A7D-90000002", age=5)
+
+        abandoned, in_flight = await dispatch(backend, "1", "2")
+        assert (abandoned.status, abandoned.tracking) == ("accepted", "A7D-90000001")
+        assert (in_flight.status, in_flight.message) == ("error", "Dispatch already in progress")
+        assert backend.transport.sent("lire") == [["A7D-90000001"]]
+        assert backend.transport.sent("add_colis") == [["A7D-90000001"]]
+        rows = await ledger(backend)
+        assert rows["1"]["status"] == "sent"
+        assert rows["2"]["status"] == "pending"
+
+    asyncio.run(scenario())
+
+
+def test_job_reclaims_its_own_rows(backend):
+    async def scenario():
+        await ensure_indexes(backend.db)
+        await abandoned_row(backend, "1", "A7D-90000001", age=5, job_id="job-1")
+        await abandoned_row(backend, "2", "A7D-90000002", age=5, job_id="job-1")
+        # The worker running job-1 died after ZRExpress accepted order 2
+        backend.zrexpress.state.colis["A7D-90000002"] = {**order("2"), "Situation": "En préparation"}
+
+        others = await dispatch(backend, "1", "2", job_id="job-2")
+        assert [result.message for result in others] == ["Dispatch already in progress"] * 2
+        assert backend.transport.calls == []
+
+        reclaimed = await dispatch(backend, "1", "2", job_id="job-1")
+        assert [(result.tracking, result.message) for result in reclaimed] == [
+            ("A7D-90000001", "Good"),
+            ("A7D-90000002", "Already dispatched"),
+        ]
+        assert backend.transport.sent("lire") == [["A7D-90000001", "A7D-90000002"]]
+        assert backend.transport.sent("add_colis") == [["A7D-90000001"]]
+        assert {row["status"] for row in (await ledger(backend)).values()} == {"sent"}
+
+    asyncio.run(scenario())
+
+
+async def api_client(backend) -> httpx.AsyncClient:
+    """A client signed in as a user with ZRExpress credentials."""
+    server = backend.server
+    user = server.User(username="shop", password="unused")
+    await backend.db.users.insert_one(user.dict())
+    await backend.db.user_settings.insert_one({"user_id": user.id, **backend.settings})
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=server.app),
+        base_url="http://backend",
+        headers={"Authorization": f"Bearer {server.create_access_token({'sub': user.username})}"},
+    )
+
+
+def test_idempotency_key_replays_the_first_response(backend):
+    async def scenario():
+        await ensure_indexes(backend.db)
+        async with await api_client(backend) as client:
+            headers = {"Idempotency-Key": "send-1"}
+            first = await client.post("/api/zrexpress/send", json=[order("1")], headers=headers)
+            replay = await client.post("/api/zrexpress/send", json=[order("1")], headers=headers)
+
+        assert first.status_code == replay.status_code == 200
+        assert replay.json() == first.json()
+        assert first.json()["results"][0]["message"] == "Good"
+        assert len(backend.transport.sent("add_colis")) == 1
+
+    asyncio.run(scenario())
+
+
+def test_idempotency_key_in_progress_is_a_409(backend):
+    async def scenario():
+        await ensure_indexes(backend.db)
+        backend.behaviour.latency_ms = 100
+        async with await api_client(backend) as client:
+            headers = {"Idempotency-Key": "send-1"}
+            responses = await asyncio.gather(
+                client.post("/api/zrexpress/send", json=[order("1")], headers=headers),
+                client.post("/api/zrexpress/send", json=[order("1")], headers=headers),
+            )
+
+        assert sorted(response.status_code for response in responses) == [200, 409]
+        assert len(backend.transport.sent("add_colis")) == 1
+
+    asyncio.run(scenario())
+
+
+def test_idempotency_key_reused_for_another_request_is_a_422(backend):
+    async def scenario():
+        await ensure_indexes(backend.db)
+        async with await api_client(backend) as client:
+            headers = {"Idempotency-Key": "send-1"}
+            first = await client.post("/api/zrexpress/send", json=[order("1")], headers=headers)
+            other_body = await client.post("/api/zrexpress/send", json=[order("2")], headers=headers)
+            other_route = await client.post("/api/zrexpress/jobs", json=[order("1")], headers=headers)
+
+        assert first.status_code == 200
+        assert other_body.status_code == other_route.status_code == 422
+        assert backend.transport.sent("add_colis") == [[first.json()["tracking_numbers"][0]]]
+        assert await backend.db.zrexpress_jobs.count_documents({}) == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,47 @@
+import asyncio
+
+from mongomock_motor import AsyncMongoMockClient
+
+from etags import VersionCounter, etag_for, etag_matches, not_modified
+
+
+def test_etag_for_is_stable_and_distinct():
+    assert etag_for("users", "abc:1", 50) == etag_for("users", "abc:1", 50)
+    assert etag_for("users", "abc:1", 50) != etag_for("users", "abc:2", 50)
+    assert etag_for("users", "abc:1", 50).startswith('"')
+
+
+def test_etag_matches():
+    etag = etag_for("orders", 1)
+    assert etag_matches(etag, etag)
+    assert etag_matches(f'"other", W/{etag}', etag)
+    assert etag_matches(" * ", etag)
+    assert not etag_matches('"other"', etag)
+    assert not etag_matches(None, etag)
+    assert not etag_matches("", etag)
+
+
+def test_not_modified():
+    etag = etag_for("orders", 1)
+    response = not_modified(etag)
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.headers["Cache-Control"] == "private, no-cache"
+
+
+def test_version_counter():
+    async def scenario():
+        counters = AsyncMongoMockClient()["test"]["counters"]
+        version = VersionCounter(counters, "users_version")
+        first = await version.current()
+        assert await version.current() == first
+        await version.bump()
+        second = await version.current()
+        assert second != first
+        assert second.split(":")[0] == first.split(":")[0]
+
+        # A recreated counter gets a new epoch, so old versions never come back
+        await counters.delete_many({})
+        assert await version.current() not in (first, second)
+
+    asyncio.run(scenario())
@@ -0,0 +1,73 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+
+async def signed_in(backend, **fields) -> httpx.AsyncClient:
+    server = backend.server
+    user = server.User(username="shop", password="unused", **fields)
+    await backend.db.users.insert_one(user.dict())
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=server.app),
+        base_url="http://backend",
+        headers={"Authorization": f"Bearer {server.create_access_token({'sub': user.username})}"},
+    )
+
+
+async def new_ticket(client: httpx.AsyncClient) -> str:
+    response = await client.post("/api/events/ticket")
+    assert response.status_code == 200
+    assert response.json()["expires_in"] > 0
+    return response.json()["ticket"]
+
+
+async def rejected(backend, ticket) -> int:
+    with pytest.raises(HTTPException) as error:
+        await backend.server.get_stream_user(ticket)
+    return error.value.status_code
+
+
+def test_ticket_opens_one_stream(backend):
+    async def scenario():
+        async with await signed_in(backend) as client:
+            ticket = await new_ticket(client)
+            assert (await client.post("/api/events/ticket", headers={"Authorization": ""})).status_code in (401, 403)
+
+        # Only a hash of the ticket is stored
+        [stored] = await backend.db.stream_tickets.find().to_list(None)
+        assert stored["_id"] == backend.server.stream_ticket_id(ticket) != ticket
+
+        user = await backend.server.get_stream_user(ticket)
+        assert user.username == "shop"
+        assert await rejected(backend, ticket) == 401
+        assert await backend.db.stream_tickets.count_documents({}) == 0
+
+    asyncio.run(scenario())
+
+
+def test_expired_ticket_and_access_token_are_rejected(backend):
+    async def scenario():
+        async with await signed_in(backend) as client:
+            ticket = await new_ticket(client)
+            token = client.headers["Authorization"].split()[1]
+        await backend.db.stream_tickets.update_many({}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+
+        assert await rejected(backend, ticket) == 401
+        assert await rejected(backend, token) == 401
+        assert await rejected(backend, None) == 401
+
+    asyncio.run(scenario())
+
+
+def test_ticket_of_a_deactivated_user_is_refused(backend):
+    async def scenario():
+        async with await signed_in(backend) as client:
+            ticket = await new_ticket(client)
+        await backend.db.users.update_one({"username": "shop"}, {"$set": {"is_active": False}})
+
+        assert await rejected(backend, ticket) == 403
+
+    asyncio.run(scenario())
@@ -0,0 +1,37 @@
+import asyncio
+import io
+
+import httpx
+from openpyxl import load_workbook
+
+from indexes import ensure_indexes
+
+
+def test_dispatch_export_as_xlsx(backend):
+    async def scenario():
+        await ensure_indexes(backend.db)
+        server = backend.server
+        user = server.User(username="shop", password="unused")
+        await backend.db.users.insert_one(user.dict())
+        order = server.EditableOrder(
+            shopify_id="1", customer_name="=Ahmed", customer_phone="0555123456", shipping_address="x",
+            city="Oran", total_price="2500", status="paid", items=[]
+        )
+        [sent] = await server.dispatch_to_zrexpress(backend.settings, user.id, [order])
+
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=server.app),
+            base_url="http://backend",
+            headers={"Authorization": f"Bearer {server.create_access_token({'sub': user.username})}"},
+        ) as client:
+            response = await client.get("/api/zrexpress/export", params={
+                "format": "xlsx", "status": "sent", "columns": "id_externe,tracking,customer_name,id_wilaya"
+            })
+
+        assert response.status_code == 200
+        rows = list(load_workbook(io.BytesIO(response.content)).active.values)
+        assert rows[0] == ("id_externe", "tracking", "customer_name", "id_wilaya")
+        # A value starting with "=" is written as text, not as a formula
+        assert rows[1:] == [("1", sent.tracking, "'=Ahmed", "31")]
+
+    asyncio.run(scenario())
@@ -0,0 +1,198 @@
+"""
+The ZRExpress dispatch queue (server.zrexpress_queue running run_zrexpress_job)
+against mongomock and the fake ZRExpress server from benchmarks/fake_upstreams.py.
+"""
+
+import asyncio
+import time
+
+from indexes import ensure_indexes
+from job_queue import JobQueue
+
+
+def order(shopify_id: str, **fields) -> dict:
+    return {
+        "shopify_id": shopify_id,
+        "customer_name": "Ahmed Benali",
+        "customer_phone": "0555123456",
+        "shipping_address": "12 rue Larbi Ben M'hidi",
+        "city": "Alger",
+        "total_price": "2500",
+        "status": "paid",
+        "items": [],
+        **fields,
+    }
+
+
+async def submit(backend, *orders: dict, user_id: str = "user-1") -> dict:
+    """Enqueue a dispatch job the way POST /zrexpress/jobs does."""
+    await ensure_indexes(backend.db)
+    if not await backend.db.user_settings.find_one({"user_id": user_id}):
+        await backend.db.user_settings.insert_one({"user_id": user_id, **backend.settings})
+    return await backend.queue.enqueue(
+        "zrexpress_send", user_id, {"orders": list(orders)}, results=[None] * len(orders)
+    )
+
+
+async def wait_for_status(queue: JobQueue, job_id: str, statuses=("completed", "failed"), timeout: float = 5.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = await queue.collection.find_one({"id": job_id})
+        if job["status"] in statuses:
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"job {job_id} still {job['status']!r} after {timeout}s")
+
+
+async def run_job(backend, job: dict) -> dict:
+    backend.queue.start()
+    try:
+        return await wait_for_status(backend.queue, job["id"])
+    finally:
+        await backend.queue.stop()
+
+
+def test_job_sends_every_order(backend):
+    async def scenario():
+        job = await submit(backend, order("1"), order("2"))
+        done = await run_job(backend, job)
+
+        assert done["status"] == "completed"
+        assert done["attempts"] == 1
+        assert done["lease_owner"] is None
+        assert [(result["status"], result["message"]) for result in done["results"]] == [("accepted", "Good")] * 2
+        trackings = [result["tracking"] for result in done["results"]]
+        assert set(backend.zrexpress.state.colis) == set(trackings)
+        assert all(colis["IDWilaya"] == "16" for colis in backend.zrexpress.state.colis.values())
+        assert await backend.db.dispatches.count_documents({"job_id": job["id"], "status": "sent"}) == 2
+
+    asyncio.run(scenario())
+
+
+def test_rejected_orders_complete_the_job(backend):
+    async def scenario():
+        job = await submit(backend, order("1"), order("2", customer_name=""), order("3", city="Nowhereville"))
+        done = await run_job(backend, job)
+
+        assert done["status"] == "completed"
+        assert done["attempts"] == 1
+        assert [result["status"] for result in done["results"]] == ["accepted", "rejected", "rejected"]
+        assert done["results"][1]["message"] == "Champs obligatoires manquants"
+        assert done["results"][2]["message"].startswith("Could not determine the wilaya")
+        assert list(backend.zrexpress.state.colis) == [done["results"][0]["tracking"]]
+        assert len(backend.transport.sent("add_colis")) == 1
+
+    asyncio.run(scenario())
+
+
+def test_upstream_errors_are_retried_until_they_clear(backend):
+    async def scenario():
+        backend.behaviour.error_rate = 1.0
+        attempts = []
+
+        async def recovering(job, queue):
+            attempts.append(job["attempts"])
+            if len(attempts) == 3:
+                backend.behaviour.error_rate = 0.0
+            return await backend.server.run_zrexpress_job(job, queue)
+
+        backend.queue.handler = recovering
+        job = await submit(backend, order("1"))
+        done = await run_job(backend, job)
+
+        assert done["status"] == "completed"
+        assert done["attempts"] == 3
+        assert done["last_error"] == "1 orders could not be delivered to ZRExpress"
+        [result] = done["results"]
+        assert result["status"] == "accepted"
+        # The 503 left the send uncertain: the retries checked with lire, then resent under the same tracking number
+        assert backend.transport.sent("add_colis") == [[result["tracking"]], [result["tracking"]]]
+        assert list(backend.zrexpress.state.colis) == [result["tracking"]]
+
+    asyncio.run(scenario())
+
+
+def test_job_fails_after_max_attempts(backend):
+    async def scenario():
+        backend.behaviour.error_rate = 1.0
+        backend.queue.max_attempts = 3
+        job = await submit(backend, order("1"))
+        done = await run_job(backend, job)
+
+        assert done["status"] == "failed"
+        assert done["attempts"] == 3
+        assert done["last_error"] == "1 orders could not be delivered to ZRExpress"
+        assert done["results"][0]["status"] == "error"
+        assert backend.zrexpress.state.colis == {}
+
+    asyncio.run(scenario())
+
+
+def test_job_without_credentials_fails_without_retrying(backend):
+    async def scenario():
+        job = await submit(backend, order("1"))
+        await backend.db.user_settings.delete_many({})
+        done = await run_job(backend, job)
+
+        assert done["status"] == "failed"
+        assert done["attempts"] == 1
+        assert done["last_error"] == "ZRExpress credentials not configured"
+        assert backend.transport.calls == []
+
+    asyncio.run(scenario())
+
+
+def test_expired_lease_is_claimed_again(backend):
+    async def scenario():
+        backend.queue.visibility_timeout = 0.2
+        job = await submit(backend, order("1"), order("2"))
+
+        # A worker claims the job, gets order 1 accepted, then dies without finishing
+        crashed = await backend.queue.claim("crashed-worker")
+        assert crashed["id"] == job["id"]
+        assert await backend.queue.claim("other-worker") is None
+        [first] = await backend.server.dispatch_to_zrexpress(
+            backend.settings, "user-1", [backend.server.EditableOrder(**order("1"))], job_id=job["id"]
+        )
+        await backend.db.dispatches.insert_one(backend.server.dispatch_ledger_entry(
+            "user-1", backend.server.EditableOrder(**order("2", tracking="A7D-90000002")), crashed["updated_at"], job["id"]
+        ))
+
+        await asyncio.sleep(0.25)
+        reclaimed = await backend.queue.claim("other-worker")
+        assert reclaimed["id"] == job["id"]
+        assert reclaimed["lease_owner"] == "other-worker"
+        assert reclaimed["attempts"] == 2
+
+        # The first worker lost its lease, so its late writes are ignored
+        await backend.queue.update(crashed, {"$set": {"status": "completed"}})
+        stored = await backend.queue.collection.find_one({"id": job["id"]})
+        assert stored["status"] == "running"
+        assert stored["lease_owner"] == "other-worker"
+
+        # The new worker gets the job's own ledger rows back without waiting for them to go stale
+        await backend.server.run_zrexpress_job(reclaimed, backend.queue)
+        stored = await backend.queue.collection.find_one({"id": job["id"]})
+        assert [(result["tracking"], result["message"]) for result in stored["results"]] == [
+            (first.tracking, "Already dispatched"),
+            ("A7D-90000002", "Good"),
+        ]
+        assert len(backend.zrexpress.state.colis) == 2
+
+    asyncio.run(scenario())
+
+
+def test_running_job_keeps_its_lease(backend):
+    async def scenario():
+        backend.behaviour.latency_ms = 500
+        backend.queue.workers = 2
+        backend.queue.visibility_timeout = 0.2
+        job = await submit(backend, order("1"))
+        done = await run_job(backend, job)
+
+        # The call outlasts the visibility timeout, but the lease is extended while it runs
+        assert done["status"] == "completed"
+        assert done["attempts"] == 1
+        assert len(backend.transport.sent("add_colis")) == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,38 @@
+from datetime import datetime
+
+import pytest
+
+from pagination import after, decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    values = [datetime(2026, 3, 1, 12, 30, 15, 250000), "user-42", 7, None]
+    cursor = encode_cursor(values)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == values
+
+
+@pytest.mark.parametrize("cursor", ["", "not a cursor", "e30", "!!!!"])
+def test_invalid_cursor(cursor):
+    # e30 is {} base64-encoded: valid JSON, but not a sort key
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_after_ascending():
+    assert after(["created_at", "id"], [5, "b"]) == {"$or": [
+        {"created_at": {"$gt": 5}},
+        {"created_at": 5, "id": {"$gt": "b"}},
+    ]}
+
+
+def test_after_descending():
+    assert after(["created_at", "id"], [5, "b"], descending=True) == {"$or": [
+        {"created_at": {"$lt": 5}},
+        {"created_at": 5, "id": {"$lt": "b"}},
+    ]}
+
+
+def test_after_rejects_a_cursor_for_another_sort():
+    with pytest.raises(ValueError):
+        after(["created_at", "id"], [5])
@@ -0,0 +1,119 @@
+import asyncio
+import time
+
+import httpx
+
+from upstream import CircuitBreaker, ShopifyRateLimiter
+
+
+def shopify_response(status_code: int = 200, call_limit: str = None, retry_after: str = None) -> httpx.Response:
+    headers = {}
+    if call_limit:
+        headers["X-Shopify-Shop-Api-Call-Limit"] = call_limit
+    if retry_after:
+        headers["Retry-After"] = retry_after
+    return httpx.Response(status_code, headers=headers)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=3, cooldown=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()  # a success resets the count
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.trips == 1
+    assert not breaker.allow()
+    assert breaker.rejected == 1
+    assert 0 < breaker.retry_after() <= 60
+
+
+def test_breaker_half_open_allows_a_single_probe():
+    breaker = CircuitBreaker("test", failure_threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()  # the probe is still in flight
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.trips == 2  # a failed probe reopens the circuit
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_breaker_abandoned_probe_frees_the_slot():
+    breaker = CircuitBreaker("test", failure_threshold=1, cooldown=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.abandon()
+    assert breaker.allow()
+
+
+def test_limiter_follows_the_call_limit_header():
+    async def scenario():
+        limiter = ShopifyRateLimiter(capacity=40, headroom=4)
+        await limiter.acquire()
+        await limiter.release(shopify_response(call_limit="36/40"))
+        assert limiter.level == 36
+
+        # One more call would go past capacity - headroom: wait for the bucket to drain one call (0.5s at 2/s)
+        started = time.monotonic()
+        await limiter.acquire()
+        waited = time.monotonic() - started
+        await limiter.release()
+        assert 0.3 < waited < 1.0
+
+    asyncio.run(scenario())
+
+
+def test_limiter_backs_off_on_429():
+    async def scenario():
+        limiter = ShopifyRateLimiter(max_concurrency=8)
+        assert limiter.concurrency == 4
+
+        await limiter.acquire()
+        await limiter.release(shopify_response(call_limit="2/40"))
+        assert limiter.concurrency == 5  # grows while the bucket is under half full
+
+        await limiter.acquire()
+        await limiter.release(shopify_response(429, call_limit="30/40", retry_after="0.3"))
+        assert limiter.concurrency == 2
+        assert limiter.throttled == 1
+
+        started = time.monotonic()
+        await limiter.acquire()
+        assert time.monotonic() - started >= 0.25
+        await limiter.release()
+
+    asyncio.run(scenario())
+
+
+def test_limiter_caps_calls_in_flight():
+    async def scenario():
+        limiter = ShopifyRateLimiter(max_concurrency=2)
+        assert limiter.concurrency == 1
+        await limiter.acquire()
+
+        second = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.05)
+        assert not second.done()
+
+        await limiter.release()
+        await asyncio.wait_for(second, timeout=1)
+        assert limiter.in_flight == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,51 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+
+from webhooks import SecretCache, verify_shopify_hmac
+
+BODY = b'{"id": 5000000001, "updated_at": "2026-03-01T12:00:00Z"}'
+
+
+def sign(body: bytes, secret: str) -> str:
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+
+def test_valid_signature():
+    assert verify_shopify_hmac(BODY, "shpss_secret", sign(BODY, "shpss_secret"))
+
+
+def test_invalid_signatures():
+    signature = sign(BODY, "shpss_secret")
+    assert not verify_shopify_hmac(BODY + b" ", "shpss_secret", signature)
+    assert not verify_shopify_hmac(BODY, "another_secret", signature)
+    assert not verify_shopify_hmac(BODY, "shpss_secret", "garbage")
+    assert not verify_shopify_hmac(BODY, "shpss_secret", None)
+    assert not verify_shopify_hmac(BODY, None, signature)
+    assert not verify_shopify_hmac(BODY, "", sign(BODY, ""))
+
+
+def test_secret_cache_is_bounded_and_skips_unknown_users():
+    async def scenario():
+        loads = []
+
+        async def load(user_id):
+            loads.append(user_id)
+            return None if user_id == "unknown" else f"secret-{user_id}"
+
+        cache = SecretCache(load, ttl=60, max_size=2)
+        assert await cache.get("a") == "secret-a"
+        assert await cache.get("b") == "secret-b"
+        assert await cache.get("a") == "secret-a"
+        assert await cache.get("c") == "secret-c"  # evicts b, the least recently used
+        assert len(cache) == 2
+        assert await cache.get("b") == "secret-b"
+        assert loads == ["a", "b", "c", "b"]
+
+        assert await cache.get("unknown") is None
+        assert await cache.get("unknown") is None
+        assert loads.count("unknown") == 2
+        assert len(cache) == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,79 @@
+import pytest
+
+from wilayas import UNRESOLVED, WilayaResolver, get_wilaya_resolver, normalize
+
+DATASET = {
+    "16": {
+        "name": "Alger",
+        "name_ar": "الجزائر",
+        "aliases": ["Algiers"],
+        "communes": ["Hydra", "Bab Ezzouar", {"name": "Bir Mourad Raïs", "name_ar": "بئر مراد رايس", "aliases": ["Birmandreis"]}],
+    },
+    "25": {"name": "Constantine", "name_ar": "قسنطينة", "communes": ["Constantine", "El Khroub"]},
+    "31": {"name": "Oran", "name_ar": "وهران", "communes": ["Oran", "Es Senia", "Bir El Djir"]},
+    "19": {"name": "Sétif", "name_ar": "سطيف", "communes": ["Sétif", "El Eulma", "Ain Arnat"]},
+    "44": {"name": "Aïn Defla", "name_ar": "عين الدفلى", "communes": ["Ain Defla", "Ain Arnat"]},
+}
+
+
+@pytest.fixture
+def resolver():
+    return WilayaResolver(DATASET)
+
+
+@pytest.mark.parametrize("a, b", [
+    ("Béjaïa", "BEJAIA"),
+    ("Djelfa", "Jelfa"),
+    ("Tizi-Ouzou", "tizi ouzou"),
+    ("Wilaya Tlemcen", "tlemcen"),
+    ("ولاية وهران", "وهران"),
+    ("عين الدفلى", "عين الدفلي"),
+])
+def test_normalize_spelling_variants(a, b):
+    assert normalize(a) == normalize(b)
+
+
+def test_exact_names(resolver):
+    assert resolver.resolve("Oran") == ("31", "Oran", 1.0)
+    assert resolver.resolve("Algiers") == ("16", None, 1.0)
+    assert resolver.resolve("قسنطينة") == ("25", None, 1.0)
+    assert resolver.resolve("بئر مراد رايس") == ("16", "Bir Mourad Raïs", 1.0)
+    assert resolver.resolve("birmandreis") == ("16", "Bir Mourad Raïs", 1.0)
+
+
+def test_typos_match_with_capped_confidence(resolver):
+    location = resolver.resolve("Constantin")
+    assert location.id_wilaya == "25"
+    assert location.commune == "Constantine"
+    assert 0 < location.confidence <= 0.9
+
+
+def test_unknown_and_empty(resolver):
+    assert resolver.resolve("Nowhereville") == UNRESOLVED
+    assert resolver.resolve("") == UNRESOLVED
+    assert resolver.resolve(None) == UNRESOLVED
+
+
+def test_shared_commune_splits_confidence(resolver):
+    assert sorted(resolver.match("Ain Arnat")) == [("19", "Ain Arnat", 0.5), ("44", "Ain Arnat", 0.5)]
+
+
+def test_commune_and_wilaya_together(resolver):
+    assert resolver.resolve("Hydra, Alger") == ("16", "Hydra", 1.0)
+
+
+def test_province_narrows_the_city(resolver):
+    assert resolver.resolve("Ain Arnat", "Sétif") == ("19", "Ain Arnat", 1.0)
+    assert resolver.resolve("Bab Ezzouar", "DZ-16") == ("16", "Bab Ezzouar", 1.0)
+
+
+def test_province_wins_over_unknown_or_conflicting_city(resolver):
+    assert resolver.resolve("Nowhereville", "16") == ("16", None, 0.9)
+    assert resolver.resolve("Oran", "DZ-16") == ("16", None, 0.7)
+
+
+def test_bundled_dataset_has_every_wilaya():
+    resolver = get_wilaya_resolver()
+    assert sorted(resolver.wilayas, key=int) == [str(code) for code in range(1, 59)]
+    assert resolver.resolve("وهران").id_wilaya == "31"
+    assert resolver.resolve("Tizi Ouzou").id_wilaya == "15"